@@ -98,15 +98,16 @@ class Agent(Daemon):
         """Reloads the agent configuration and checksd configurations."""
         log.info("Attempting a configuration reload...")
 
-        # Reload checksd configs
+        # Reload checksd configs, only the checks that changed are initialized again
         hostname = get_hostname(self._agentConfig)
-        self._checksd = load_check_directory(self._agentConfig, hostname)
+        self._checksd = load_check_directory(self._agentConfig, hostname, deferred=True,
+                                             previous=self._checksd)
 
         # Logging
         num_checks = len(self._checksd['initialized_checks'])
         if num_checks > 0:
-            log.info("Successfully reloaded {num_checks} checks".
-                     format(num_checks=num_checks))
+            log.info("Successfully reloaded {reloaded} checks, kept {kept} unchanged checks".
+                     format(**self._checksd['reload_counts']))
         else:
             log.info("No checksd configs found")
 
@@ -142,8 +143,8 @@ class Agent(Daemon):
         systemStats = get_system_stats()
         emitters = self._get_emitters()
 
-        # Load the checks.d checks
-        self._checksd = load_check_directory(self._agentConfig, hostname)
+        # Load the checks.d checks, they're imported by the collector on their first run
+        self._checksd = load_check_directory(self._agentConfig, hostname, deferred=True)
 
         # Initialize the Collector
         self.collector = Collector(self._agentConfig, emitters, systemStats, hostname)
@@ -179,7 +180,8 @@ class Agent(Daemon):
             # Do the work.
             self.collector.run(checksd=self._checksd,
                                start_event=self.start_event,
-                               configs_reloaded=self.configs_reloaded)
+                               configs_reloaded=self.configs_reloaded,
+                               scheduled=True)
             if self.configs_reloaded:
                 self.configs_reloaded = False
             if profiled:
@@ -201,8 +203,11 @@ class Agent(Daemon):
                     watchdog.reset()
                 if profiled:
                     collector_profiled_runs += 1
-                log.debug("Sleeping for {0} seconds".format(self.check_frequency))
-                time.sleep(self.check_frequency)
+                # Wake up on the next wall-clock multiple of the check frequency,
+                # whatever the time the collection took, not to drift
+                sleep_time = self.check_frequency - time.time() % self.check_frequency
+                log.debug("Sleeping for {0} seconds".format(round(sleep_time, 2)))
+                time.sleep(sleep_time)
 
         # Now clean-up.
         try:
@@ -1,5 +1,9 @@
 # stdlib
+from collections import deque
+from functools import partial
 import logging
+import math
+import threading
 from time import time
 
 # project
@@ -19,6 +23,9 @@ log = logging.getLogger(__name__)
 # MetricsBucketAggregator constructor.
 RECENT_POINT_THRESHOLD_DEFAULT = 3600
 
+# Maximum number of entries of the aggregator tags cache
+DEFAULT_TAGS_CACHE_SIZE = 16384
+
 
 class Infinity(Exception):
     pass
@@ -28,12 +35,69 @@ class UnknownValue(Exception):
     pass
 
 
+class TagsCache(object):
+    """
+    A bounded cache used to build metric contexts without sorting tags on
+    every sample. Aggregators use one to map the raw tag strings of packets
+    to (tags, hostname, device_name) tuples, and another one to map tags
+    sequences to their interned, sorted and deduplicated tuple.
+
+    It approximates a LRU with two generations of entries: entries found in
+    the old generation are promoted to the new one, and the old generation
+    is evicted when the new one is full.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = int(max_size or DEFAULT_TAGS_CACHE_SIZE)
+        self.generation_size = max(self.max_size // 2, 1)
+        self.current = {}
+        self.previous = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+    def get(self, key):
+        value = self.current.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        value = self.previous.pop(key, None)
+        if value is not None:
+            self.hits += 1
+            self.set(key, value)
+            return value
+
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        if len(self.current) >= self.generation_size:
+            self.evictions += len(self.previous)
+            self.previous = self.current
+            self.current = {}
+        self.current[key] = value
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self),
+        }
+
+
 class Metric(object):
     """
     A base metric class that accepts points, slices them into time intervals
     and performs roll-ups within those intervals.
     """
 
+    __slots__ = ()
+
     def sample(self, value, sample_rate, timestamp=None):
         """ Add a point to the given metric. """
         raise NotImplementedError()
@@ -46,6 +110,9 @@ class Metric(object):
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
 
+    __slots__ = ('formatter', 'name', 'value', 'tags', 'hostname', 'device_name',
+                 'last_sample_time', 'timestamp')
+
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
         self.name = name
@@ -87,6 +154,8 @@ class BucketGauge(Gauge):
 
     """
 
+    __slots__ = ()
+
     def flush(self, timestamp, interval):
         if self.value is not None:
             res = [self.formatter(
@@ -108,6 +177,9 @@ class BucketGauge(Gauge):
 class Count(Metric):
     """ A metric that tracks a count. """
 
+    __slots__ = ('formatter', 'name', 'value', 'tags', 'hostname', 'device_name',
+                 'last_sample_time')
+
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
         self.name = name
@@ -140,6 +212,9 @@ class Count(Metric):
 
 class MonotonicCount(Metric):
 
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name', 'prev_counter',
+                 'curr_counter', 'count', 'last_sample_time')
+
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
         self.name = name
@@ -188,6 +263,9 @@ class MonotonicCount(Metric):
 class Counter(Metric):
     """ A metric that tracks a counter value. """
 
+    __slots__ = ('formatter', 'name', 'value', 'tags', 'hostname', 'device_name',
+                 'last_sample_time')
+
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
         self.name = name
@@ -219,26 +297,165 @@ class Counter(Metric):
 
 DEFAULT_HISTOGRAM_AGGREGATES = ['max', 'median', 'avg', 'count']
 DEFAULT_HISTOGRAM_PERCENTILES = [0.95]
+DEFAULT_HISTOGRAM_BACKEND = 'exact'
+# Relative error of the quantiles (median, percentiles) of the sketch backend
+DEFAULT_HISTOGRAM_SKETCH_ACCURACY = 0.01
+# Maximum number of bins of a sketch, the lowest ones are merged past it
+HISTOGRAM_SKETCH_MAX_BINS = 2048
+
+
+class ExactSamples(list):
+    """
+    Histogram samples backend keeping every value: quantiles are exact, but
+    memory grows with the number of samples and flushing sorts them all.
+    """
+
+    __slots__ = ()
+
+    def prepare(self):
+        self.sort()
+
+    def min(self):
+        return self[0]
+
+    def max(self):
+        return self[-1]
+
+    def avg(self):
+        return sum(self) / float(len(self))
+
+    def value_at_rank(self, rank):
+        return self[rank]
+
+
+class SketchSamples(object):
+    """
+    Histogram samples backend using a DDSketch-like quantile sketch.
+
+    Values are counted in logarithmically sized bins so that any quantile
+    is estimated within `relative_accuracy` of the exact value, with
+    bounded memory and no sort of the samples. min, max, avg and count
+    are exact.
+    """
+
+    __slots__ = ('gamma', 'multiplier', 'positive_bins', 'negative_bins', 'zero_count',
+                 'count', 'sum', 'min_value', 'max_value', '_sorted_bins')
+
+    def __init__(self, relative_accuracy=None):
+        relative_accuracy = relative_accuracy or DEFAULT_HISTOGRAM_SKETCH_ACCURACY
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.multiplier = 1 / math.log(self.gamma)
+        self.positive_bins = {}
+        self.negative_bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0
+        self.min_value = None
+        self.max_value = None
+        self._sorted_bins = None
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value):
+        if value > 0:
+            bins = self.positive_bins
+        elif value < 0:
+            bins = self.negative_bins
+        else:
+            bins = None
+            self.zero_count += 1
+
+        if bins is not None:
+            index = int(math.ceil(math.log(abs(value)) * self.multiplier))
+            bins[index] = bins.get(index, 0) + 1
+            if len(bins) > HISTOGRAM_SKETCH_MAX_BINS:
+                self._collapse(bins)
+
+        if self.count == 0:
+            self.min_value = self.max_value = value
+        elif value < self.min_value:
+            self.min_value = value
+        elif value > self.max_value:
+            self.max_value = value
+        self.count += 1
+        self.sum += value
+
+    def _collapse(self, bins):
+        # Merge the bins closest to zero, losing accuracy on the smallest values
+        indexes = sorted(bins)
+        excess = len(bins) - HISTOGRAM_SKETCH_MAX_BINS
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            bins[target] += bins.pop(index)
+
+    def _bin_value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def prepare(self):
+        # (value, count) pairs, in increasing value order
+        sorted_bins = [(-self._bin_value(i), self.negative_bins[i])
+                       for i in sorted(self.negative_bins, reverse=True)]
+        if self.zero_count:
+            sorted_bins.append((0, self.zero_count))
+        sorted_bins += [(self._bin_value(i), self.positive_bins[i])
+                        for i in sorted(self.positive_bins)]
+        self._sorted_bins = sorted_bins
+
+    def min(self):
+        return self.min_value
+
+    def max(self):
+        return self.max_value
+
+    def avg(self):
+        return self.sum / float(self.count)
+
+    def value_at_rank(self, rank):
+        seen = 0
+        value = self.max_value
+        for value, count in self._sorted_bins:
+            seen += count
+            if seen > rank:
+                break
+        # The bin value can lie outside of the range of the actual samples
+        return min(max(value, self.min_value), self.max_value)
+
 
 class Histogram(Metric):
     """ A metric to track the distribution of a set of values. """
 
+    __slots__ = ('formatter', 'name', 'count', 'aggregates', 'percentiles', '_samples_factory',
+                 'samples', 'tags', 'hostname', 'device_name', 'last_sample_time')
+
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
         self.name = name
         self.count = 0
-        self.samples = []
         self.aggregates = extra_config['aggregates'] if\
             extra_config is not None and extra_config.get('aggregates') is not None\
             else DEFAULT_HISTOGRAM_AGGREGATES
         self.percentiles = extra_config['percentiles'] if\
             extra_config is not None and extra_config.get('percentiles') is not None\
             else DEFAULT_HISTOGRAM_PERCENTILES
+        self._samples_factory = self._get_samples_factory(name, extra_config or {})
+        self.samples = self._samples_factory()
         self.tags = tags
         self.hostname = hostname
         self.device_name = device_name
         self.last_sample_time = None
 
+    @staticmethod
+    def _get_samples_factory(name, extra_config):
+        backend = extra_config.get('backend') or DEFAULT_HISTOGRAM_BACKEND
+        sketch_prefixes = extra_config.get('sketch_prefixes')
+        if sketch_prefixes and name.startswith(tuple(sketch_prefixes)):
+            backend = 'sketch'
+
+        if backend == 'sketch':
+            return partial(SketchSamples, extra_config.get('sketch_accuracy'))
+        return ExactSamples
+
     def sample(self, value, sample_rate, timestamp=None):
         self.count += int(1 / sample_rate)
         self.samples.append(value)
@@ -248,13 +465,14 @@ class Histogram(Metric):
         if not self.count:
             return []
 
-        self.samples.sort()
-        length = len(self.samples)
+        samples = self.samples
+        samples.prepare()
+        length = len(samples)
 
-        min_ = self.samples[0]
-        max_ = self.samples[-1]
-        med = self.samples[int(round(length/2 - 1))]
-        avg = sum(self.samples) / float(length)
+        min_ = samples.min()
+        max_ = samples.max()
+        med = samples.value_at_rank(int(round(length/2 - 1)))
+        avg = samples.avg()
 
         aggregators = [
             ('min', min_, MetricTypes.GAUGE),
@@ -282,7 +500,7 @@ class Histogram(Metric):
         ]
 
         for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
+            val = samples.value_at_rank(int(round(p * length - 1)))
             name = '%s.%spercentile' % (self.name, int(p * 100))
             metrics.append(self.formatter(
                 hostname=self.hostname,
@@ -295,7 +513,7 @@ class Histogram(Metric):
             ))
 
         # Reset our state.
-        self.samples = []
+        self.samples = self._samples_factory()
         self.count = 0
 
         return metrics
@@ -304,6 +522,9 @@ class Histogram(Metric):
 class Set(Metric):
     """ A metric to track the number of unique elements in a set. """
 
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name', 'values',
+                 'last_sample_time')
+
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
         self.name = name
@@ -338,6 +559,9 @@ class Set(Metric):
 class Rate(Metric):
     """ Track the rate of metrics over each flush interval """
 
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name', 'samples',
+                 'last_sample_time')
+
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
         self.name = name
@@ -397,7 +621,8 @@ class Aggregator(object):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, tags_cache_size=None, histogram_backend=None,
+            histogram_sketch_prefixes=None, histogram_sketch_accuracy=None):
         self.events = []
         self.service_checks = []
         self.total_count = 0
@@ -417,11 +642,20 @@ class Aggregator(object):
         self.metric_config = {
             Histogram: {
                 'aggregates': histogram_aggregates,
-                'percentiles': histogram_percentiles
+                'percentiles': histogram_percentiles,
+                'backend': histogram_backend,
+                'sketch_prefixes': histogram_sketch_prefixes,
+                'sketch_accuracy': histogram_sketch_accuracy,
             }
         }
 
         self.utf8_decoding = utf8_decoding
+        self.tags_cache = TagsCache(tags_cache_size)
+        self.normalized_tags_cache = TagsCache(tags_cache_size)
+
+        # Held while packets are submitted and while the aggregated state is
+        # swapped out at flush time, never while it is serialized
+        self.swap_lock = threading.Lock()
 
     def packets_per_second(self, interval):
         if interval == 0:
@@ -432,28 +666,23 @@ class Aggregator(object):
         """
         Schema of a dogstatsd packet:
         <name>:<value>|<metric_type>|@<sample_rate>|#<tag1_name>:<tag1_value>,<tag2_name>:<tag2_value>:<value>|<metric_type>...
-        """
-        parsed_packets = []
-        name_and_metadata = packet.split(':', 1)
 
-        if len(name_and_metadata) != 2:
+        Returns a list of (name, value, metric_type, tags, sample_rate, hostname, device_name)
+        tuples, magic tags (host, device) being already extracted from the sorted tags.
+        """
+        name, _, data = packet.partition(':')
+        if not data:
             raise Exception('Unparseable metric packet: %s' % packet)
 
-        name = name_and_metadata[0]
-        broken_split = name_and_metadata[1].split(':')
-        data = []
-        partial_datum = None
-        for token in broken_split:
-            # We need to fix the tag groups that got broken by the : split
-            if partial_datum is None:
-                partial_datum = token
-            elif "|" not in token:
-                partial_datum += ":" + token
-            else:
-                data.append(partial_datum)
-                partial_datum = token
-        data.append(partial_datum)
+        # Fast path: a single value, i.e. no ':' followed by another '|'
+        # (colons inside of tags are not followed by any '|')
+        colon = data.find(':')
+        if colon == -1 or data.find('|', colon) == -1:
+            data = (data,)
+        else:
+            data = self._split_metric_data(data)
 
+        parsed_packets = []
         for datum in data:
             value_and_metadata = datum.split('|')
 
@@ -478,22 +707,48 @@ class Aggregator(object):
                         # Otherwise, raise an error saying it must be a number
                         raise Exception('Metric value must be a number: %s, %s' % (name, raw_value))
 
-
             # Parse the optional values - sample rate & tags.
             sample_rate = 1
             tags = None
-            for m in value_and_metadata[2:]:
-                # Parse the sample rate
-                if m[0] == '@':
-                    sample_rate = float(m[1:])
-                    assert 0 <= sample_rate <= 1
-                elif m[0] == '#':
-                    tags = tuple(sorted(m[1:].split(',')))
-
-            parsed_packets.append((name, value, metric_type, tags,sample_rate))
+            hostname = None
+            device_name = None
+            if len(value_and_metadata) > 2:
+                for m in value_and_metadata[2:]:
+                    # Parse the sample rate
+                    if m[0] == '@':
+                        sample_rate = float(m[1:])
+                        assert 0 <= sample_rate <= 1
+                    elif m[0] == '#':
+                        parsed_tags = self.tags_cache.get(m)
+                        if parsed_tags is None:
+                            parsed_tags = self._parse_tags(m[1:])
+                            self.tags_cache.set(m, parsed_tags)
+                        tags, hostname, device_name = parsed_tags
+
+            parsed_packets.append((name, value, metric_type, tags, sample_rate, hostname, device_name))
 
         return parsed_packets
 
+    def _split_metric_data(self, data):
+        """
+        Split the data of a packet holding several values, e.g.
+        `1|c|#tag:value:2|g` into `1|c|#tag:value` and `2|g`
+        """
+        broken_split = data.split(':')
+        data = []
+        partial_datum = None
+        for token in broken_split:
+            # We need to fix the tag groups that got broken by the : split
+            if partial_datum is None:
+                partial_datum = token
+            elif "|" not in token:
+                partial_datum += ":" + token
+            else:
+                data.append(partial_datum)
+                partial_datum = token
+        data.append(partial_datum)
+        return data
+
     def _unescape_sc_content(self, string):
         return string.replace('\\n', '\n').replace('m\:', 'm:')
 
@@ -587,48 +842,76 @@ class Aggregator(object):
         if self.utf8_decoding:
             packets = unicode(packets, 'utf-8', errors='replace')
 
-        for packet in packets.splitlines():
-            if not packet.strip():
-                continue
-
-            if packet.startswith('_e'):
-                self.event_count += 1
-                event = self.parse_event_packet(packet)
-                self.event(**event)
-            elif packet.startswith('_sc'):
-                self.service_check_count += 1
-                service_check = self.parse_sc_packet(packet)
-                self.service_check(**service_check)
-            else:
-                self.count += 1
-                parsed_packets = self.parse_metric_packet(packet)
-                for name, value, mtype, tags, sample_rate in parsed_packets:
-                    hostname, device_name, tags = self._extract_magic_tags(tags)
-                    self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
-                        device_name=device_name, sample_rate=sample_rate)
-
-
-    def _extract_magic_tags(self, tags):
-        """Magic tags (host, device) override metric hostname and device_name attributes"""
+        parse_metric_packet = self.parse_metric_packet
+        submit_metric = self.submit_metric
+        with self.swap_lock:
+            for packet in packets.splitlines():
+                if not packet or packet.isspace():
+                    continue
+
+                if packet[0] == '_' and packet.startswith('_e'):
+                    self.event_count += 1
+                    event = self.parse_event_packet(packet)
+                    self.event(**event)
+                elif packet[0] == '_' and packet.startswith('_sc'):
+                    self.service_check_count += 1
+                    service_check = self.parse_sc_packet(packet)
+                    self.service_check(**service_check)
+                else:
+                    self.count += 1
+                    for name, value, mtype, tags, sample_rate, hostname, device_name in parse_metric_packet(packet):
+                        submit_metric(name, value, mtype, tags, hostname, device_name, None, sample_rate)
+
+    def _parse_tags(self, tags_string):
+        """
+        Parse the tags of a packet, magic tags (host, device) override metric
+        hostname and device_name attributes.
+        Returns a (tags, hostname, device_name) tuple, tags being interned.
+        """
+        tags = tags_string.split(',')
+        tags.sort()
         hostname = None
         device_name = None
-        # This implementation avoid list operations for the common case
-        if tags:
-            tags_to_remove = []
+        # Only look for magic tags when there can be some
+        if 'host:' in tags_string or 'device:' in tags_string:
+            remaining_tags = []
             for tag in tags:
                 if tag.startswith('host:'):
                     hostname = tag[5:]
-                    tags_to_remove.append(tag)
                 elif tag.startswith('device:'):
                     device_name = tag[7:]
-                    tags_to_remove.append(tag)
-            if tags_to_remove:
-                # tags is a tuple already sorted, we convert it into a list to pop elements
-                tags = list(tags)
-                for tag in tags_to_remove:
-                    tags.remove(tag)
-                tags = tuple(tags) or None
-        return hostname, device_name, tags
+                else:
+                    remaining_tags.append(tag)
+            tags = remaining_tags
+
+        if tags:
+            tags = self._normalize_tags(tags)
+        else:
+            tags = None
+        return tags, hostname, device_name
+
+    def _normalize_tags(self, tags):
+        """ Return the interned sorted and deduplicated tuple of `tags` """
+        key = tags if type(tags) is tuple else tuple(tags)
+        cache = self.normalized_tags_cache
+        normalized_tags = cache.get(key)
+        if normalized_tags is None:
+            normalized_tags = tuple(sorted(set(tags)))
+            # Share the same tuple between all the equivalent tags sequences
+            interned_tags = cache.current.get(normalized_tags)
+            if interned_tags is None:
+                interned_tags = normalized_tags
+                cache.set(interned_tags, interned_tags)
+            cache.set(key, interned_tags)
+            normalized_tags = interned_tags
+        return normalized_tags
+
+    def tags_cache_stats(self):
+        """ Stats of the cache of packet tags, and of the cache of tags sequences """
+        stats = self.tags_cache.stats()
+        for key, value in self.normalized_tags_cache.stats().iteritems():
+            stats['normalized_%s' % key] = value
+        return stats
 
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                       device_name=None, timestamp=None, sample_rate=1):
@@ -684,30 +967,45 @@ class Aggregator(object):
         """ Flush aggregated metrics """
         raise NotImplementedError()
 
+    def swap(self):
+        """
+        Swap out the aggregated state to flush, and return it to be passed to
+        `flush_retired`. Aggregators without a separate state to swap flush
+        everything in `flush_retired`.
+        """
+        return None
+
+    def flush_retired(self, retired):
+        """ Flush the metrics of a state returned by `swap` """
+        return self.flush()
+
     def flush_events(self):
-        events = self.events
-        self.events = []
+        with self.swap_lock:
+            events = self.events
+            self.events = []
 
-        self.total_count += self.event_count
-        self.event_count = 0
+            self.total_count += self.event_count
+            self.event_count = 0
 
         log.debug("Received %d events since last flush" % len(events))
 
         return events
 
     def flush_service_checks(self):
-        service_checks = self.service_checks
-        self.service_checks = []
+        with self.swap_lock:
+            service_checks = self.service_checks
+            self.service_checks = []
 
-        self.total_count += self.service_check_count
-        self.service_check_count = 0
+            self.total_count += self.service_check_count
+            self.service_check_count = 0
 
         log.debug("Received {0} service check runs since last flush".format(len(service_checks)))
 
         return service_checks
 
     def send_packet_count(self, metric_name):
-        self.submit_metric(metric_name, self.count, 'g')
+        with self.swap_lock:
+            self.submit_metric(metric_name, self.count, 'g')
 
 class MetricsBucketAggregator(Aggregator):
     """
@@ -717,7 +1015,8 @@ class MetricsBucketAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, tags_cache_size=None, histogram_backend=None,
+            histogram_sketch_prefixes=None, histogram_sketch_accuracy=None):
         super(MetricsBucketAggregator, self).__init__(
             hostname,
             interval,
@@ -726,7 +1025,11 @@ class MetricsBucketAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            tags_cache_size,
+            histogram_backend,
+            histogram_sketch_prefixes,
+            histogram_sketch_accuracy
         )
         self.metric_by_bucket = {}
         self.last_sample_time_by_context = {}
@@ -756,7 +1059,9 @@ class MetricsBucketAggregator(Aggregator):
         if tags is None:
             context = (name, tuple(), hostname, device_name)
         else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
+            # Metrics share the interned tuple instead of keeping their own tags
+            tags = self._normalize_tags(tags)
+            context = (name, tags, hostname, device_name)
 
         cur_time = time()
         # Check to make sure that the timestamp that is passed in (if any) is not older than
@@ -784,67 +1089,93 @@ class MetricsBucketAggregator(Aggregator):
 
             metric_by_context[context].sample(value, sample_rate, timestamp)
 
-    def create_empty_metrics(self, sample_time_by_context, expiry_timestamp, flush_timestamp, metrics):
+    def create_empty_metrics(self, sample_time_by_context, expiry_timestamp, flush_timestamp, metrics,
+                             sampled_contexts=None):
         # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
         #  (Set, Gauge, Histogram) do not report if no data is submitted
-        for context, last_sample_time in sample_time_by_context.items():
+        sampled_contexts = sampled_contexts or {}
+        expired_contexts = []
+        for context, last_sample_time in sample_time_by_context.iteritems():
+            if context in sampled_contexts:
+                continue
             if last_sample_time < expiry_timestamp:
                 log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                self.last_sample_time_by_context.pop(context, None)
+                expired_contexts.append(context)
             else:
                 # The expiration currently only applies to Counters
                 # This counts on the ordering of the context created in submit_metric not changing
                 metric = Counter(self.formatter, context[0], context[1], context[2], context[3])
                 metrics += metric.flush(flush_timestamp, self.interval)
+        for context in expired_contexts:
+            self.last_sample_time_by_context.pop(context, None)
 
     def flush(self):
-        cur_time = time()
-        flush_cutoff_time = self.calculate_bucket_start(cur_time)
+        return self.flush_retired(self.swap())
+
+    def swap(self):
+        """
+        Take the buckets that are complete out of the aggregator, under the
+        swap lock. Packets keep being submitted to the current bucket while
+        the returned state is flushed.
+        """
+        with self.swap_lock:
+            cur_time = time()
+            flush_cutoff_time = self.calculate_bucket_start(cur_time)
+            has_buckets = bool(self.metric_by_bucket)
+            retired_buckets = [
+                (bucket_start_timestamp, self.metric_by_bucket.pop(bucket_start_timestamp))
+                for bucket_start_timestamp in sorted(self.metric_by_bucket.keys())
+                if bucket_start_timestamp < flush_cutoff_time
+            ]
+
+            count = self.count
+            self.total_count += count
+            self.count = 0
+            num_discarded_old_points = self.num_discarded_old_points
+            self.num_discarded_old_points = 0
+            self.current_bucket = None
+            self.current_mbc = {}
+
+        return (cur_time, flush_cutoff_time, has_buckets, retired_buckets,
+                count, num_discarded_old_points)
+
+    def flush_retired(self, retired):
+        cur_time, flush_cutoff_time, has_buckets, retired_buckets, count, num_discarded_old_points = retired
         expiry_timestamp = cur_time - self.expiry_seconds
 
         metrics = []
 
-        if self.metric_by_bucket:
+        if has_buckets:
             # We want to process these in order so that we can check for and expired metrics and
-            #  re-create non-expired metrics.  We also mutate self.metric_by_bucket.
-            for bucket_start_timestamp in sorted(self.metric_by_bucket.keys()):
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
-                if bucket_start_timestamp < flush_cutoff_time:
-                    not_sampled_in_this_bucket = self.last_sample_time_by_context.copy()
-                    # We mutate this dictionary while iterating so don't use an iterator.
-                    for context, metric in metric_by_context.items():
-                        if metric.last_sample_time < expiry_timestamp:
-                            # This should never happen
-                            log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                            not_sampled_in_this_bucket.pop(context, None)
-                            self.last_sample_time_by_context.pop(context, None)
-                        else:
-                            metrics += metric.flush(bucket_start_timestamp, self.interval)
-                            if isinstance(metric, Counter):
-                                self.last_sample_time_by_context[context] = metric.last_sample_time
-                                not_sampled_in_this_bucket.pop(context, None)
-                    # We need to account for Metrics that have not expired and were not flushed for this bucket
-                    self.create_empty_metrics(not_sampled_in_this_bucket, expiry_timestamp, bucket_start_timestamp, metrics)
-
-                    del self.metric_by_bucket[bucket_start_timestamp]
+            #  re-create non-expired metrics.
+            for bucket_start_timestamp, metric_by_context in retired_buckets:
+                # Only the contexts sampled in this bucket are flushed here, instead of
+                #  copying the sample times of every known counter for each bucket
+                for context, metric in metric_by_context.iteritems():
+                    if metric.last_sample_time < expiry_timestamp:
+                        # This should never happen
+                        log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+                        self.last_sample_time_by_context.pop(context, None)
+                    else:
+                        metrics += metric.flush(bucket_start_timestamp, self.interval)
+                        if isinstance(metric, Counter):
+                            self.last_sample_time_by_context[context] = metric.last_sample_time
+                # We need to account for Metrics that have not expired and were not flushed for this bucket
+                self.create_empty_metrics(self.last_sample_time_by_context, expiry_timestamp,
+                                          bucket_start_timestamp, metrics, metric_by_context)
         else:
             # Even if there are no metrics in this flush, there may be some non-expired counters
             #  We should only create these non-expired metrics if we've passed an interval since the last flush
             if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
-                self.create_empty_metrics(self.last_sample_time_by_context.copy(), expiry_timestamp,
+                self.create_empty_metrics(self.last_sample_time_by_context, expiry_timestamp,
                                           flush_cutoff_time-self.interval, metrics)
 
         # Log a warning regarding metrics with old timestamps being submitted
-        if self.num_discarded_old_points > 0:
-            log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
-            self.num_discarded_old_points = 0
+        if num_discarded_old_points > 0:
+            log.warn('%s points were discarded as a result of having an old timestamp' % num_discarded_old_points)
 
         # Save some stats.
-        log.debug("received %s payloads since last flush" % self.count)
-        self.total_count += self.count
-        self.count = 0
-        self.current_bucket = None
-        self.current_mbc = {}
+        log.debug("received %s payloads since last flush" % count)
         self.last_flush_cutoff_time = flush_cutoff_time
         return metrics
 
@@ -857,7 +1188,8 @@ class MetricsAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, tags_cache_size=None, histogram_backend=None,
+            histogram_sketch_prefixes=None, histogram_sketch_accuracy=None):
         super(MetricsAggregator, self).__init__(
             hostname,
             interval,
@@ -866,9 +1198,20 @@ class MetricsAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            tags_cache_size,
+            histogram_backend,
+            histogram_sketch_prefixes,
+            histogram_sketch_accuracy
         )
         self.metrics = {}
+        # Contexts sampled since the last flush, the only ones with points to flush
+        self.dirty_contexts = set()
+        # Counters keep reporting "0" until they expire, so they are flushed even if idle
+        self.counter_contexts = set()
+        # (flush timestamp, contexts flushed) pairs, in flush order: contexts that
+        # were not sampled again since the oldest ones are candidates for expiry
+        self.expiry_wheel = deque()
         self.metric_type_to_class = {
             'g': Gauge,
             'ct': Count,
@@ -890,11 +1233,16 @@ class MetricsAggregator(Aggregator):
         if tags is None:
             context = (name, tuple(), hostname, device_name)
         else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
+            # Metrics share the interned tuple instead of keeping their own tags
+            tags = self._normalize_tags(tags)
+            context = (name, tags, hostname, device_name)
         if context not in self.metrics:
             metric_class = self.metric_type_to_class[mtype]
             self.metrics[context] = metric_class(self.formatter, name, tags,
                 hostname, device_name, self.metric_config.get(metric_class))
+            if metric_class is Counter:
+                self.counter_contexts.add(context)
+        self.dirty_contexts.add(context)
         cur_time = time()
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
             log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
@@ -932,16 +1280,23 @@ class MetricsAggregator(Aggregator):
         timestamp = time()
         expiry_timestamp = timestamp - self.expiry_seconds
 
-        # Flush points and remove expired metrics. We mutate this dictionary
-        # while iterating so don't use an iterator.
+        self._expire_idle_contexts(expiry_timestamp)
+
+        # Only flush the metrics that can have points, the other ones would
+        # return nothing: sampled metrics and counters.
         metrics = []
-        for context, metric in self.metrics.items():
+        for context in self.dirty_contexts | self.counter_contexts:
+            metric = self.metrics.get(context)
+            if metric is None:
+                continue
             if metric.last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                del self.metrics[context]
+                self._expire_context(context)
             else:
                 metrics += metric.flush(timestamp, self.interval)
 
+        self.expiry_wheel.append((timestamp, self.dirty_contexts))
+        self.dirty_contexts = set()
+
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
             log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
@@ -953,6 +1308,21 @@ class MetricsAggregator(Aggregator):
         self.count = 0
         return metrics
 
+    def _expire_context(self, context):
+        log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+        del self.metrics[context]
+        self.counter_contexts.discard(context)
+
+    def _expire_idle_contexts(self, expiry_timestamp):
+        # Contexts flushed before the expiry timestamp were last sampled before
+        # it too, unless they have been sampled again since.
+        while self.expiry_wheel and self.expiry_wheel[0][0] < expiry_timestamp:
+            _, contexts = self.expiry_wheel.popleft()
+            for context in contexts:
+                metric = self.metrics.get(context)
+                if metric is not None and metric.last_sample_time < expiry_timestamp:
+                    self._expire_context(context)
+
 def get_formatter(config):
     formatter = api_formatter
 
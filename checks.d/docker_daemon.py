@@ -14,14 +14,19 @@ from utils.dockerutil import find_cgroup, find_cgroup_filename_pattern, get_clie
     set_docker_settings, image_tag_extractor, container_name_extractor
 from utils.kubeutil import get_kube_labels
 from utils.platform import Platform
+from utils.procfs import read_pseudo_file
 
 
 EVENT_TYPE = 'docker'
 SERVICE_CHECK_NAME = 'docker.service_up'
 SIZE_REFRESH_RATE = 5  # Collect container sizes every 5 iterations of the check
 MAX_CGROUP_LISTING_RETRIES = 3
+# Look for the processes of a container again every N runs when a crawl didn't find them
+UNRESOLVED_CONTAINER_RETRY_RUNS = 10
 CONTAINER_ID_RE = re.compile('[0-9a-f]{64}')
 POD_NAME_LABEL = "io.kubernetes.pod.name"
+# Events after which the processes of a container are different
+CONTAINER_PID_EVENTS = set(['start', 'restart', 'die', 'destroy'])
 
 GAUGE = AgentCheck.gauge
 RATE = AgentCheck.rate
@@ -157,6 +162,11 @@ class DockerDaemon(AgentCheck):
             self._filtered_containers = set()
             self._disable_net_metrics = False
 
+            # Index of the cgroup directories and PIDs of the containers, kept between runs
+            self._cgroup_filename_patterns = {}
+            self._container_pids = {}
+            self._unresolved_containers = {}  # Runs since the last crawl which didn't find them
+
             # At first run we'll just collect the events from the latest 60 secs
             self._last_event_collection_ts = int(time.time()) - 60
 
@@ -225,6 +235,7 @@ class DockerDaemon(AgentCheck):
 
         # Get the list of containers and the index of their names
         containers_by_id = self._get_and_count_containers()
+        self._prune_container_index(containers_by_id)
         containers_by_id = self._crawl_container_pids(containers_by_id)
 
         # Report performance container metrics (cpu, mem, net, io)
@@ -553,6 +564,7 @@ class DockerDaemon(AgentCheck):
     def _process_events(self, containers_by_id):
         try:
             api_events = self._get_events()
+            self._invalidate_container_pids(api_events)
             aggregated_events = self._pre_aggregate_events(api_events, containers_by_id)
             events = self._format_events(aggregated_events, containers_by_id)
         except (socket.timeout, urllib2.URLError):
@@ -648,18 +660,24 @@ class DockerDaemon(AgentCheck):
             "file": filename,
         }
 
-        return find_cgroup_filename_pattern(self._mountpoints, container_id) % (params)
+        # The cgroup directory of a container doesn't move, only look for it once
+        pattern = self._cgroup_filename_patterns.get(container_id)
+        if pattern is None:
+            pattern = find_cgroup_filename_pattern(self._mountpoints, container_id)
+            self._cgroup_filename_patterns[container_id] = pattern
+
+        return pattern % (params)
 
     def _parse_cgroup_file(self, stat_file):
         """Parse a cgroup pseudo file for key/values."""
         self.log.debug("Opening cgroup file: %s" % stat_file)
         try:
-            with open(stat_file, 'r') as fp:
-                if 'blkio' in stat_file:
-                    return self._parse_blkio_metrics(fp.read().splitlines())
-                else:
-                    return dict(map(lambda x: x.split(' ', 1), fp.read().splitlines()))
-        except IOError:
+            lines = read_pseudo_file(stat_file).splitlines()
+            if 'blkio' in stat_file:
+                return self._parse_blkio_metrics(lines)
+            else:
+                return dict(map(lambda x: x.split(' ', 1), lines))
+        except (IOError, OSError):
             # It is possible that the container got stopped between the API call and now
             self.log.info("Can't open %s. Metrics for this container are skipped." % stat_file)
 
@@ -677,51 +695,105 @@ class DockerDaemon(AgentCheck):
         return metrics
 
     # proc files
+    def _prune_container_index(self, containers_by_id):
+        """Forget the cgroup directories and PIDs of the containers which are gone or excluded."""
+        for index in (self._cgroup_filename_patterns, self._container_pids, self._unresolved_containers):
+            for container_id in index.keys():
+                if container_id not in containers_by_id:
+                    del index[container_id]
+
+    def _invalidate_container_pids(self, api_events):
+        """Forget the PIDs of the containers which were started or stopped since the last run."""
+        for event in api_events:
+            if event.get('status') in CONTAINER_PID_EVENTS:
+                self._container_pids.pop(event.get('id'), None)
+                self._unresolved_containers.pop(event.get('id'), None)
+
+    def _get_container_id(self, proc_path, pid):
+        """Return the ID of the container of the process `pid`, None if it isn't in a container."""
+        content = read_pseudo_file(os.path.join(proc_path, pid, 'cgroup'))
+        for line in content.splitlines():
+            line = line.split(':')
+            if line[1] in ('cpu,cpuacct', 'cpuacct,cpu', 'cpuacct') and 'docker' in line[2]:
+                match = CONTAINER_ID_RE.search(line[2])
+                return match.group(0) if match else None
+        return None
+
+    def _is_container_pid(self, proc_path, pid, container_id):
+        """Tell if the process `pid` is still running in the container `container_id`."""
+        try:
+            return self._get_container_id(proc_path, pid) == container_id
+        except Exception:
+            return False
+
     def _crawl_container_pids(self, container_dict):
-        """Crawl `/proc` to find container PIDs and add them to `containers_by_id`."""
+        """Find a PID of the running containers and add it to `containers_by_id`.
+
+        PIDs are kept between runs and checked against the cgroup of their process, `/proc`
+        is only crawled when a running container has no known PID anymore.
+        """
         proc_path = os.path.join(self._docker_root, 'proc')
-        pid_dirs = [_dir for _dir in os.listdir(proc_path) if _dir.isdigit()]
-
-        if len(pid_dirs) == 0:
-            self.warning("Unable to find any pid directory in {0}. "
-                "If you are running the agent in a container, make sure to "
-                'share the volume properly: "/proc:/host/proc:ro". '
-                "See https://github.com/DataDog/docker-dd-agent/blob/master/README.md for more information. "
-                "Network metrics will be missing".format(proc_path))
-            self._disable_net_metrics = True
-            return container_dict
-
-        self._disable_net_metrics = False
-
-        for folder in pid_dirs:
-
-            try:
-                path = os.path.join(proc_path, folder, 'cgroup')
-                with open(path, 'r') as f:
-                    content = [line.strip().split(':') for line in f.readlines()]
-            except IOError, e:
-                #  Issue #2074
-                self.log.debug("Cannot read %s, "
-                               "process likely raced to finish : %s" %
-                               (path, str(e)))
-            except Exception, e:
-                self.warning("Cannot read %s : %s" % (path, str(e)))
+
+        unresolved = set()
+        for container_id, container in container_dict.iteritems():
+            if not self._is_container_running(container):
+                # It will have different processes when it runs again
+                self._container_pids.pop(container_id, None)
+                self._unresolved_containers.pop(container_id, None)
                 continue
 
-            try:
-                for line in content:
-                    if line[1] in ('cpu,cpuacct', 'cpuacct,cpu', 'cpuacct') and 'docker' in line[2]:
-                        cpuacct = line[2]
-                        break
-                else:
+            pid = self._container_pids.get(container_id)
+            if pid is not None and not self._is_container_pid(proc_path, pid, container_id):
+                del self._container_pids[container_id]
+                pid = None
+            if pid is None:
+                # Containers whose processes weren't found by a crawl are only looked for
+                # again after a few runs
+                if container_id in self._unresolved_containers:
+                    self._unresolved_containers[container_id] += 1
+                    if self._unresolved_containers[container_id] < UNRESOLVED_CONTAINER_RETRY_RUNS:
+                        continue
+                unresolved.add(container_id)
+
+        if unresolved:
+            pid_dirs = [_dir for _dir in os.listdir(proc_path) if _dir.isdigit()]
+
+            if len(pid_dirs) == 0:
+                self.warning("Unable to find any pid directory in {0}. "
+                    "If you are running the agent in a container, make sure to "
+                    'share the volume properly: "/proc:/host/proc:ro". '
+                    "See https://github.com/DataDog/docker-dd-agent/blob/master/README.md for more information. "
+                    "Network metrics will be missing".format(proc_path))
+                self._disable_net_metrics = True
+                return container_dict
+
+            self._disable_net_metrics = False
+
+            remaining = set(unresolved)
+            for folder in pid_dirs:
+                try:
+                    container_id = self._get_container_id(proc_path, folder)
+                except (IOError, OSError), e:
+                    #  Issue #2074
+                    self.log.debug("Cannot read the cgroup of process %s, "
+                                   "process likely raced to finish : %s" %
+                                   (folder, str(e)))
+                    continue
+                except Exception, e:
+                    self.warning("Cannot parse the cgroup of process %s : %s" % (folder, str(e)))
                     continue
 
-                match = CONTAINER_ID_RE.search(cpuacct)
-                if match:
-                    container_id = match.group(0)
-                    container_dict[container_id]['_pid'] = folder
-                    container_dict[container_id]['_proc_root'] = os.path.join(proc_path, folder)
-            except Exception, e:
-                self.warning("Cannot parse %s content: %s" % (path, str(e)))
-                continue
+                if container_id in remaining:
+                    self._container_pids[container_id] = folder
+                    self._unresolved_containers.pop(container_id, None)
+                    remaining.discard(container_id)
+                    if not remaining:
+                        break
+
+            for container_id in remaining:
+                self._unresolved_containers[container_id] = 0
+
+        for container_id, pid in self._container_pids.iteritems():
+            container_dict[container_id]['_pid'] = pid
+            container_dict[container_id]['_proc_root'] = os.path.join(proc_path, pid)
         return container_dict
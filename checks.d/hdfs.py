@@ -31,11 +31,11 @@ class HDFSCheck(AgentCheck):
             host, port = instance['namenode'], instance.get('port', DEFAULT_PORT)
             return snakebite.client.Client(host, port)
 
-        if type(instance['namenodes']) != list or len(instance['namenodes']) == 0:
+        if not isinstance(instance['namenodes'], list) or len(instance['namenodes']) == 0:
             raise ValueError('"namenodes parameter should be a list of dictionaries.')
 
         for namenode in instance['namenodes']:
-            if type(namenode) != dict:
+            if not isinstance(namenode, dict):
                 raise ValueError('"namenodes parameter should be a list of dictionaries.')
 
             if "url" not in namenode:
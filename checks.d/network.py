@@ -7,6 +7,7 @@ import re
 # project
 from checks import AgentCheck
 from utils.platform import Platform
+from utils.procfs import PROCFS_PATH, read_socket_states
 from utils.subprocess_output import get_subprocess_output
 
 BSD_TCP_METRICS = [
@@ -52,6 +53,21 @@ class Network(AgentCheck):
             "LAST_ACK": "closing",
             "LISTEN": "listening",
             "CLOSING": "closing",
+        },
+        # Hex codes of the states in /proc/net/tcp[6], see include/net/tcp_states.h
+        "proc": {
+            "01": "established",
+            "02": "opening",
+            "03": "opening",
+            "04": "closing",
+            "05": "closing",
+            "06": "time_wait",
+            "07": "closing",
+            "08": "closing",
+            "09": "closing",
+            "0A": "listening",
+            "0B": "closing",
+            "0C": "opening",
         }
     }
 
@@ -138,42 +154,15 @@ class Network(AgentCheck):
     def _check_linux(self, instance):
         if self._collect_cx_state:
             try:
-                self.log.debug("Using `ss` to collect connection state")
-                # Try using `ss` for increased performance over `netstat`
-                for ip_version in ['4', '6']:
-                    # Call `ss` for each IP version because there's no built-in way of distinguishing
-                    # between the IP versions in the output
-                    output, _, _ = get_subprocess_output(["ss", "-n", "-u", "-t", "-a", "-{0}".format(ip_version)], self.log)
-                    lines = output.splitlines()
-                    # Netid  State      Recv-Q Send-Q     Local Address:Port       Peer Address:Port
-                    # udp    UNCONN     0      0              127.0.0.1:8125                  *:*
-                    # udp    ESTAB      0      0              127.0.0.1:37036         127.0.0.1:8125
-                    # udp    UNCONN     0      0        fe80::a00:27ff:fe1c:3c4:123          :::*
-                    # tcp    TIME-WAIT  0      0          90.56.111.177:56867        46.105.75.4:143
-                    # tcp    LISTEN     0      0       ::ffff:127.0.0.1:33217  ::ffff:127.0.0.1:7199
-                    # tcp    ESTAB      0      0       ::ffff:127.0.0.1:58975  ::ffff:127.0.0.1:2181
-
-                    metrics = self._parse_linux_cx_state(lines[1:], self.TCP_STATES['ss'], 1, ip_version=ip_version)
-                    # Only send the metrics which match the loop iteration's ip version
-                    for stat, metric in self.CX_STATE_GAUGE.iteritems():
-                        if stat[0].endswith(ip_version):
-                            self.gauge(metric, metrics.get(metric))
-
-            except OSError:
-                self.log.info("`ss` not found: using `netstat` as a fallback")
-                output, _, _ = get_subprocess_output(["netstat", "-n", "-u", "-t", "-a"], self.log)
-                lines = output.splitlines()
-                # Active Internet connections (w/o servers)
-                # Proto Recv-Q Send-Q Local Address           Foreign Address         State
-                # tcp        0      0 46.105.75.4:80          79.220.227.193:2032     SYN_RECV
-                # tcp        0      0 46.105.75.4:143         90.56.111.177:56867     ESTABLISHED
-                # tcp        0      0 46.105.75.4:50468       107.20.207.175:443      TIME_WAIT
-                # tcp6       0      0 46.105.75.4:80          93.15.237.188:58038     FIN_WAIT2
-                # tcp6       0      0 46.105.75.4:80          79.220.227.193:2029     ESTABLISHED
-                # udp        0      0 0.0.0.0:123             0.0.0.0:*
-                # udp6       0      0 :::41458                :::*
-
-                metrics = self._parse_linux_cx_state(lines[2:], self.TCP_STATES['netstat'], 5)
+                self.log.debug("Using /proc/net to collect connection state")
+                # Count the sockets by state straight from the kernel's socket tables,
+                # much cheaper than running `ss` or `netstat` and parsing their output
+                socket_states = read_socket_states(PROCFS_PATH)
+            except (IOError, OSError):
+                self.log.info("/proc/net can't be read: using `ss` or `netstat` as a fallback")
+                self._check_linux_cx_state_subprocess()
+            else:
+                metrics = self._parse_procfs_cx_state(socket_states)
                 for metric, value in metrics.iteritems():
                     self.gauge(metric, value)
 
@@ -264,6 +253,47 @@ class Network(AgentCheck):
             # On Openshift, /proc/net/snmp is only readable by root
             self.log.debug("Unable to read /proc/net/snmp.")
 
+    def _check_linux_cx_state_subprocess(self):
+        try:
+            self.log.debug("Using `ss` to collect connection state")
+            # Try using `ss` for increased performance over `netstat`
+            for ip_version in ['4', '6']:
+                # Call `ss` for each IP version because there's no built-in way of distinguishing
+                # between the IP versions in the output
+                output, _, _ = get_subprocess_output(["ss", "-n", "-u", "-t", "-a", "-{0}".format(ip_version)], self.log)
+                lines = output.splitlines()
+                # Netid  State      Recv-Q Send-Q     Local Address:Port       Peer Address:Port
+                # udp    UNCONN     0      0              127.0.0.1:8125                  *:*
+                # udp    ESTAB      0      0              127.0.0.1:37036         127.0.0.1:8125
+                # udp    UNCONN     0      0        fe80::a00:27ff:fe1c:3c4:123          :::*
+                # tcp    TIME-WAIT  0      0          90.56.111.177:56867        46.105.75.4:143
+                # tcp    LISTEN     0      0       ::ffff:127.0.0.1:33217  ::ffff:127.0.0.1:7199
+                # tcp    ESTAB      0      0       ::ffff:127.0.0.1:58975  ::ffff:127.0.0.1:2181
+
+                metrics = self._parse_linux_cx_state(lines[1:], self.TCP_STATES['ss'], 1, ip_version=ip_version)
+                # Only send the metrics which match the loop iteration's ip version
+                for stat, metric in self.CX_STATE_GAUGE.iteritems():
+                    if stat[0].endswith(ip_version):
+                        self.gauge(metric, metrics.get(metric))
+
+        except OSError:
+            self.log.info("`ss` not found: using `netstat` as a fallback")
+            output, _, _ = get_subprocess_output(["netstat", "-n", "-u", "-t", "-a"], self.log)
+            lines = output.splitlines()
+            # Active Internet connections (w/o servers)
+            # Proto Recv-Q Send-Q Local Address           Foreign Address         State
+            # tcp        0      0 46.105.75.4:80          79.220.227.193:2032     SYN_RECV
+            # tcp        0      0 46.105.75.4:143         90.56.111.177:56867     ESTABLISHED
+            # tcp        0      0 46.105.75.4:50468       107.20.207.175:443      TIME_WAIT
+            # tcp6       0      0 46.105.75.4:80          93.15.237.188:58038     FIN_WAIT2
+            # tcp6       0      0 46.105.75.4:80          79.220.227.193:2029     ESTABLISHED
+            # udp        0      0 0.0.0.0:123             0.0.0.0:*
+            # udp6       0      0 :::41458                :::*
+
+            metrics = self._parse_linux_cx_state(lines[2:], self.TCP_STATES['netstat'], 5)
+            for metric, value in metrics.iteritems():
+                self.gauge(metric, value)
+
     # Parse the output of the command that retrieves the connection state (either `ss` or `netstat`)
     # Returns a dict metric_name -> value
     def _parse_linux_cx_state(self, lines, tcp_states, state_col, ip_version=None):
@@ -282,6 +312,20 @@ class Network(AgentCheck):
 
         return metrics
 
+    # Count the connections by state from the socket counts of /proc/net, see `read_socket_states`
+    # Returns a dict metric_name -> value
+    def _parse_procfs_cx_state(self, socket_states):
+        metrics = dict.fromkeys(self.CX_STATE_GAUGE.values(), 0)
+        tcp_states = self.TCP_STATES['proc']
+        for ip_version, suffix in (('4', ''), ('6', '6')):
+            for state, count in socket_states['tcp' + suffix].iteritems():
+                if state in tcp_states:
+                    metrics[self.CX_STATE_GAUGE['tcp' + ip_version, tcp_states[state]]] += count
+            udp_count = sum(socket_states['udp' + suffix].itervalues())
+            metrics[self.CX_STATE_GAUGE['udp' + ip_version, 'connections']] += udp_count
+
+        return metrics
+
     def _check_bsd(self, instance):
         netstat_flags = ['-i', '-b']
 
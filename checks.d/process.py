@@ -1,5 +1,6 @@
 # stdlib
 from collections import defaultdict
+import re
 import time
 
 # 3p
@@ -9,6 +10,7 @@ import psutil
 from checks import AgentCheck
 from config import _is_affirmative
 from utils.platform import Platform
+from utils.procfs import is_procfs_available, read_process_stats
 
 
 DEFAULT_AD_CACHE_DURATION = 120
@@ -31,6 +33,81 @@ ATTR_TO_METRIC = {
 }
 
 
+class ProcessSnapshot(object):
+    """
+    The processes running when it was taken, shared by all the instances of the check:
+    processes are listed once, and their name or command line read at most once.
+
+    The command lines are matched against the search strings of all the instances
+    at once, with a single regex discarding the processes that match none of them.
+    """
+    def __init__(self, exact_strings, cmdline_strings, skip_pids, log):
+        self.pids = set()
+        # Processes whose name, or command line, can't be read
+        self.denied_pids = {True: set(), False: set()}
+        self._log = log
+        self._names = exact_strings is not None
+        self._cmdlines = {} if cmdline_strings is not None else None
+        self._pids_by_name = defaultdict(set)
+        self._pids_by_string = defaultdict(set)
+        self._strings = set(cmdline_strings or [])
+        self.refreshed_ad_cache = False
+        self._scan(skip_pids)
+
+    def _scan(self, skip_pids):
+        pattern = None
+        if self._strings:
+            pattern = re.compile('|'.join(re.escape(string) for string in self._strings))
+
+        for proc in psutil.process_iter():
+            if proc.pid in skip_pids:
+                continue
+
+            try:
+                if self._names:
+                    try:
+                        self._pids_by_name[proc.name()].add(proc.pid)
+                    except psutil.AccessDenied:
+                        self.denied_pids[True].add(proc.pid)
+
+                if self._cmdlines is not None:
+                    try:
+                        cmdline = ' '.join(proc.cmdline())
+                    except psutil.AccessDenied:
+                        self.denied_pids[False].add(proc.pid)
+                    else:
+                        self._cmdlines[proc.pid] = cmdline
+                        if pattern is not None and pattern.search(cmdline):
+                            for string in self._strings:
+                                if string in cmdline:
+                                    self._pids_by_string[string].add(proc.pid)
+            except psutil.NoSuchProcess:
+                self._log.debug('Process %s disappeared while scanning', proc.pid)
+                continue
+
+            self.pids.add(proc.pid)
+
+    def can_search(self, exact_match):
+        if exact_match:
+            return self._names
+        return self._cmdlines is not None
+
+    def find(self, string, exact_match):
+        """ Returns the pids of the processes named `string`, or with `string` in their command line """
+        # FIXME 6.x: All has been deprecated from the doc, should be removed
+        if string == 'All':
+            return self.pids - self.denied_pids[exact_match]
+        if exact_match:
+            return self._pids_by_name.get(string, set())
+        if string not in self._strings:
+            # Unknown when the snapshot was taken, search it once
+            self._strings.add(string)
+            for pid, cmdline in self._cmdlines.iteritems():
+                if string in cmdline:
+                    self._pids_by_string[string].add(pid)
+        return self._pids_by_string.get(string, set())
+
+
 class ProcessCheck(AgentCheck):
     def __init__(self, name, init_config, agentConfig, instances=None):
         AgentCheck.__init__(self, name, init_config, agentConfig, instances)
@@ -61,8 +138,27 @@ class ProcessCheck(AgentCheck):
             )
         )
 
-        # Process cache, indexed by instance
-        self.process_cache = defaultdict(dict)
+        # Process cache, indexed by PID and shared by the instances
+        self.process_cache = {}
+
+        # On Linux, the stats of the processes are read from /proc directly, each file
+        # once, instead of once per psutil method. Indexed by PID, the last
+        # (start time, CPU time, timestamp) of each process to compute its CPU usage.
+        self._use_procfs = Platform.is_linux() and is_procfs_available()
+        self._cpu_samples = {}
+
+        # The instances run during a collection cycle share a snapshot of the
+        # processes, and read the stats of each process once
+        self._start_cycle()
+
+    def _start_cycle(self):
+        self._snapshot = None
+        self._process_stats = {}
+        self._cycle_names = set()
+
+    def run(self, *args, **kwargs):
+        self._start_cycle()
+        return AgentCheck.run(self, *args, **kwargs)
 
     def should_refresh_ad_cache(self, name):
         now = time.time()
@@ -72,6 +168,48 @@ class ProcessCheck(AgentCheck):
         now = time.time()
         return now - self.last_pid_cache_ts.get(name, 0) > self.pid_cache_duration
 
+    def _get_search_strings(self):
+        """ Returns the names, and the command line substrings, searched by the instances """
+        exact_strings, cmdline_strings = None, None
+        for instance in self.instances:
+            search_string = instance.get('search_string')
+            if not isinstance(search_string, list):
+                continue
+            if _is_affirmative(instance.get('exact_match', True)):
+                exact_strings = (exact_strings or set()).union(search_string)
+            else:
+                cmdline_strings = (cmdline_strings or set()).union(search_string)
+        return exact_strings, cmdline_strings
+
+    def get_process_snapshot(self, search_string, exact_match, refresh_ad_cache):
+        """ Returns the snapshot of the processes of this collection cycle """
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.can_search(exact_match)\
+                and (snapshot.refreshed_ad_cache or not refresh_ad_cache):
+            return snapshot
+
+        exact_strings, cmdline_strings = self._get_search_strings()
+        if exact_match:
+            exact_strings = (exact_strings or set()).union(search_string)
+        else:
+            cmdline_strings = (cmdline_strings or set()).union(search_string)
+
+        # Skip access denied processes
+        skip_pids = self.ad_cache if not refresh_ad_cache else set()
+        snapshot = ProcessSnapshot(exact_strings, cmdline_strings, skip_pids, self.log)
+        snapshot.refreshed_ad_cache = refresh_ad_cache
+        if refresh_ad_cache:
+            self.ad_cache = snapshot.denied_pids[True] | snapshot.denied_pids[False]
+
+        # Forget the processes that are gone
+        for pid in set(self.process_cache) - snapshot.pids:
+            del self.process_cache[pid]
+        for pid in set(self._cpu_samples) - snapshot.pids:
+            del self._cpu_samples[pid]
+
+        self._snapshot = snapshot
+        return snapshot
+
     def find_pids(self, name, search_string, exact_match, ignore_ad=True):
         """
         Create a set of pids of selected processes.
@@ -85,42 +223,16 @@ class ProcessCheck(AgentCheck):
             ad_error_logger = self.log.error
 
         refresh_ad_cache = self.should_refresh_ad_cache(name)
+        snapshot = self.get_process_snapshot(search_string, exact_match, refresh_ad_cache)
 
-        matching_pids = set()
+        for pid in snapshot.denied_pids[exact_match]:
+            ad_error_logger('Access denied to process with PID %s', pid)
+            if not ignore_ad:
+                raise psutil.AccessDenied(pid)
 
-        for proc in psutil.process_iter():
-            # Skip access denied processes
-            if not refresh_ad_cache and proc.pid in self.ad_cache:
-                continue
-
-            found = False
-            for string in search_string:
-                try:
-                    # FIXME 6.x: All has been deprecated from the doc, should be removed
-                    if string == 'All':
-                        found = True
-                    if exact_match:
-                        if proc.name() == string:
-                            found = True
-                    else:
-                        cmdline = proc.cmdline()
-                        if string in ' '.join(cmdline):
-                            found = True
-                except psutil.NoSuchProcess:
-                    self.log.warning('Process disappeared while scanning')
-                except psutil.AccessDenied, e:
-                    ad_error_logger('Access denied to process with PID %s', proc.pid)
-                    ad_error_logger('Error: %s', e)
-                    if refresh_ad_cache:
-                        self.ad_cache.add(proc.pid)
-                    if not ignore_ad:
-                        raise
-                else:
-                    if refresh_ad_cache:
-                        self.ad_cache.discard(proc.pid)
-                    if found:
-                        matching_pids.add(proc.pid)
-                        break
+        matching_pids = set()
+        for string in search_string:
+            matching_pids.update(snapshot.find(string, exact_match))
 
         self.pid_cache[name] = matching_pids
         self.last_pid_cache_ts[name] = time.time()
@@ -168,64 +280,121 @@ class ProcessCheck(AgentCheck):
 
         return result
 
-    def get_process_state(self, name, pids):
-        st = defaultdict(list)
-
-        # Remove from cache the processes that are not in `pids`
-        cached_pids = set(self.process_cache[name].keys())
-        pids_to_remove = cached_pids - pids
-        for pid in pids_to_remove:
-            del self.process_cache[name][pid]
-
-        for pid in pids:
-            st['pids'].append(pid)
-
-            new_process = False
-            # If the pid's process is not cached, retrieve it
-            if pid not in self.process_cache[name] or not self.process_cache[name][pid].is_running():
-                new_process = True
-                try:
-                    self.process_cache[name][pid] = psutil.Process(pid)
-                    self.log.debug('New process in cache: %s' % pid)
-                # Skip processes dead in the meantime
-                except psutil.NoSuchProcess:
-                    self.warning('Process %s disappeared while scanning' % pid)
-                    # reset the PID cache now, something changed
-                    self.last_pid_cache_ts[name] = 0
-                    continue
-
-            p = self.process_cache[name][pid]
+    def get_process_stats(self, pid):
+        """
+        Returns the stats of the process `pid`, read once per collection cycle,
+        or None if it's gone
+        """
+        if pid in self._process_stats:
+            return self._process_stats[pid]
+
+        stats = None
+        if self._use_procfs:
+            stats = self._read_procfs_stats(pid)
+            if stats is not None:
+                self._process_stats[pid] = stats
+                return stats
+
+        new_process = False
+        # If the pid's process is not cached, retrieve it
+        if pid not in self.process_cache or not self.process_cache[pid].is_running():
+            new_process = True
+            try:
+                self.process_cache[pid] = psutil.Process(pid)
+                self.log.debug('New process in cache: %s' % pid)
+            # Skip processes dead in the meantime
+            except psutil.NoSuchProcess:
+                self.warning('Process %s disappeared while scanning' % pid)
+                self.process_cache.pop(pid, None)
+
+        if pid in self.process_cache:
+            p = self.process_cache[pid]
+            stats = {}
 
             meminfo = self.psutil_wrapper(p, 'memory_info', ['rss', 'vms'])
-            st['rss'].append(meminfo.get('rss'))
-            st['vms'].append(meminfo.get('vms'))
+            stats['rss'] = meminfo.get('rss')
+            stats['vms'] = meminfo.get('vms')
 
             # will fail on win32 and solaris
             shared_mem = self.psutil_wrapper(p, 'memory_info_ex', ['shared']).get('shared')
             if shared_mem is not None and meminfo.get('rss') is not None:
-                st['real'].append(meminfo['rss'] - shared_mem)
-            else:
-                st['real'].append(None)
+                stats['real'] = meminfo['rss'] - shared_mem
 
             ctxinfo = self.psutil_wrapper(p, 'num_ctx_switches', ['voluntary', 'involuntary'])
-            st['ctx_swtch_vol'].append(ctxinfo.get('voluntary'))
-            st['ctx_swtch_invol'].append(ctxinfo.get('involuntary'))
+            stats['ctx_swtch_vol'] = ctxinfo.get('voluntary')
+            stats['ctx_swtch_invol'] = ctxinfo.get('involuntary')
 
-            st['thr'].append(self.psutil_wrapper(p, 'num_threads', None))
+            stats['thr'] = self.psutil_wrapper(p, 'num_threads', None)
 
             cpu_percent = self.psutil_wrapper(p, 'cpu_percent', None)
             if not new_process:
                 # psutil returns `0.` for `cpu_percent` the first time it's sampled on a process,
                 # so save the value only on non-new processes
-                st['cpu'].append(cpu_percent)
+                stats['cpu'] = cpu_percent
 
-            st['open_fd'].append(self.psutil_wrapper(p, 'num_fds', None))
+            stats['open_fd'] = self.psutil_wrapper(p, 'num_fds', None)
 
             ioinfo = self.psutil_wrapper(p, 'io_counters', ['read_count', 'write_count', 'read_bytes', 'write_bytes'])
-            st['r_count'].append(ioinfo.get('read_count'))
-            st['w_count'].append(ioinfo.get('write_count'))
-            st['r_bytes'].append(ioinfo.get('read_bytes'))
-            st['w_bytes'].append(ioinfo.get('write_bytes'))
+            stats['r_count'] = ioinfo.get('read_count')
+            stats['w_count'] = ioinfo.get('write_count')
+            stats['r_bytes'] = ioinfo.get('read_bytes')
+            stats['w_bytes'] = ioinfo.get('write_bytes')
+
+        self._process_stats[pid] = stats
+        return stats
+
+    def _read_procfs_stats(self, pid):
+        """ Returns the stats of the process `pid` read from /proc, or None if it can't be read """
+        try:
+            proc_stats = read_process_stats(pid)
+        except (IOError, OSError, ValueError, IndexError):
+            # Gone or unreadable, psutil tells which
+            return None
+
+        now = time.time()
+        last_sample = self._cpu_samples.get(pid)
+        self._cpu_samples[pid] = (proc_stats.starttime, proc_stats.cpu_time, now)
+
+        stats = {
+            'rss': proc_stats.rss,
+            'vms': proc_stats.vms,
+            'ctx_swtch_vol': proc_stats.ctx_switches_vol,
+            'ctx_swtch_invol': proc_stats.ctx_switches_invol,
+            'thr': proc_stats.threads,
+            'open_fd': proc_stats.open_fds,
+            'r_count': proc_stats.read_count,
+            'w_count': proc_stats.write_count,
+            'r_bytes': proc_stats.read_bytes,
+            'w_bytes': proc_stats.write_bytes,
+        }
+        if proc_stats.rss is not None and proc_stats.shared is not None:
+            stats['real'] = proc_stats.rss - proc_stats.shared
+
+        # Same as psutil's `cpu_percent`, only for processes sampled before: the PID
+        # may have been reused by another process, which has another start time
+        if last_sample is not None and last_sample[0] == proc_stats.starttime:
+            elapsed = now - last_sample[2]
+            stats['cpu'] = 0.0
+            if elapsed > 0:
+                stats['cpu'] = (proc_stats.cpu_time - last_sample[1]) / elapsed * 100
+
+        return stats
+
+    def get_process_state(self, name, pids):
+        st = defaultdict(list)
+
+        for pid in pids:
+            st['pids'].append(pid)
+
+            stats = self.get_process_stats(pid)
+            if stats is None:
+                # reset the PID cache now, something changed
+                self.last_pid_cache_ts[name] = 0
+                continue
+
+            for attr in ATTR_TO_METRIC:
+                if attr in stats:
+                    st[attr].append(stats[attr])
 
         return st
 
@@ -251,6 +420,11 @@ class ProcessCheck(AgentCheck):
         if search_string is None:
             raise KeyError('The "search_string" is mandatory')
 
+        # An instance that already ran in this cycle starts the next one
+        if name in self._cycle_names:
+            self._start_cycle()
+        self._cycle_names.add(name)
+
         pids = self.find_pids(
             name,
             search_string,
@@ -261,7 +435,7 @@ class ProcessCheck(AgentCheck):
         proc_state = self.get_process_state(name, pids)
 
         # FIXME 6.x remove the `name` tag
-        tags.extend(['process_name:%s' % name, name])
+        tags = tags + ['process_name:%s' % name, name]
 
         self.log.debug('ProcessCheck: process %s analysed', name)
         self.gauge('system.processes.number', len(pids), tags=tags)
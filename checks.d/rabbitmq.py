@@ -124,7 +124,7 @@ class RabbitMQ(AgentCheck):
 
         for object_type, filters in specified.iteritems():
             for filter_type, filter_objects in filters.iteritems():
-                if type(filter_objects) != list:
+                if not isinstance(filter_objects, list):
                     raise TypeError(
                         "{0} / {0}_regexes parameter must be a list".format(object_type))
 
@@ -5,7 +5,7 @@ The Check class is being deprecated so don't write new checks with it.
 """
 # stdlib
 from collections import defaultdict
-import copy
+import gc
 import logging
 import numbers
 import os
@@ -25,6 +25,7 @@ import yaml
 # project
 from checks import check_status
 from util import get_hostname, get_next_id, LaconicFilter, yLoader
+from utils.frozen import freeze, is_mutated
 from utils.platform import Platform
 from utils.profile import pretty_statistics
 if Platform.is_windows():
@@ -161,7 +162,7 @@ class Check(object):
 
         # Sort and validate tags
         if tags is not None:
-            if type(tags) not in [type([]), type(())]:
+            if not isinstance(tags, (list, tuple)):
                 raise CheckException("Tags must be a list or tuple of strings")
             else:
                 tags = tuple(sorted(tags))
@@ -329,12 +330,17 @@ class AgentCheck(object):
             formatter=agent_formatter,
             recent_point_threshold=agentConfig.get('recent_point_threshold', None),
             histogram_aggregates=agentConfig.get('histogram_aggregates'),
-            histogram_percentiles=agentConfig.get('histogram_percentiles')
+            histogram_percentiles=agentConfig.get('histogram_percentiles'),
+            histogram_backend=agentConfig.get('histogram_backend'),
+            histogram_sketch_prefixes=agentConfig.get('histogram_sketch_prefixes'),
+            histogram_sketch_accuracy=agentConfig.get('histogram_sketch_accuracy')
         )
 
         self.events = []
         self.service_checks = []
         self.instances = instances or []
+        self._frozen_instances = {}
+        self._instance_copies = 0
         self.warnings = []
         self.library_versions = None
         self.last_collection_time = defaultdict(int)
@@ -712,28 +718,28 @@ class AgentCheck(object):
         self._internal_profiling_stats = None
         return stats
 
-    def run(self):
-        """ Run all instances. """
+    def run(self, instance_ids=None):
+        """ Run all instances, or the instances of `instance_ids` when they are scheduled
+        by the collector, regardless of their `min_collection_interval`. """
 
         # Store run statistics if needed
         before, after = None, None
+        self._instance_copies = 0
         if self.in_developer_mode and self.name != AGENT_METRICS_CHECK_NAME:
             try:
                 before = AgentCheck._collect_internal_stats()
+                before['gc_objects'] = len(gc.get_objects())
             except Exception:  # It's fine if we can't collect stats for the run, just log and proceed
                 self.log.debug("Failed to collect Agent Stats before check {0}".format(self.name))
 
         instance_statuses = []
         for i, instance in enumerate(self.instances):
+            if instance_ids is not None and i not in instance_ids:
+                continue
             try:
-                min_collection_interval = instance.get(
-                    'min_collection_interval', self.init_config.get(
-                        'min_collection_interval',
-                        self.DEFAULT_MIN_COLLECTION_INTERVAL
-                    )
-                )
+                min_collection_interval = self.get_min_collection_interval(i)
                 now = time.time()
-                if now - self.last_collection_time[i] < min_collection_interval:
+                if instance_ids is None and now - self.last_collection_time[i] < min_collection_interval:
                     self.log.debug("Not running instance #{0} of check {1} as it ran less than {2}s ago".format(i, self.name, min_collection_interval))
                     continue
 
@@ -742,7 +748,7 @@ class AgentCheck(object):
                 check_start_time = None
                 if self.in_developer_mode:
                     check_start_time = timeit.default_timer()
-                self.check(copy.deepcopy(instance))
+                self.check(self._get_frozen_instance(i))
 
                 instance_check_stats = None
                 if check_start_time is not None:
@@ -772,6 +778,8 @@ class AgentCheck(object):
         if self.in_developer_mode and self.name != AGENT_METRICS_CHECK_NAME:
             try:
                 after = AgentCheck._collect_internal_stats()
+                after['gc_objects'] = len(gc.get_objects())
+                after['instance_copies'] = self._instance_copies
                 self._set_internal_profiling_stats(before, after)
                 log.info("\n \t %s %s" % (self.name, pretty_statistics(self._internal_profiling_stats)))
             except Exception:  # It's fine if we can't collect stats for the run, just log and proceed
@@ -779,6 +787,30 @@ class AgentCheck(object):
 
         return instance_statuses
 
+    def _get_frozen_instance(self, instance_id):
+        """
+        Return the copy of the instance that is passed to `check`, frozen on the
+        first run and shared by the next ones. Checks which write to their instance
+        get a new copy on the next run, so that it never sees the previous changes.
+        """
+        instance = self.instances[instance_id]
+        loaded, frozen = self._frozen_instances.get(instance_id, (None, None))
+        if loaded is not instance or is_mutated(frozen):
+            if loaded is instance:
+                self.log.debug("Check {0} updated instance #{1}, copying it".format(self.name, instance_id))
+            frozen = freeze(instance)
+            self._frozen_instances[instance_id] = (instance, frozen)
+            self._instance_copies += 1
+        return frozen
+
+    def get_min_collection_interval(self, instance_id):
+        return self.instances[instance_id].get(
+            'min_collection_interval', self.init_config.get(
+                'min_collection_interval',
+                self.DEFAULT_MIN_COLLECTION_INTERVAL
+            )
+        )
+
     def check(self, instance):
         """
         Overriden by the check class. This will be called to run the check.
@@ -295,7 +295,7 @@ class CheckStatus(object):
                  event_count=None, service_check_count=None, service_metadata=[],
                  init_failed_error=None, init_failed_traceback=None,
                  library_versions=None, source_type_name=None,
-                 check_stats=None):
+                 check_stats=None, timed_out=False):
         self.name = check_name
         self.source_type_name = source_type_name
         self.instance_statuses = instance_statuses
@@ -307,10 +307,15 @@ class CheckStatus(object):
         self.library_versions = library_versions
         self.check_stats = check_stats
         self.service_metadata = service_metadata
+        self.timed_out = timed_out
+        # Seconds the check ran, waited for a check runner, and started after it was due
+        self.run_time = None
+        self.queue_time = None
+        self.schedule_lag = None
 
     @property
     def status(self):
-        if self.init_failed_error:
+        if self.init_failed_error or self.timed_out:
             return STATUS_ERROR
         for instance_status in self.instance_statuses:
             if instance_status.status == STATUS_ERROR:
@@ -344,11 +349,22 @@ class CollectorStatus(AgentStatus):
 
     NAME = 'Collector'
 
-    def __init__(self, check_statuses=None, emitter_statuses=None, metadata=None):
+    STARTUP_PHASES = {
+        'parse_configs': 'Parse check configurations',
+        'import_checks': 'Import and initialize checks',
+        'first_run': 'First collection run',
+    }
+
+    def __init__(self, check_statuses=None, emitter_statuses=None, metadata=None, startup_phases=None,
+                 reload_counts=None):
         AgentStatus.__init__(self)
         self.check_statuses = check_statuses or []
         self.emitter_statuses = emitter_statuses or []
         self.host_metadata = metadata or []
+        # (phase, duration) of the last load of the checks
+        self.startup_phases = startup_phases or []
+        # Number of checks initialized again, and kept, by the last reload
+        self.reload_counts = reload_counts
 
     @property
     def status(self):
@@ -374,6 +390,10 @@ class CollectorStatus(AgentStatus):
                 check_lines.extend('      ' + line for line in
                                    cs.init_failed_traceback.split('\n'))
         else:
+            if getattr(cs, 'timed_out', False):
+                check_lines.append("    - run [%s]: timed out, its results were skipped" %
+                                   style(STATUS_ERROR, 'red'))
+
             for s in cs.instance_statuses:
                 c = 'green'
                 if s.has_warnings():
@@ -416,6 +436,14 @@ class CollectorStatus(AgentStatus):
                     "    - Stats: %s" % pretty_statistics(cs.check_stats)
                 ]
 
+            if getattr(cs, 'run_time', None) is not None:
+                line = "    - Run time: %.2fs" % cs.run_time
+                if cs.queue_time:
+                    line += ", waited %.2fs for a check runner" % cs.queue_time
+                if getattr(cs, 'schedule_lag', None):
+                    line += ", started %.2fs after it was due" % cs.schedule_lag
+                check_lines.append(line)
+
             if cs.library_versions is not None:
                 check_lines += [
                     "    - Dependencies:"]
@@ -478,6 +506,22 @@ class CollectorStatus(AgentStatus):
         lines.append('  checks.d: ' + checksd_path)
         lines.append('')
 
+        # Time spent loading the checks
+        startup_phases = getattr(self, 'startup_phases', None)
+        if startup_phases:
+            lines += [
+                'Startup',
+                '=======',
+                ''
+            ]
+            for phase, duration in startup_phases:
+                lines.append('  %s: %.2fs' % (self.STARTUP_PHASES.get(phase, phase), duration))
+            reload_counts = getattr(self, 'reload_counts', None)
+            if reload_counts:
+                lines.append('  Last reload: %s check%s reloaded, %s kept' % (
+                    reload_counts['reloaded'], plural(reload_counts['reloaded']), reload_counts['kept']))
+            lines.append('')
+
         # Hostnames
         lines += [
             'Hostnames',
@@ -646,6 +690,12 @@ class CollectorStatus(AgentStatus):
                         status_info['hostnames'][key] = host
                         break
 
+        status_info['startup'] = [
+            {'phase': phase, 'duration': duration}
+            for phase, duration in getattr(self, 'startup_phases', None) or []
+        ]
+        status_info['reload_counts'] = getattr(self, 'reload_counts', None)
+
         # Checks.d Status
         status_info['checks'] = {}
         check_statuses = self.check_statuses + get_jmx_status()
@@ -716,7 +766,12 @@ class DogstatsdStatus(AgentStatus):
     NAME = 'Dogstatsd'
 
     def __init__(self, flush_count=0, packet_count=0, packets_per_second=0,
-            metric_count=0, event_count=0, service_check_count=0):
+            metric_count=0, event_count=0, service_check_count=0,
+            packets_dropped=0, queue_depth=0, queue_size=0, shards=None,
+            shard_late_flushes=0, shard_lost_flushes=0, tags_cache=None,
+            swap_duration=0, serialization_duration=0,
+            submit_duration=0, payloads_sent=0, payloads_failed=0,
+            payloads_dropped=0, retry_queue_length=0, post_latency=0):
         AgentStatus.__init__(self)
         self.flush_count = flush_count
         self.packet_count = packet_count
@@ -724,6 +779,21 @@ class DogstatsdStatus(AgentStatus):
         self.metric_count = metric_count
         self.event_count = event_count
         self.service_check_count = service_check_count
+        self.packets_dropped = packets_dropped
+        self.queue_depth = queue_depth
+        self.queue_size = queue_size
+        self.shards = shards or []
+        self.shard_late_flushes = shard_late_flushes
+        self.shard_lost_flushes = shard_lost_flushes
+        self.tags_cache = tags_cache or {}
+        self.swap_duration = swap_duration
+        self.serialization_duration = serialization_duration
+        self.submit_duration = submit_duration
+        self.payloads_sent = payloads_sent
+        self.payloads_failed = payloads_failed
+        self.payloads_dropped = payloads_dropped
+        self.retry_queue_length = retry_queue_length
+        self.post_latency = post_latency
 
     def has_error(self):
         return self.flush_count == 0 and self.packet_count == 0 and self.metric_count == 0
@@ -736,7 +806,35 @@ class DogstatsdStatus(AgentStatus):
             "Metric count: %s" % self.metric_count,
             "Event count: %s" % self.event_count,
             "Service check count: %s" % self.service_check_count,
+            "Last flush: submitted in %.2fms, swap %.2fms, serialization %.2fms" % (
+                self.submit_duration * 1000, self.swap_duration * 1000,
+                self.serialization_duration * 1000),
+            "Payloads: %s sent, %s failed, %s dropped, %s waiting for retry" % (
+                self.payloads_sent, self.payloads_failed, self.payloads_dropped,
+                self.retry_queue_length),
+            "Average post latency: %.2fms" % (self.post_latency * 1000),
         ]
+        if self.queue_size:
+            lines += [
+                "Receive queue depth: %s/%s" % (self.queue_depth, self.queue_size),
+                "Packets dropped: %s" % self.packets_dropped,
+            ]
+        if self.tags_cache:
+            lines.append("Tags cache: %s entries, %s hits, %s misses, %s evictions" % (
+                self.tags_cache['size'], self.tags_cache['hits'],
+                self.tags_cache['misses'], self.tags_cache['evictions']))
+            if 'normalized_size' in self.tags_cache:
+                lines.append("Tags sequences cache: %s entries, %s hits, %s misses, %s evictions" % (
+                    self.tags_cache['normalized_size'], self.tags_cache['normalized_hits'],
+                    self.tags_cache['normalized_misses'], self.tags_cache['normalized_evictions']))
+        if self.shards:
+            lines += ["", "Shards: %s" % len(self.shards),
+                      "Shard flushes: %s answered late, %s lost" % (
+                          self.shard_late_flushes, self.shard_lost_flushes)]
+            for shard in self.shards:
+                lines.append("  Shard %s: %s packets/s, %s forwarded/s, %s metrics" % (
+                    shard['shard'], shard['packets_per_second'],
+                    shard['forwarded_per_second'], shard['metric_count']))
         return lines
 
     def to_dict(self):
@@ -748,6 +846,21 @@ class DogstatsdStatus(AgentStatus):
             'metric_count': self.metric_count,
             'event_count': self.event_count,
             'service_check_count': self.service_check_count,
+            'packets_dropped': self.packets_dropped,
+            'queue_depth': self.queue_depth,
+            'queue_size': self.queue_size,
+            'shards': self.shards,
+            'shard_late_flushes': self.shard_late_flushes,
+            'shard_lost_flushes': self.shard_lost_flushes,
+            'tags_cache': self.tags_cache,
+            'swap_duration': self.swap_duration,
+            'serialization_duration': self.serialization_duration,
+            'submit_duration': self.submit_duration,
+            'payloads_sent': self.payloads_sent,
+            'payloads_failed': self.payloads_failed,
+            'payloads_dropped': self.payloads_dropped,
+            'retry_queue_length': self.retry_queue_length,
+            'post_latency': self.post_latency,
         })
         return status_info
 
@@ -757,13 +870,26 @@ class ForwarderStatus(AgentStatus):
     NAME = 'Forwarder'
 
     def __init__(self, queue_length=0, queue_size=0, flush_count=0, transactions_received=0,
-            transactions_flushed=0):
+            transactions_flushed=0, transactions_spilled=0, transactions_replayed=0,
+            transactions_dropped=0, spill_queue_length=0, spill_queue_size=0,
+            in_flight_limit=0, throttling_delay=0, endpoints=None, payloads_received=0,
+            emitters=None):
         AgentStatus.__init__(self)
         self.queue_length = queue_length
         self.queue_size = queue_size
         self.flush_count = flush_count
         self.transactions_received = transactions_received
+        self.payloads_received = payloads_received
         self.transactions_flushed = transactions_flushed
+        self.transactions_spilled = transactions_spilled
+        self.transactions_replayed = transactions_replayed
+        self.transactions_dropped = transactions_dropped
+        self.spill_queue_length = spill_queue_length
+        self.spill_queue_size = spill_queue_size
+        self.in_flight_limit = in_flight_limit
+        self.throttling_delay = throttling_delay
+        self.endpoints = endpoints or {}
+        self.emitters = emitters or {}
         self.proxy_data = get_config(parse_args=False).get('proxy_settings')
         self.hidden_username = None
         self.hidden_password = None
@@ -779,10 +905,44 @@ class ForwarderStatus(AgentStatus):
             "Queue Length: %s" % self.queue_length,
             "Flush Count: %s" % self.flush_count,
             "Transactions received: %s" % self.transactions_received,
+            "Payloads received: %s (%s)" % (self.payloads_received, self.coalescing_ratio()),
             "Transactions flushed: %s" % self.transactions_flushed,
+            "Transactions dropped: %s" % self.transactions_dropped,
             ""
         ]
 
+        if self.transactions_spilled:
+            lines += [
+                "Spill Queue Size: %s bytes" % self.spill_queue_size,
+                "Spill Queue Length: %s" % self.spill_queue_length,
+                "Transactions spilled: %s" % self.transactions_spilled,
+                "Transactions replayed: %s" % self.transactions_replayed,
+                ""
+            ]
+
+        if self.endpoints:
+            lines += [
+                "In-flight limit: %s" % self.in_flight_limit,
+                "Throttling delay: %ss" % self.throttling_delay,
+            ]
+            for endpoint, stats in sorted(self.endpoints.iteritems()):
+                latency = stats['latency']
+                lines.append(
+                    "  %s: %s in flight, %s request(s), %s error(s), latency %s" %
+                    (endpoint, stats['in_flight'], stats['requests'], stats['errors'],
+                     "%.0fms" % (latency * 1000) if latency is not None else "n/a"))
+            lines.append("")
+
+        if self.emitters:
+            lines.append("Custom emitters:")
+            for name, stats in sorted(self.emitters.iteritems()):
+                latency = stats['latency']
+                lines.append(
+                    "  %s: %s queued, %s processed, %s dropped, latency %s" %
+                    (name, stats['queue_length'], stats['processed'], stats['dropped'],
+                     "%.0fms" % (latency * 1000) if latency is not None else "n/a"))
+            lines.append("")
+
         if self.proxy_data:
             lines += [
                 "Proxy",
@@ -802,12 +962,29 @@ class ForwarderStatus(AgentStatus):
     def has_error(self):
         return self.flush_count == 0
 
+    def coalescing_ratio(self):
+        # Payloads merged into each transaction, on average
+        if not self.transactions_received:
+            return "n/a"
+        return "%.1f per transaction" % (float(self.payloads_received) / self.transactions_received)
+
     def to_dict(self):
         status_info = AgentStatus.to_dict(self)
         status_info.update({
             'flush_count': self.flush_count,
             'queue_length': self.queue_length,
             'queue_size': self.queue_size,
+            'transactions_received': self.transactions_received,
+            'payloads_received': self.payloads_received,
+            'transactions_dropped': self.transactions_dropped,
+            'transactions_spilled': self.transactions_spilled,
+            'transactions_replayed': self.transactions_replayed,
+            'spill_queue_length': self.spill_queue_length,
+            'spill_queue_size': self.spill_queue_size,
+            'in_flight_limit': self.in_flight_limit,
+            'throttling_delay': self.throttling_delay,
+            'endpoints': self.endpoints,
+            'emitters': self.emitters,
             'proxy_data': self.proxy_data,
             'hidden_username': self.hidden_username,
             'hidden_password': self.hidden_password,
@@ -1,10 +1,16 @@
 # stdlib
 import collections
+import heapq
 import logging
+import math
 import pprint
+from Queue import Queue
 import socket
 import sys
+import threading
 import time
+import traceback
+from zlib import crc32
 
 # project
 from checks import AGENT_METRICS_CHECK_NAME, AgentCheck, create_service_check
@@ -17,7 +23,7 @@ from checks.check_status import (
 )
 from checks.datadog import DdForwarder, Dogstreams
 from checks.ganglia import Ganglia
-from config import get_system_stats, get_version
+from config import DEFAULT_CHECK_FREQUENCY, DeferredCheck, get_system_stats, get_version
 from resources.processes import Processes as ResProcesses
 import checks.system.unix as u
 import checks.system.win32 as w32
@@ -41,6 +47,12 @@ log = logging.getLogger(__name__)
 FLUSH_LOGGING_PERIOD = 10
 FLUSH_LOGGING_INITIAL = 5
 DD_CHECK_TAG = 'dd_check:{0}'
+# Seconds a check run by the check runners gets before its results are skipped
+DEFAULT_CHECK_TIMEOUT = 60
+# Seconds between two looks at the checks waiting for a check runner
+CHECK_POLL_INTERVAL = 1
+# Scheduled check instances are run when due within this many seconds
+SCHEDULE_TOLERANCE = 1
 
 
 class AgentPayload(collections.MutableMapping):
@@ -145,6 +157,238 @@ class AgentPayload(collections.MutableMapping):
         return statuses
 
 
+class CheckRun(object):
+    """
+    A run of a checks.d check, and what it collected.
+
+    A run that timed out is reported without any result, even if the check
+    completes later on.
+    """
+
+    def __init__(self, check, timeout=None, instance_ids=None, scheduled=None):
+        self.check = check
+        self.timeout = timeout
+        # Instances to run, all of them by default, and when they were due
+        self.instance_ids = instance_ids
+        self.scheduled = scheduled
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.timed_out = False
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+        self.status = None
+        self.metrics = []
+        self.events = []
+        self.service_checks = []
+
+    def execute(self):
+        with self.lock:
+            if self.timed_out:
+                # Timed out while waiting for a check runner
+                return
+            self.started = time.time()
+        results = None
+        try:
+            results = self._run()
+        finally:
+            with self.lock:
+                self.finished = time.time()
+                if results is not None and not self.timed_out:
+                    self.status, self.metrics, self.events, self.service_checks = results
+            self.done.set()
+
+    def _run(self):
+        check = self.check
+        log.info("Running check %s" % check.name)
+        instance_statuses = []
+        current_check_metrics = []
+        current_check_events = []
+        current_check_metadata = []
+        check_stats = None
+
+        try:
+            # Run the check.
+            if self.instance_ids is None:
+                instance_statuses = check.run()
+            else:
+                instance_statuses = check.run(self.instance_ids)
+
+            # Collect the metrics and events.
+            current_check_metrics = check.get_metrics()
+            current_check_events = check.get_events()
+            check_stats = check._get_internal_profiling_stats()
+
+            # Collect metadata
+            current_check_metadata = check.get_service_metadata()
+
+        except Exception:
+            log.exception("Error running check %s" % check.name)
+
+        check_status = CheckStatus(
+            check.name, instance_statuses, len(current_check_metrics),
+            len(current_check_events), service_metadata=current_check_metadata,
+            library_versions=check.get_library_info(),
+            source_type_name=check.SOURCE_TYPE_NAME or check.name,
+            check_stats=check_stats
+        )
+
+        # Service check for Agent checks failures
+        service_check_tags = ["check:%s" % check.name]
+        if check_status.status == STATUS_OK:
+            status = AgentCheck.OK
+        elif check_status.status == STATUS_ERROR:
+            status = AgentCheck.CRITICAL
+        check.service_check('datadog.agent.check_status', status, tags=service_check_tags)
+
+        # Collect the service checks and save them in the payload
+        current_check_service_checks = check.get_service_checks()
+
+        # Update the check status with the correct service_check_count
+        check_status.service_check_count = len(current_check_service_checks)
+
+        return check_status, current_check_metrics, current_check_events, current_check_service_checks
+
+    def time_out(self, hostname, message, queued=False):
+        """
+        Skip the results of the run. Returns False if it completed in the
+        meantime, or if it started while `queued` is expected.
+        """
+        with self.lock:
+            if self.done.is_set() or (queued and self.started is not None):
+                return False
+            self.timed_out = True
+
+        check = self.check
+        log.warning(message)
+
+        self.status = CheckStatus(check.name, [], timed_out=True,
+                                  source_type_name=check.SOURCE_TYPE_NAME or check.name)
+        self.service_checks = [
+            create_service_check('datadog.agent.check_status', AgentCheck.CRITICAL,
+                                 tags=["check:%s" % check.name], hostname=hostname, message=message)
+        ]
+        return True
+
+    def is_over(self):
+        return self.timed_out or self.done.is_set()
+
+    def get_run_time(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def get_queue_time(self):
+        if self.started is None:
+            return None
+        return self.started - self.submitted
+
+    def get_schedule_lag(self):
+        if self.started is None or self.scheduled is None:
+            return None
+        return max(0, self.started - self.scheduled)
+
+
+class CheckScheduler(object):
+    """
+    Schedules each instance of the checks.d checks on its own interval: its
+    `min_collection_interval`, rounded up to a number of `tick`s of the
+    collector loop.
+
+    Instances first run right away, then at the wall-clock multiples of their
+    interval, shifted by a number of ticks derived from their name, so that
+    instances with the same interval don't all run on the same tick.
+    """
+
+    def __init__(self, tick):
+        self.tick = tick
+        self._checks = []
+        # (next run, check index, instance id)
+        self._heap = []
+
+    def sync(self, checks, now=None):
+        """ Schedule `checks`, keeping the schedule of the ones already scheduled """
+        if [id(c) for c in checks] == [id(c) for c in self._checks]:
+            return
+
+        next_runs = {}
+        for next_run, check_index, instance_id in self._heap:
+            next_runs[(id(self._checks[check_index]), instance_id)] = next_run
+
+        now = now or time.time()
+        self._checks = list(checks)
+        self._heap = []
+        for check_index, check in enumerate(self._checks):
+            for instance_id in xrange(len(check.instances)):
+                next_run = next_runs.get((id(check), instance_id), now)
+                self._heap.append((next_run, check_index, instance_id))
+        heapq.heapify(self._heap)
+
+    def _get_interval_ticks(self, check, instance_id):
+        try:
+            interval = float(check.get_min_collection_interval(instance_id))
+        except Exception:
+            interval = 0
+        return max(1, int(math.ceil(interval / self.tick)))
+
+    def _get_next_run(self, check, instance_id, now):
+        ticks = self._get_interval_ticks(check, instance_id)
+        interval = ticks * self.tick
+        offset = (crc32('%s:%s' % (check.name, instance_id)) % ticks) * self.tick
+        # Next multiple of the interval, shifted by the offset, after this run
+        return (math.floor((now + SCHEDULE_TOLERANCE - offset) / interval) + 1) * interval + offset
+
+    def pop_due(self, now):
+        """
+        Returns the (check, instance ids, due time) to run now, in the order of
+        the checks, and schedules their next run.
+        """
+        due = {}
+        while self._heap and self._heap[0][0] <= now + SCHEDULE_TOLERANCE:
+            scheduled, check_index, instance_id = heapq.heappop(self._heap)
+            check = self._checks[check_index]
+            instance_ids, first_scheduled = due.get(check_index, ([], scheduled))
+            instance_ids.append(instance_id)
+            due[check_index] = (instance_ids, min(first_scheduled, scheduled))
+
+            next_run = self._get_next_run(check, instance_id, now)
+            heapq.heappush(self._heap, (next_run, check_index, instance_id))
+
+        return [(self._checks[i], sorted(due[i][0]), due[i][1]) for i in sorted(due)]
+
+    def get_next_run(self):
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+
+class CheckRunner(object):
+    """
+    Pool of threads running checks concurrently. Threads are daemons, so that
+    a hung check doesn't prevent the agent from stopping.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._queue = Queue()
+        for i in xrange(size):
+            thread = threading.Thread(target=self._work, name="CheckRunner-%d" % i)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            check_run = self._queue.get()
+            try:
+                check_run.execute()
+            except Exception:
+                log.exception("Error running check %s" % check_run.check.name)
+
+    def submit(self, check_run):
+        self._queue.put(check_run)
+
+
 class Collector(object):
     """
     The collector is responsible for collecting data from each check and
@@ -161,6 +405,18 @@ class Collector(object):
         self.plugins = None
         self.emitters = emitters
         self.check_timings = agentConfig.get('check_timings')
+        # Checks are run concurrently by `check_runners` threads, in sequence by default
+        self._check_runner = None
+        self._check_timeout = float(agentConfig.get('check_timeout') or DEFAULT_CHECK_TIMEOUT)
+        check_runners = int(agentConfig.get('check_runners') or 1)
+        if check_runners > 1:
+            log.info("Running checks with %s check runners" % check_runners)
+            self._check_runner = CheckRunner(check_runners)
+        # Runs still going on past their timeout, that hold a check runner
+        self._late_check_runs = []
+        # Scheduled collections only run the check instances that are due
+        self._scheduler = CheckScheduler(int(agentConfig.get('check_freq') or DEFAULT_CHECK_FREQUENCY))
+        self._last_check_statuses = {}
         self.push_times = {
             'host_metadata': {
                 'start': time.time(),
@@ -181,6 +437,11 @@ class Collector(object):
         self.hostname_metadata_cache = None
         self.initialized_checks_d = []
         self.init_failed_checks_d = {}
+        # Time spent in the phases of the last load of checks.d, until its first collection run
+        self._loaded_checksd = None
+        self._startup_phases = []
+        # Number of checks initialized again, and kept, by the last reload
+        self._reload_counts = None
 
         # Unix System Checks
         self._unix_system_checks = {
@@ -242,14 +503,47 @@ class Collector(object):
         for check in self.initialized_checks_d:
             check.stop()
 
+    def _stop_replaced_checks(self, checksd):
+        """ Stop the checks that a reload of checks.d removed or initialized again """
+        kept_checks = set(id(check) for check in checksd['initialized_checks'])
+        for check in self.initialized_checks_d:
+            if id(check) not in kept_checks:
+                try:
+                    check.stop()
+                except Exception:
+                    log.exception("Unable to stop check %s" % check.name)
+
+    def _load_deferred_checks(self, checksd):
+        """ Import and initialize the checks.d checks deferred by `load_check_directory` """
+        checks = checksd['initialized_checks']
+        if not any(isinstance(check, DeferredCheck) for check in checks):
+            return
+
+        start = time.time()
+        loaded_checks = []
+        for check in checks:
+            if isinstance(check, DeferredCheck):
+                try:
+                    check = check.load()
+                except Exception, e:
+                    log.exception('Unable to initialize check %s' % check.name)
+                    checksd['init_failed_checks'][check.name] = {'error': e, 'traceback': traceback.format_exc()}
+                    continue
+            loaded_checks.append(check)
+        checks[:] = loaded_checks
+        self._startup_phases.append(('import_checks', time.time() - start))
+
     @staticmethod
     def _stats_for_display(raw_stats):
         return pprint.pformat(raw_stats, indent=4)
 
     @log_exceptions(log)
-    def run(self, checksd=None, start_event=True, configs_reloaded=False):
+    def run(self, checksd=None, start_event=True, configs_reloaded=False, scheduled=False):
         """
         Collect data from each check and submit their data.
+
+        With `scheduled`, only the instances of the checks.d checks that are
+        due are run, see CheckScheduler.
         """
         log.debug("Found {num_checks} checks".format(num_checks=len(checksd['initialized_checks'])))
         timer = Timer()
@@ -258,7 +552,15 @@ class Collector(object):
         self.run_count += 1
         log.debug("Starting collection run #%s" % self.run_count)
 
+        startup_run = False
         if checksd:
+            if checksd is not self._loaded_checksd:
+                self._loaded_checksd = checksd
+                self._startup_phases = list(checksd.get('load_times', []))
+                self._reload_counts = checksd.get('reload_counts')
+                startup_run = True
+                self._stop_replaced_checks(checksd)
+            self._load_deferred_checks(checksd)
             self.initialized_checks_d = checksd['initialized_checks']  # is a list of AgentCheck instances
             self.init_failed_checks_d = checksd['init_failed_checks']  # is of type {check_name: {error, traceback}}
 
@@ -389,78 +691,69 @@ class Collector(object):
 
         # checks.d checks
         check_statuses = []
-        for check in self.initialized_checks_d:
-            if not self.continue_running:
+        if scheduled:
+            now = time.time()
+            self._scheduler.sync(self.initialized_checks_d, now)
+            to_run = self._scheduler.pop_due(now)
+        else:
+            to_run = [(check, None, None) for check in self.initialized_checks_d]
+
+        if self._check_runner is None:
+            check_runs = []
+            for check, instance_ids, due in to_run:
+                if not self.continue_running:
+                    return
+                check_run = CheckRun(check, instance_ids=instance_ids, scheduled=due)
+                check_run.execute()
+                check_runs.append(check_run)
+        else:
+            check_runs = self._run_checks_concurrently(to_run)
+            if check_runs is None:
                 return
-            log.info("Running check %s" % check.name)
-            instance_statuses = []
-            metric_count = 0
-            event_count = 0
-            service_check_count = 0
-            check_start_time = time.time()
-            check_stats = None
-
-            try:
-                # Run the check.
-                instance_statuses = check.run()
 
-                # Collect the metrics and events.
-                current_check_metrics = check.get_metrics()
-                current_check_events = check.get_events()
-                check_stats = check._get_internal_profiling_stats()
-
-                # Collect metadata
-                current_check_metadata = check.get_service_metadata()
-
-                # Save metrics & events for the payload.
-                metrics.extend(current_check_metrics)
-                if current_check_events:
-                    if check.name not in events:
-                        events[check.name] = current_check_events
-                    else:
-                        events[check.name] += current_check_events
-
-                # Save the status of the check.
-                metric_count = len(current_check_metrics)
-                event_count = len(current_check_events)
+        for check_run in check_runs:
+            check = check_run.check
+            check_status = check_run.status
+            if check_status is None:
+                # The run failed, and was logged by its check runner
+                continue
 
-            except Exception:
-                log.exception("Error running check %s" % check.name)
-
-            check_status = CheckStatus(
-                check.name, instance_statuses, metric_count,
-                event_count, service_check_count, service_metadata=current_check_metadata,
-                library_versions=check.get_library_info(),
-                source_type_name=check.SOURCE_TYPE_NAME or check.name,
-                check_stats=check_stats
-            )
-
-            # Service check for Agent checks failures
-            service_check_tags = ["check:%s" % check.name]
-            if check_status.status == STATUS_OK:
-                status = AgentCheck.OK
-            elif check_status.status == STATUS_ERROR:
-                status = AgentCheck.CRITICAL
-            check.service_check('datadog.agent.check_status', status, tags=service_check_tags)
-
-            # Collect the service checks and save them in the payload
-            current_check_service_checks = check.get_service_checks()
-            if current_check_service_checks:
-                service_checks.extend(current_check_service_checks)
-            service_check_count = len(current_check_service_checks)
-
-            # Update the check status with the correct service_check_count
-            check_status.service_check_count = service_check_count
+            # Save metrics & events for the payload.
+            metrics.extend(check_run.metrics)
+            if check_run.events:
+                if check.name not in events:
+                    events[check.name] = check_run.events
+                else:
+                    events[check.name] += check_run.events
+            service_checks.extend(check_run.service_checks)
+
+            check_run_time = check_run.get_run_time()
+            check_queue_time = check_run.get_queue_time()
+            check_schedule_lag = check_run.get_schedule_lag()
+            check_status.run_time = check_run_time
+            check_status.queue_time = check_queue_time
+            check_status.schedule_lag = check_schedule_lag
             check_statuses.append(check_status)
 
-            check_run_time = time.time() - check_start_time
-            log.debug("Check %s ran in %.2f s" % (check.name, check_run_time))
+            if check_run_time is not None:
+                log.debug("Check %s ran in %.2f s" % (check.name, check_run_time))
 
             # Intrument check run timings if enabled.
             if self.check_timings:
-                metric = 'datadog.agent.check_run_time'
                 meta = {'tags': ["check:%s" % check.name]}
-                metrics.append((metric, time.time(), check_run_time, meta))
+                if check_run_time is not None:
+                    metrics.append(('datadog.agent.check_run_time', time.time(), check_run_time, meta))
+                if self._check_runner is not None and check_queue_time is not None:
+                    metrics.append(('datadog.agent.check_queue_time', time.time(), check_queue_time, meta))
+                if check_schedule_lag is not None:
+                    metrics.append(('datadog.agent.check_schedule_lag', time.time(), check_schedule_lag, meta))
+
+        if scheduled:
+            # Checks that were not due keep the status of their last run
+            for check_status in check_statuses:
+                self._last_check_statuses[check_status.name] = check_status
+            check_statuses = [self._last_check_statuses[c.name] for c in self.initialized_checks_d
+                              if c.name in self._last_check_statuses]
 
         for check_name, info in self.init_failed_checks_d.iteritems():
             if not self.continue_running:
@@ -483,6 +776,8 @@ class Collector(object):
         self._populate_payload_metadata(payload, check_statuses, start_event)
 
         collect_duration = timer.step()
+        if startup_run:
+            self._startup_phases.append(('first_run', collect_duration))
 
         if self._agent_metrics:
             metric_context = {
@@ -509,7 +804,9 @@ class Collector(object):
         # Persist the status of the collection run.
         try:
             CollectorStatus(check_statuses, emitter_statuses,
-                            self.hostname_metadata_cache).persist()
+                            self.hostname_metadata_cache,
+                            startup_phases=self._startup_phases,
+                            reload_counts=self._reload_counts).persist()
         except Exception:
             log.exception("Error persisting collector status")
 
@@ -525,6 +822,50 @@ class Collector(object):
 
         return payload
 
+    def _run_checks_concurrently(self, to_run):
+        """
+        Run the checks.d checks with the check runners, and wait for each of
+        them to complete or to time out. Returns None if the collector stopped.
+        """
+        self._late_check_runs = [r for r in self._late_check_runs if not r.done.is_set()]
+        late_checks = set(id(r.check) for r in self._late_check_runs)
+
+        check_runs = []
+        for check, instance_ids, due in to_run:
+            timeout = float(check.init_config.get('check_timeout') or self._check_timeout)
+            check_run = CheckRun(check, timeout, instance_ids=instance_ids, scheduled=due)
+            if id(check) in late_checks:
+                # Still running since a previous collection, don't run it twice at once
+                check_run.time_out(self.hostname, "Check %s is still running since a previous collection" % check.name)
+            else:
+                self._check_runner.submit(check_run)
+            check_runs.append(check_run)
+
+        for check_run in check_runs:
+            while not check_run.is_over():
+                if not self.continue_running:
+                    return None
+
+                now = time.time()
+                if check_run.started is None:
+                    late_count = len([r for r in self._late_check_runs if not r.done.is_set()])
+                    if late_count >= self._check_runner.size:
+                        # No check runner will be available
+                        check_run.time_out(self.hostname, "Check %s couldn't start, all the check runners are busy with checks that timed out"
+                                           % check_run.check.name, queued=True)
+                        continue
+                    wait = CHECK_POLL_INTERVAL
+                elif now >= check_run.started + check_run.timeout:
+                    if check_run.time_out(self.hostname, "Check %s didn't complete within %ss"
+                                          % (check_run.check.name, check_run.timeout)):
+                        self._late_check_runs.append(check_run)
+                    continue
+                else:
+                    wait = min(check_run.started + check_run.timeout - now, CHECK_POLL_INTERVAL)
+                check_run.done.wait(wait)
+
+        return check_runs
+
     @staticmethod
     def run_single_check(check, verbose=True):
         log.info("Running check %s" % check.name)
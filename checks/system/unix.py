@@ -3,6 +3,7 @@ Unix system checks.
 """
 # stdlib
 import operator
+import os
 import platform
 import re
 import sys
@@ -12,6 +13,7 @@ import time
 from checks import Check
 from util import get_hostname
 from utils.platform import Platform
+from utils.procfs import DiskStats, PROCFS_PATH, read_diskstats, SYSFS_PATH
 from utils.subprocess_output import get_subprocess_output
 
 # 3rd party
@@ -31,6 +33,61 @@ class IO(Check):
         self.header_re = re.compile(r'([%\\/\-_a-zA-Z0-9]+)[\s+]?')
         self.item_re = re.compile(r'^([a-zA-Z0-9\/]+)')
         self.value_re = re.compile(r'\d+\.\d+')
+        # On Linux, the stats are computed from /proc/diskstats instead of iostat,
+        # with the sample of the previous run: (timestamp, {device: DiskStats})
+        self._use_diskstats = os.path.isfile(os.path.join(PROCFS_PATH, 'diskstats'))\
+            and os.path.isdir(os.path.join(SYSFS_PATH, 'block'))
+        self._last_diskstats = None
+
+    def _check_linux_diskstats(self):
+        """
+        The stats of `iostat -d -x -k`, from the difference between the samples
+        of /proc/diskstats of this run and of the previous one, in the same format.
+        """
+        now = time.time()
+        diskstats = read_diskstats()
+        last_diskstats = self._last_diskstats
+        self._last_diskstats = (now, diskstats)
+        if last_diskstats is None:
+            return {}
+        last_ts, last_stats = last_diskstats
+        return self._compute_iostats(last_stats, diskstats, now - last_ts)
+
+    @staticmethod
+    def _compute_iostats(previous, current, elapsed):
+        io = {}
+        if elapsed <= 0:
+            return io
+
+        for device, stats in current.iteritems():
+            if device not in previous:
+                continue
+            d = DiskStats(*[c - p for c, p in zip(stats, previous[device])])
+            # Counters wrapped, or the device was replaced: wait for the next sample
+            if min(d.reads, d.reads_merged, d.sectors_read, d.read_ms, d.writes, d.writes_merged,
+                   d.sectors_written, d.write_ms, d.io_ms, d.weighted_io_ms) < 0:
+                continue
+
+            ios = d.reads + d.writes
+            values = {
+                'rrqm/s': d.reads_merged / elapsed,
+                'wrqm/s': d.writes_merged / elapsed,
+                'r/s': d.reads / elapsed,
+                'w/s': d.writes / elapsed,
+                # Sectors are 512 bytes
+                'rkB/s': d.sectors_read / 2.0 / elapsed,
+                'wkB/s': d.sectors_written / 2.0 / elapsed,
+                'avgrq-sz': float(d.sectors_read + d.sectors_written) / ios if ios else 0.0,
+                'avgqu-sz': d.weighted_io_ms / 1000.0 / elapsed,
+                'await': float(d.read_ms + d.write_ms) / ios if ios else 0.0,
+                'r_await': float(d.read_ms) / d.reads if d.reads else 0.0,
+                'w_await': float(d.write_ms) / d.writes if d.writes else 0.0,
+                'svctm': float(d.io_ms) / ios if ios else 0.0,
+                '%util': min(100.0, d.io_ms / 10.0 / elapsed),
+            }
+            io[device] = dict((name, '%.2f' % value) for name, value in values.iteritems())
+
+        return io
 
     def _parse_linux2(self, output):
         recentStats = output.split('Device:')[2].split('\n')
@@ -112,7 +169,10 @@ class IO(Check):
         """
         io = {}
         try:
-            if Platform.is_linux():
+            if Platform.is_linux() and self._use_diskstats:
+                io.update(self._check_linux_diskstats())
+
+            elif Platform.is_linux():
                 stdout, _, _ = get_subprocess_output(['iostat', '-d', '1', '2', '-x', '-k'], self.logger)
 
                 #                 Linux 2.6.32-343-ec2 (ip-10-35-95-10)   12/11/2012      _x86_64_        (2 CPU)
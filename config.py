@@ -1,7 +1,9 @@
 # stdlib
 import ConfigParser
 from cStringIO import StringIO
+import copy
 import glob
+import hashlib
 import imp
 import inspect
 import itertools
@@ -15,6 +17,7 @@ import re
 from socket import gaierror, gethostbyname
 import string
 import sys
+import time
 import traceback
 from urlparse import urlparse
 
@@ -34,6 +37,8 @@ UNIX_CONFIG_PATH = '/etc/dd-agent'
 MAC_CONFIG_PATH = '/opt/datadog-agent/etc'
 DEFAULT_CHECK_FREQUENCY = 15   # seconds
 LOGGING_MAX_BYTES = 5 * 1024 * 1024
+# Threads parsing the configuration files of conf.d
+CHECK_CONFIG_LOADERS = 4
 
 log = logging.getLogger(__name__)
 
@@ -308,6 +313,38 @@ def get_histogram_percentiles(configstr=None):
 
     return result
 
+def get_histogram_backend(configstr=None):
+    if configstr is None:
+        return None
+
+    backend = configstr.strip()
+    if backend not in ('exact', 'sketch'):
+        log.warning("Ignored histogram backend {0}, must be exact or sketch".format(backend))
+        return None
+
+    return backend
+
+def get_histogram_sketch_prefixes(configstr=None):
+    if configstr is None:
+        return None
+
+    return [prefix.strip() for prefix in configstr.split(',') if prefix.strip()] or None
+
+def get_histogram_sketch_accuracy(configstr=None):
+    if configstr is None:
+        return None
+
+    try:
+        accuracy = float(configstr)
+        if accuracy <= 0 or accuracy >= 1:
+            raise ValueError
+    except ValueError:
+        log.warning("Bad histogram sketch accuracy {0}, must be float in ]0;1[, skipping"
+            .format(configstr))
+        return None
+
+    return accuracy
+
 def get_config(parse_args=True, cfg_path=None, options=None):
     if parse_args:
         options, _ = get_parsed_args()
@@ -422,6 +459,16 @@ def get_config(parse_args=True, cfg_path=None, options=None):
         if config.has_option('Main', 'histogram_percentiles'):
             agentConfig['histogram_percentiles'] = get_histogram_percentiles(config.get('Main', 'histogram_percentiles'))
 
+        # Histogram samples backend, the sketch one has a bounded memory usage
+        if config.has_option('Main', 'histogram_backend'):
+            agentConfig['histogram_backend'] = get_histogram_backend(config.get('Main', 'histogram_backend'))
+
+        if config.has_option('Main', 'histogram_sketch_prefixes'):
+            agentConfig['histogram_sketch_prefixes'] = get_histogram_sketch_prefixes(config.get('Main', 'histogram_sketch_prefixes'))
+
+        if config.has_option('Main', 'histogram_sketch_accuracy'):
+            agentConfig['histogram_sketch_accuracy'] = get_histogram_sketch_accuracy(config.get('Main', 'histogram_sketch_accuracy'))
+
         # Disable Watchdog (optionally)
         if config.has_option('Main', 'watchdog'):
             if config.get('Main', 'watchdog').lower() in ('no', 'false'):
@@ -723,37 +770,172 @@ def get_ssl_certificate(osname, filename):
 
 def check_yaml(conf_path):
     f = open(conf_path)
-    check_name = os.path.basename(conf_path).split('.')[0]
     try:
-        check_config = yaml.load(f.read(), Loader=yLoader)
-        assert 'init_config' in check_config, "No 'init_config' section found"
-        assert 'instances' in check_config, "No 'instances' section found"
-
-        valid_instances = True
-        if check_config['instances'] is None or not isinstance(check_config['instances'], list):
-            valid_instances = False
-        else:
-            for i in check_config['instances']:
-                if not isinstance(i, dict):
-                    valid_instances = False
-                    break
-        if not valid_instances:
-            raise Exception('You need to have at least one instance defined in the YAML file for this check')
-        else:
-            return check_config
+        return _parse_check_yaml(f.read())
     finally:
         f.close()
 
 
-def load_check_directory(agentConfig, hostname):
+def _parse_check_yaml(content):
+    check_config = yaml.load(content, Loader=yLoader)
+    assert 'init_config' in check_config, "No 'init_config' section found"
+    assert 'instances' in check_config, "No 'instances' section found"
+
+    valid_instances = True
+    if check_config['instances'] is None or not isinstance(check_config['instances'], list):
+        valid_instances = False
+    else:
+        for i in check_config['instances']:
+            if not isinstance(i, dict):
+                valid_instances = False
+                break
+    if not valid_instances:
+        raise Exception('You need to have at least one instance defined in the YAML file for this check')
+    else:
+        return check_config
+
+
+# Validated configurations of conf.d, by path: (mtime, md5 of the file, configuration)
+_check_config_cache = {}
+
+
+def load_check_config(conf_path):
+    """
+    Same as `check_yaml`, but only reads and parses the files that changed since
+    they were last loaded. Returns a (check configuration, whether it was cached) tuple.
+    """
+    mtime = os.path.getmtime(conf_path)
+    cached = _check_config_cache.get(conf_path)
+    from_cache = cached is not None and cached[0] == mtime
+    if not from_cache:
+        f = open(conf_path)
+        try:
+            content = f.read()
+        finally:
+            f.close()
+        digest = hashlib.md5(content).hexdigest()
+        # A touched file keeps its configuration
+        from_cache = cached is not None and cached[1] == digest
+        if from_cache:
+            cached = (mtime, digest, cached[2])
+        else:
+            cached = (mtime, digest, _parse_check_yaml(content))
+        _check_config_cache[conf_path] = cached
+
+    # Checks may update their configuration, they get their own copy of it
+    return copy.deepcopy(cached[2]), from_cache
+
+
+def _load_check_config_safe(conf_path):
+    """ Returns a (check configuration, whether it was cached, error, traceback) tuple """
+    try:
+        return load_check_config(conf_path) + (None, None)
+    except Exception, e:
+        log.exception("Unable to parse yaml config in %s" % conf_path)
+        return None, False, e, traceback.format_exc()
+
+
+def _initialize_check(check_name, check_path, check_config, agentConfig):
+    """
+    Import the module of a checks.d check and initialize its check class with `check_config`.
+    Returns None if the module doesn't define a check class.
+    """
+    from checks import AgentCheck
+
+    check_module = imp.load_source('checksd_%s' % check_name, check_path)
+
+    # We make sure that there is an AgentCheck class defined
+    check_class = None
+    classes = inspect.getmembers(check_module, inspect.isclass)
+    for _, clsmember in classes:
+        if clsmember == AgentCheck:
+            continue
+        if issubclass(clsmember, AgentCheck):
+            check_class = clsmember
+            if AgentCheck in clsmember.__bases__:
+                continue
+            else:
+                break
+
+    if not check_class:
+        return None
+
+    # Init all of the check's classes with
+    init_config = check_config.get('init_config', {})
+    # init_config: in the configuration triggers init_config to be defined
+    # to None.
+    if init_config is None:
+        init_config = {}
+
+    instances = check_config['instances']
+    try:
+        c = check_class(check_name, init_config=init_config,
+                        agentConfig=agentConfig, instances=instances)
+    except TypeError, e:
+        # Backwards compatibility for checks which don't support the
+        # instances argument in the constructor.
+        c = check_class(check_name, init_config=init_config,
+                        agentConfig=agentConfig)
+        c.instances = instances
+    return c
+
+
+def _get_check_signature(check_path, conf_path):
+    """ Identifies the versions of the module and of the configuration file of a check """
+    digest = None
+    if conf_path in _check_config_cache:
+        digest = _check_config_cache[conf_path][1]
+    return (check_path, os.path.getmtime(check_path), conf_path, digest)
+
+
+class DeferredCheck(object):
+    """
+    Stands for a checks.d check until its first run: the collector imports and
+    initializes it then, instead of when the agent starts or reloads.
+    """
+    def __init__(self, name, check_path, check_config, agentConfig):
+        self.name = name
+        self.check_path = check_path
+        self.check_config = check_config
+        self.agentConfig = agentConfig
+        self.instances = check_config['instances']
+
+    def load(self):
+        """ Returns the initialized check, raises if it can't be imported or initialized """
+        check = _initialize_check(self.name, self.check_path, self.check_config, self.agentConfig)
+        if check is None:
+            raise Exception('No check class (inheriting from AgentCheck) found in %s.py' % self.name)
+        log.debug('Loaded check.d/%s.py' % self.name)
+        return check
+
+    def stop(self):
+        pass
+
+
+def load_check_directory(agentConfig, hostname, deferred=False, previous=None):
     ''' Return the initialized checks from checks.d, and a mapping of checks that failed to
     initialize. Only checks that have a configuration
-    file in conf.d will be returned. '''
-    from checks import AgentCheck, AGENT_METRICS_CHECK_NAME
+    file in conf.d will be returned.
+
+    With `deferred`, checks are not imported and initialized but returned as
+    `DeferredCheck`s, loaded by the collector on their first run.
+
+    With `previous`, the result of the last load, checks whose module and
+    configuration didn't change are kept, with their state. '''
+    from checks import AGENT_METRICS_CHECK_NAME
 
     initialized_checks = {}
     init_failed_checks = {}
     deprecated_checks = {}
+    load_times = []
+    # Versions of the module and configuration of the initialized checks
+    signatures = {}
+    previous_checks = {}
+    previous_signatures = {}
+    if previous:
+        previous_checks = dict((c.name, c) for c in previous['initialized_checks'])
+        previous_signatures = previous.get('signatures', {})
+    kept_checks = []
     agentConfig['checksd_hostname'] = hostname
 
     deprecated_configs_enabled = [v for k,v in OLD_STYLE_PARAMETERS if len([l for l in agentConfig if l.startswith(k)]) > 0]
@@ -782,111 +964,100 @@ def load_check_directory(agentConfig, hostname):
     # So we iterate over the files in the checks.d directory
     # If there is a matching configuration file in the conf.d directory
     # then we import the check
+    # (check name, check path, configuration file path, configuration)
+    to_load = []
     for check in itertools.chain(*checks_paths):
         check_name = os.path.basename(check).split('.')[0]
-        check_config = None
-        if check_name in initialized_checks or check_name in init_failed_checks:
+        if check_name in [c[0] for c in to_load]:
             log.debug('Skipping check %s because it has already been loaded from another location', check)
             continue
 
         # Let's see if there is a conf.d for this check
         conf_path = os.path.join(confd_path, '%s.yaml' % check_name)
-        conf_exists = False
 
-        if os.path.exists(conf_path):
-            conf_exists = True
-        else:
+        if not os.path.exists(conf_path):
             log.debug("No configuration file for %s. Looking for defaults" % check_name)
 
             # Default checks read their config from the "[CHECKNAME].yaml.default" file
             default_conf_path = os.path.join(confd_path, '%s.yaml.default' % check_name)
-            if not os.path.exists(default_conf_path):
+            if os.path.exists(default_conf_path):
+                conf_path = default_conf_path
+            else:
                 log.debug("Default configuration file {0} is missing. Skipping check".format(default_conf_path))
-                continue
-            conf_path = default_conf_path
-            conf_exists = True
+                conf_path = None
 
-        if conf_exists:
-            try:
-                check_config = check_yaml(conf_path)
-            except Exception, e:
-                log.exception("Unable to parse yaml config in %s" % conf_path)
-                traceback_message = traceback.format_exc()
-                init_failed_checks[check_name] = {'error': str(e), 'traceback': traceback_message}
-                continue
-        else:
-            # Compatibility code for the Nagios checks if it's still configured
-            # in datadog.conf
-            # FIXME: 6.x, should be removed
-            if check_name == 'nagios':
-                if any([nagios_key in agentConfig for nagios_key in NAGIOS_OLD_CONF_KEYS]):
+                # Compatibility code for the Nagios checks if it's still configured
+                # in datadog.conf
+                # FIXME: 6.x, should be removed
+                if check_name == 'nagios' and any([nagios_key in agentConfig for nagios_key in NAGIOS_OLD_CONF_KEYS]):
                     log.warning("Configuring Nagios in datadog.conf is deprecated "
                                 "and will be removed in a future version. "
                                 "Please use conf.d")
                     check_config = {'instances':[dict((key, agentConfig[key]) for key in agentConfig if key in NAGIOS_OLD_CONF_KEYS)]}
-                else:
-                    continue
-            else:
-                log.debug("No configuration file for %s" % check_name)
+                    to_load.append((check_name, check, None, check_config))
                 continue
 
-        # If we are here, there is a valid matching configuration file.
-        # Let's try to import the check
-        try:
-            check_module = imp.load_source('checksd_%s' % check_name, check)
-        except Exception, e:
-            traceback_message = traceback.format_exc()
-            # There is a configuration file for that check but the module can't be imported
-            init_failed_checks[check_name] = {'error':e, 'traceback':traceback_message}
-            log.exception('Unable to import check module %s.py from checks.d' % check_name)
-            continue
+        to_load.append((check_name, check, conf_path, None))
 
-        # We make sure that there is an AgentCheck class defined
-        check_class = None
-        classes = inspect.getmembers(check_module, inspect.isclass)
-        for _, clsmember in classes:
-            if clsmember == AgentCheck:
+    # Parse the configuration files, in parallel as they may be many on a slow disk
+    start = time.time()
+    conf_paths = [path for _, _, path, _ in to_load if path]
+    if len(conf_paths) > 1:
+        from checks.libs.thread_pool import Pool
+        pool = Pool(min(CHECK_CONFIG_LOADERS, len(conf_paths)))
+        try:
+            parsed_configs = pool.map(_load_check_config_safe, conf_paths)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        parsed_configs = map(_load_check_config_safe, conf_paths)
+    parsed_configs = dict(zip(conf_paths, parsed_configs))
+    load_times.append(('parse_configs', time.time() - start))
+    log.debug("Parsed %s configuration files, %s unchanged since they were last loaded",
+              len(conf_paths), len([c for c in parsed_configs.itervalues() if c[1]]))
+
+    start = time.time()
+    for check_name, check, conf_path, check_config in to_load:
+        if conf_path:
+            check_config, _, error, traceback_message = parsed_configs[conf_path]
+            if error is not None:
+                init_failed_checks[check_name] = {'error': str(error), 'traceback': traceback_message}
                 continue
-            if issubclass(clsmember, AgentCheck):
-                check_class = clsmember
-                if AgentCheck in clsmember.__bases__:
-                    continue
-                else:
-                    break
-
-        if not check_class:
-            log.error('No check class (inheriting from AgentCheck) found in %s.py' % check_name)
-            continue
 
         # Look for the per-check config, which *must* exist
         if not check_config.get('instances'):
             log.error("Config %s is missing 'instances'" % conf_path)
             continue
 
-        # Init all of the check's classes with
-        init_config = check_config.get('init_config', {})
-        # init_config: in the configuration triggers init_config to be defined
-        # to None.
-        if init_config is None:
-            init_config = {}
+        signature = _get_check_signature(check, conf_path)
+        if check_name in previous_checks and previous_signatures.get(check_name) == signature:
+            # Neither the module nor the configuration changed, keep the check and its state
+            initialized_checks[check_name] = previous_checks[check_name]
+            signatures[check_name] = signature
+            kept_checks.append(check_name)
+            continue
 
-        instances = check_config['instances']
-        try:
-            try:
-                c = check_class(check_name, init_config=init_config,
-                                agentConfig=agentConfig, instances=instances)
-            except TypeError, e:
-                # Backwards compatibility for checks which don't support the
-                # instances argument in the constructor.
-                c = check_class(check_name, init_config=init_config,
-                                agentConfig=agentConfig)
-                c.instances = instances
-        except Exception, e:
-            log.exception('Unable to initialize check %s' % check_name)
-            traceback_message = traceback.format_exc()
-            init_failed_checks[check_name] = {'error':e, 'traceback':traceback_message}
+        # If we are here, there is a valid matching configuration file.
+        if deferred:
+            initialized_checks[check_name] = DeferredCheck(check_name, check, check_config, agentConfig)
+            signatures[check_name] = signature
         else:
-            initialized_checks[check_name] = c
+            # Let's try to import the check
+            try:
+                c = _initialize_check(check_name, check, check_config, agentConfig)
+            except Exception, e:
+                # There is a configuration file for that check but it can't be imported or initialized
+                log.exception('Unable to initialize check %s' % check_name)
+                traceback_message = traceback.format_exc()
+                init_failed_checks[check_name] = {'error':e, 'traceback':traceback_message}
+            else:
+                if c is None:
+                    log.error('No check class (inheriting from AgentCheck) found in %s.py' % check_name)
+                    continue
+                initialized_checks[check_name] = c
+                signatures[check_name] = signature
+                log.debug('Loaded check.d/%s.py' % check_name)
 
         # Add custom pythonpath(s) if available
         if 'pythonpath' in check_config:
@@ -895,14 +1066,25 @@ def load_check_directory(agentConfig, hostname):
                 pythonpath = [pythonpath]
             sys.path.extend(pythonpath)
 
-        log.debug('Loaded check.d/%s.py' % check_name)
+    if not deferred:
+        load_times.append(('import_checks', time.time() - start))
 
     init_failed_checks.update(deprecated_checks)
     log.info('initialized checks.d checks: %s' % [k for k in initialized_checks.keys() if k != AGENT_METRICS_CHECK_NAME])
     log.info('initialization failed checks.d checks: %s' % init_failed_checks.keys())
-    return {'initialized_checks':initialized_checks.values(),
-            'init_failed_checks':init_failed_checks,
-            }
+    result = {'initialized_checks':initialized_checks.values(),
+              'init_failed_checks':init_failed_checks,
+              'load_times': load_times,
+              'signatures': signatures,
+              }
+    if previous:
+        result['reload_counts'] = {
+            'reloaded': len(initialized_checks) - len(kept_checks),
+            'kept': len(kept_checks),
+        }
+        log.info('reloaded %s checks.d checks, kept %s unchanged: %s',
+                 result['reload_counts']['reloaded'], len(kept_checks), kept_checks)
+    return result
 
 
 #
@@ -15,12 +15,15 @@ initialize_logging('forwarder')
 
 # stdlib
 from datetime import timedelta
+import functools
 import logging
 import os
 from Queue import Full, Queue
 from socket import error as socket_error, gaierror
 import sys
+import tempfile
 import threading
+from time import time
 import zlib
 
 # For pickle & PID files, see issue 293
@@ -42,13 +45,17 @@ import tornado.web
 # project
 from checks.check_status import ForwarderStatus
 from config import (
+    _windows_commondata_path,
     get_config,
     get_logging_config,
     get_url_endpoint,
     get_version
 )
 import modules
-from transaction import Transaction, TransactionManager
+from utils.payload import decode_series, DEFAULT_MAX_PAYLOAD_SIZE, SeriesPayload
+from utils.pidfile import PidFile
+from utils.platform import Platform
+from transaction import SpillQueue, Transaction, TransactionManager
 from util import (
     get_hostname,
     get_tornado_ioloop,
@@ -79,10 +86,46 @@ MAX_WAIT_FOR_REPLAY = timedelta(seconds=90)
 # Maximum queue size in bytes (when this is reached, old messages are dropped)
 MAX_QUEUE_SIZE = 30 * 1024 * 1024  # 30MB
 
-THROTTLING_DELAY = timedelta(microseconds=1000000/2)  # 2 msg/second
+MAX_IN_FLIGHT = 4  # Transactions sent concurrently
+
+# Past this size in memory, transactions are spilled to disk if enabled
+SPILL_THRESHOLD = 10 * 1024 * 1024  # 10MB
+# Weight of the last payload in the average processing time of an emitter
+EMITTER_LATENCY_SMOOTHING = 0.2
+# Series bodies waiting to be merged, past this they are sent as they were posted
+SERIES_QUEUE_SIZE = 100
+
+
+class EmitterPayload(object):
+    """
+    A payload received by the forwarder, shared by the emitter threads. It is
+    decoded once, by the first emitter thread handling it.
+    """
+
+    def __init__(self, data, headers):
+        self._data = data
+        self._headers = headers
+        self._decoded = None
+        self._lock = threading.Lock()
+
+    def decode(self):
+        with self._lock:
+            if self._data is not None:
+                data = self._data
+                if self._headers and self._headers.get('Content-Encoding') == 'deflate':
+                    data = zlib.decompress(data)
+                self._decoded = json_decode(data)
+                self._data = None
+        return self._decoded
 
 
 class EmitterThread(threading.Thread):
+    """
+    Calls an emitter with the payloads queued for it.
+
+    Emitters with a `batch_size` attribute are called with lists of up to
+    `batch_size` payloads, made of the ones queued while they were busy.
+    """
 
     def __init__(self, *args, **kwargs):
         self.__name = kwargs['name']
@@ -90,25 +133,55 @@ class EmitterThread(threading.Thread):
         self.__logger = kwargs.pop('logger')
         self.__config = kwargs.pop('config')
         self.__max_queue_size = kwargs.pop('max_queue_size', 100)
+        self.__batch_size = getattr(self.__emitter, 'batch_size', None)
         self.__queue = Queue(self.__max_queue_size)
+        self.__dropped = 0
+        self.__processed = 0
+        self.__latency = None
         threading.Thread.__init__(self, *args, **kwargs)
         self.daemon = True
 
     def run(self):
         while True:
-            (data, headers) = self.__queue.get()
-            try:
-                self.__logger.debug('Emitter %r handling a packet', self.__name)
-                self.__emitter(data, self.__logger, self.__config)
-            except Exception:
-                self.__logger.error('Failure during operation of emitter %r', self.__name, exc_info=True)
+            payloads = [self.__queue.get()]
+            if self.__batch_size:
+                while len(payloads) < self.__batch_size and not self.__queue.empty():
+                    payloads.append(self.__queue.get())
+            self.handle(payloads)
+
+    def handle(self, payloads):
+        start = time()
+        try:
+            self.__logger.debug('Emitter %r handling %s packet(s)', self.__name, len(payloads))
+            if self.__batch_size:
+                self.__emitter([p.decode() for p in payloads], self.__logger, self.__config)
+            else:
+                self.__emitter(payloads[0].decode(), self.__logger, self.__config)
+        except Exception:
+            self.__logger.error('Failure during operation of emitter %r', self.__name, exc_info=True)
+
+        latency = time() - start
+        if self.__latency is None:
+            self.__latency = latency
+        else:
+            self.__latency += EMITTER_LATENCY_SMOOTHING * (latency - self.__latency)
+        self.__processed += len(payloads)
 
-    def enqueue(self, data, headers):
+    def enqueue(self, payload):
         try:
-            self.__queue.put((data, headers), block=False)
+            self.__queue.put(payload, block=False)
         except Full:
+            self.__dropped += 1
             self.__logger.warn('Dropping packet for %r due to backlog', self.__name)
 
+    def get_stats(self):
+        return {
+            'queue_length': self.__queue.qsize(),
+            'dropped': self.__dropped,
+            'processed': self.__processed,
+            'latency': self.__latency,
+        }
+
 
 class EmitterManager(object):
     """Track custom emitters"""
@@ -136,12 +209,94 @@ class EmitterManager(object):
     def send(self, data, headers=None):
         if not self.emitterThreads:
             return  # bypass decompression/decoding
-        if headers and headers.get('Content-Encoding') == 'deflate':
-            data = zlib.decompress(data)
-        data = json_decode(data)
+        # Decoded by the emitter threads, not to block the ioloop
+        payload = EmitterPayload(data, headers)
         for emitterThread in self.emitterThreads:
-            logging.info('Queueing for emitter %r', emitterThread.name)
-            emitterThread.enqueue(data, headers)
+            logging.debug('Queueing for emitter %r', emitterThread.name)
+            emitterThread.enqueue(payload)
+
+    def get_stats(self):
+        return dict((t.name, t.get_stats()) for t in self.emitterThreads)
+
+
+class SeriesCoalescer(threading.Thread):
+    """
+    Merges the series posted to the forwarder into shared deflated payloads.
+
+    Bodies are decoded and recompressed by this thread, not to block the
+    ioloop. `post` is called from it with the (data, headers, payload_count)
+    of each payload to send: once full, at the next flush, or as they were
+    posted for the bodies which can't be merged.
+    """
+
+    HEADERS = {'Content-Type': 'application/json', 'Content-Encoding': 'deflate'}
+
+    def __init__(self, post, max_queue_size=SERIES_QUEUE_SIZE):
+        threading.Thread.__init__(self, name='SeriesCoalescer')
+        self.daemon = True
+        self._post = post
+        # Bodies to merge, None to flush the pending payload
+        self._queue = Queue(max_queue_size)
+        self._payload = None
+        self._payload_count = 0
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                self.handle(item)
+            except Exception:
+                log.exception("Unable to merge series")
+
+    def enqueue(self, msg, headers):
+        """ Queue the series posted as `msg` to be merged, returns False if they can't be """
+        # Big payloads are worth a request of their own, don't decode them
+        if len(msg) > DEFAULT_MAX_PAYLOAD_SIZE / 2:
+            return False
+        try:
+            self._queue.put_nowait((msg, headers))
+        except Full:
+            return False
+        return True
+
+    def flush(self):
+        """ Send the pending payload once the bodies queued so far are merged into it """
+        try:
+            self._queue.put_nowait(None)
+        except Full:
+            # It is flushed with the next one
+            pass
+
+    def handle(self, item):
+        if item is None:
+            self._flush_payload()
+            return
+
+        msg, headers = item
+        series = decode_series(msg, headers)
+        if series is None:
+            self._post(msg, headers, 1)
+            return
+        if not series.strip():
+            return
+
+        if self._payload is not None and not self._payload.fits(series):
+            self._flush_payload()
+        if self._payload is None:
+            payload = SeriesPayload(DEFAULT_MAX_PAYLOAD_SIZE)
+            if not payload.fits(series):
+                # Too big even for a payload of its own, send it as it was posted
+                self._post(msg, headers, 1)
+                return
+            self._payload = payload
+        self._payload.write(series)
+        self._payload_count += 1
+
+    def _flush_payload(self):
+        if self._payload is not None:
+            self._post(self._payload.close(), dict(self.HEADERS), self._payload_count)
+            self._payload = None
+            self._payload_count = 0
 
 
 class AgentTransaction(Transaction):
@@ -164,6 +319,10 @@ class AgentTransaction(Transaction):
     def get_tr_manager(cls):
         return cls._trManager
 
+    @classmethod
+    def get_emitter_manager(cls):
+        return cls._emitter_manager
+
     @classmethod
     def set_endpoints(cls):
         """
@@ -175,7 +334,7 @@ class AgentTransaction(Transaction):
 
         cls._endpoints.append(DD_ENDPOINT)
 
-    def __init__(self, data, headers, msg_type=""):
+    def __init__(self, data, headers, msg_type="", payload_count=1):
         self._data = data
         self._headers = headers
         self._headers['DD-Forwarder-Version'] = get_version()
@@ -183,6 +342,7 @@ class AgentTransaction(Transaction):
 
         # Call after data has been set (size is computed in Transaction's init)
         Transaction.__init__(self)
+        self._payload_count = payload_count
 
         # Emitters operate outside the regular transaction framework
         if self._emitter_manager is not None:
@@ -196,6 +356,25 @@ class AgentTransaction(Transaction):
     def __sizeof__(self):
         return sys.getsizeof(self._data)
 
+    def get_spill_record(self):
+        return (self.__class__.__name__, self._data, dict(self._headers), self._msg_type,
+                self._payload_count)
+
+    @classmethod
+    def from_spill_record(cls, record):
+        """ Rebuild a transaction spilled to disk, without queueing it again """
+        class_name, data, headers, msg_type = record[:4]
+        tr_class = TRANSACTION_CLASSES[class_name]
+        tr = tr_class.__new__(tr_class)
+        tr._data = data
+        tr._headers = headers
+        tr._msg_type = msg_type
+        Transaction.__init__(tr)
+        # Records spilled by older versions don't have a payload count
+        if len(record) > 4:
+            tr._payload_count = record[4]
+        return tr
+
     def get_url(self, endpoint):
         endpoint_base_url = get_url_endpoint(self._application._agentConfig[endpoint])
         api_key = self._application._agentConfig.get('api_key')
@@ -204,6 +383,9 @@ class AgentTransaction(Transaction):
         return "{0}/intake/{1}".format(endpoint_base_url, self._msg_type)
 
     def flush(self):
+        # The transaction is done once every endpoint answered
+        self._pending_responses = len(self._endpoints)
+        self._endpoint_errors = 0
         for endpoint in self._endpoints:
             url = self.get_url(endpoint)
             log.debug(
@@ -261,14 +443,21 @@ class AgentTransaction(Transaction):
             else:
                 log.debug("Using SimpleHTTPClient")
             http = tornado.httpclient.AsyncHTTPClient()
-            http.fetch(req, callback=self.on_response)
+            self._trManager.endpoint_request(endpoint)
+            http.fetch(req, callback=functools.partial(self.on_response, endpoint))
 
-    def on_response(self, response):
+    def on_response(self, endpoint, response):
+        self._trManager.endpoint_response(endpoint, response.code, response.request_time)
         if response.error:
             log.error("Response: %s" % response)
-            self._trManager.tr_error(self)
-        else:
-            self._trManager.tr_success(self)
+            self._endpoint_errors += 1
+
+        self._pending_responses -= 1
+        if self._pending_responses == 0:
+            if self._endpoint_errors:
+                self._trManager.tr_error(self)
+            else:
+                self._trManager.tr_success(self)
 
         self._trManager.flush_next()
 
@@ -301,6 +490,24 @@ class APIServiceCheckTransaction(AgentTransaction):
         return url
 
 
+TRANSACTION_CLASSES = dict(
+    (tr_class.__name__, tr_class)
+    for tr_class in [MetricTransaction, APIMetricTransaction, APIServiceCheckTransaction]
+)
+
+
+def get_spill_path(agentConfig):
+    if agentConfig.get('forwarder_spill_path'):
+        return agentConfig['forwarder_spill_path']
+    if Platform.is_win32():
+        path = os.path.join(_windows_commondata_path(), 'Datadog')
+    elif os.path.isdir(PidFile.get_dir()):
+        path = PidFile.get_dir()
+    else:
+        path = tempfile.gettempdir()
+    return os.path.join(path, 'forwarder_spill')
+
+
 class StatusHandler(tornado.web.RequestHandler):
 
     def get(self):
@@ -358,8 +565,10 @@ class ApiInputHandler(tornado.web.RequestHandler):
         headers = self.request.headers
 
         if msg is not None:
-            # Setup a transaction for this message
-            tr = APIMetricTransaction(msg, headers)
+            # Series are merged with the other ones posted until the next flush
+            if not self.application.coalesce_series(msg, headers):
+                # Setup a transaction for this message
+                APIMetricTransaction(msg, headers)
         else:
             raise tornado.web.HTTPError(500)
 
@@ -389,10 +598,28 @@ class Application(tornado.web.Application):
         self._port = int(port)
         self._agentConfig = agentConfig
         self._metrics = {}
+        self.mloop = get_tornado_ioloop()
+        # Series posted since the last flush, merged into one deflated payload
+        self._series_coalescer = SeriesCoalescer(self._post_series)
         AgentTransaction.set_application(self)
         AgentTransaction.set_endpoints()
+        spill_queue = None
+        spill_max_size = int(agentConfig.get('forwarder_spill_max_size') or 0)
+        if spill_max_size > 0:
+            spill_path = get_spill_path(agentConfig)
+            log.info("Spilling transactions to %s, up to %sMB" % (spill_path, spill_max_size))
+            try:
+                spill_queue = SpillQueue(spill_path, spill_max_size * 1024 * 1024)
+            except Exception:
+                log.exception("Unable to set up the spill queue, transactions will only be kept in memory")
+
         self._tr_manager = TransactionManager(MAX_WAIT_FOR_REPLAY,
-                                              MAX_QUEUE_SIZE, THROTTLING_DELAY)
+                                              MAX_QUEUE_SIZE,
+                                              spill_queue=spill_queue,
+                                              spill_threshold=SPILL_THRESHOLD,
+                                              spill_loader=AgentTransaction.from_spill_record,
+                                              max_in_flight=int(agentConfig.get('forwarder_max_in_flight') or MAX_IN_FLIGHT),
+                                              emitter_stats=AgentTransaction.get_emitter_manager().get_stats)
         AgentTransaction.set_tr_manager(self._tr_manager)
 
         self._watchdog = None
@@ -437,6 +664,22 @@ class Application(tornado.web.Application):
         else:
             metrics[name] = [[host, device, ts, value]]
 
+    def coalesce_series(self, msg, headers):
+        """
+        Queue the series posted as `msg` to be merged into the pending series
+        payload, sent at the next flush or once it is full. Returns False if
+        they can't be, to be sent as they are.
+        """
+        return self._series_coalescer.enqueue(msg, headers)
+
+    def _post_series(self, data, headers, payload_count):
+        # Called by the coalescer thread, transactions are only handled on the ioloop
+        self.mloop.add_callback(functools.partial(APIMetricTransaction, data, headers,
+                                                  payload_count=payload_count))
+
+    def _postSeries(self):
+        self._series_coalescer.flush()
+
     def _postMetrics(self):
 
         if len(self._metrics) > 0:
@@ -504,6 +747,7 @@ class Application(tornado.web.Application):
             if self._watchdog:
                 self._watchdog.reset()
             self._postMetrics()
+            self._postSeries()
             self._tr_manager.flush()
 
         tr_sched = tornado.ioloop.PeriodicCallback(flush_trs, TRANSACTION_FLUSH_INTERVAL,
@@ -523,6 +767,7 @@ class Application(tornado.web.Application):
         # Start everything
         if self._watchdog:
             self._watchdog.reset()
+        self._series_coalescer.start()
         tr_sched.start()
 
         self.mloop.start()
@@ -12,9 +12,14 @@ from utils.proxy import set_no_proxy_settings  # noqa
 set_no_proxy_settings()
 
 # stdlib
+from collections import OrderedDict
+from errno import EAGAIN, EWOULDBLOCK
+from functools import partial
 import logging
+import multiprocessing
 import optparse
 import os
+import Queue
 import select
 import signal
 import socket
@@ -23,12 +28,14 @@ import threading
 from time import sleep, time
 from urllib import urlencode
 import zlib
+from zlib import crc32
 
 # For pickle & PID files, see issue 293
 os.umask(022)
 
 # 3rd party
 import requests
+from requests.adapters import HTTPAdapter
 import simplejson as json
 
 # project
@@ -37,7 +44,9 @@ from checks.check_status import DogstatsdStatus
 from config import get_config, get_version
 from daemon import AgentSupervisor, Daemon
 from util import chunks, get_hostname, get_uuid, plural
+from utils.payload import DEFAULT_MAX_PAYLOAD_SIZE, SeriesPayload
 from utils.pidfile import PidFile
+from utils.platform import Platform
 
 # urllib3 logs a bunch of stuff at the info level
 requests_log = logging.getLogger("requests.packages.urllib3")
@@ -53,6 +62,15 @@ DOGSTATSD_AGGREGATOR_BUCKET_SIZE = 10
 
 WATCHDOG_TIMEOUT = 120
 UDP_SOCKET_TIMEOUT = 5
+# Maximum number of datagrams drained from the socket per select wakeup
+DEFAULT_RECV_BATCH_SIZE = 64
+# Linux value, the constant is missing from the python 2 socket module
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+# How long the parent process waits for a shard to answer
+SHARD_REQUEST_TIMEOUT = 5
+# Requests left unanswered by the shards whose late answers are still expected,
+# the oldest ones are given up on past it
+MAX_TIMED_OUT_REQUESTS = 100
 # Since we call flush more often than the metrics aggregation interval, we should
 #  log a bunch of flushes in a row every so often.
 FLUSH_LOGGING_PERIOD = 70
@@ -60,6 +78,19 @@ FLUSH_LOGGING_INITIAL = 10
 FLUSH_LOGGING_COUNT = 5
 EVENT_CHUNK_SIZE = 50
 COMPRESS_THRESHOLD = 1024
+# Number of series serialized at once in a payload
+SERIES_BATCH_SIZE = 100
+# Number of threads posting payloads, and of payloads waiting for one
+SUBMIT_WORKER_COUNT = 4
+MAX_QUEUED_PAYLOADS = 16
+# Number of payloads kept to be retried, or submitted once the workers catch up
+RETRY_QUEUE_SIZE = 64
+# A failed payload is retried after a delay doubling at each failure, up to
+# RETRY_MAX_DELAY. Payloads are dropped RETRY_MAX_AGE after their submission
+RETRY_MIN_DELAY = 10
+RETRY_MAX_DELAY = 160
+RETRY_MAX_AGE = 15 * 60
+HTTP_TIMEOUT = 5
 
 
 def serialize_metrics(metrics):
@@ -73,10 +104,190 @@ def serialize_metrics(metrics):
     return serialized, headers
 
 
+def serialize_metrics_chunks(metrics, max_payload_size=None):
+    """
+    Serialize metrics into deflated series payloads of at most
+    `max_payload_size` bytes, yielded as (payload, headers) as they fill.
+
+    Series are serialized by batches, and one by one at the payload
+    boundaries.
+    """
+    max_payload_size = max_payload_size or DEFAULT_MAX_PAYLOAD_SIZE
+    headers = {'Content-Type': 'application/json',
+               'Content-Encoding': 'deflate'}
+
+    payload = None
+    for i in xrange(0, len(metrics), SERIES_BATCH_SIZE):
+        batch = metrics[i:i + SERIES_BATCH_SIZE]
+        if payload is None:
+            payload = SeriesPayload(max_payload_size)
+        serialized = json.dumps(batch)[1:-1]
+        if payload.fits(serialized):
+            payload.write(serialized)
+            continue
+
+        for metric in batch:
+            serialized = json.dumps(metric)
+            if not payload.empty and not payload.fits(serialized):
+                yield payload.close(), headers
+                payload = SeriesPayload(max_payload_size)
+            if payload.empty and not payload.fits(serialized):
+                # Can't be split any further, send it in a payload of its own
+                log.warning("Series %s is bigger than the maximum payload size of %s bytes",
+                            metric.get('metric'), max_payload_size)
+            payload.write(serialized)
+
+    if payload is not None:
+        yield payload.close(), headers
+
+
 def serialize_event(event):
     return json.dumps(event)
 
 
+class PayloadSender(object):
+    """
+    Posts payloads from a pool of worker threads sharing a keep-alive
+    HTTP session.
+
+    Up to `max_queued` payloads wait for a worker, which bounds the number
+    of payloads in flight. Submitting never blocks: the payloads submitted
+    while the queue is full, and the ones that could not be posted because
+    of a connection error or a server error, are kept in a bounded retry
+    queue. `retry` submits them again once their retry delay is over, they
+    are dropped RETRY_MAX_AGE after they were first submitted.
+    """
+
+    def __init__(self, worker_count=None, max_queued=None, retry_queue_size=None):
+        self.worker_count = worker_count or SUBMIT_WORKER_COUNT
+        self.retry_queue_size = retry_queue_size or RETRY_QUEUE_SIZE
+        self.queue = Queue.Queue(max_queued or MAX_QUEUED_PAYLOADS)
+        self.retry_queue = []  # (next retry time, failures, first submit time, payload)
+        self.workers = []
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.worker_count)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.lock = threading.Lock()
+        self.payloads_sent = 0
+        self.payloads_failed = 0
+        self.payloads_dropped = 0
+        self.post_count = 0
+        self.post_duration = 0
+
+    def start(self):
+        for i in xrange(self.worker_count):
+            worker = threading.Thread(target=self._run, name='dogstatsd-sender-%s' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join(HTTP_TIMEOUT)
+        self.workers = []
+
+    def submit(self, url, data, headers):
+        now = time()
+        try:
+            self.queue.put_nowait(((url, data, headers), 0, now))
+        except Queue.Full:
+            log.debug("Workers busy, keeping the payload for the next flush")
+            with self.lock:
+                self._defer((now, 0, now, (url, data, headers)))
+
+    def retry(self):
+        """ Submit the payloads waiting in the retry queue whose delay is over """
+        now = time()
+        with self.lock:
+            retry_queue = []
+            expired = 0
+            for entry in self.retry_queue:
+                next_retry, failures, submitted, payload = entry
+                if now - submitted > RETRY_MAX_AGE:
+                    expired += 1
+                    continue
+                if next_retry <= now:
+                    try:
+                        self.queue.put_nowait((payload, failures, submitted))
+                        continue
+                    except Queue.Full:
+                        pass
+                retry_queue.append(entry)
+            self.retry_queue = retry_queue
+            if expired:
+                log.warning("Dropping %s payload%s submitted more than %ss ago" % (
+                    expired, plural(expired), RETRY_MAX_AGE))
+                self.payloads_dropped += expired
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self._post(*item)
+
+    def _post(self, payload, failures, submitted):
+        url, data, headers = payload
+        log.debug("Posting payload to %s" % url)
+        start_time = time()
+        try:
+            r = self.session.post(url, data=data, timeout=HTTP_TIMEOUT, headers=headers)
+        except Exception:
+            log.exception("Unable to post payload.")
+            self._failed(payload, failures + 1, submitted, retry=True)
+            return
+
+        duration = time() - start_time
+        log.debug("%s POST %s (%sms)" % (r.status_code, url, round(duration * 1000.0, 4)))
+        if r.status_code >= 400:
+            log.error("Unable to post payload, received status code: {0}".format(r.status_code))
+            # Client errors would fail the same way if retried
+            self._failed(payload, failures + 1, submitted, retry=r.status_code >= 500)
+            return
+
+        log.debug("Payload accepted")
+        with self.lock:
+            self.payloads_sent += 1
+            self.post_count += 1
+            self.post_duration += duration
+
+    def _failed(self, payload, failures, submitted, retry):
+        with self.lock:
+            self.payloads_failed += 1
+            if not retry:
+                self.payloads_dropped += 1
+                return
+            delay = min(RETRY_MIN_DELAY * 2 ** (failures - 1), RETRY_MAX_DELAY)
+            self._defer((time() + delay, failures, submitted, payload))
+
+    def _defer(self, entry):
+        # Called with the lock held
+        self.retry_queue.append(entry)
+        if len(self.retry_queue) > self.retry_queue_size:
+            log.warning("Retry queue full, dropping the oldest payload")
+            self.retry_queue.pop(0)
+            self.payloads_dropped += 1
+
+    def get_stats(self):
+        """ Payload counts since start, and the average post latency since the last call """
+        with self.lock:
+            post_latency = self.post_duration / self.post_count if self.post_count else 0
+            self.post_count = 0
+            self.post_duration = 0
+            return {
+                'payloads_sent': self.payloads_sent,
+                'payloads_failed': self.payloads_failed,
+                'payloads_dropped': self.payloads_dropped,
+                'retry_queue_length': len(self.retry_queue),
+                'post_latency': post_latency,
+            }
+
+
 class Reporter(threading.Thread):
     """
     The reporter periodically sends the aggregated metrics to the
@@ -84,11 +295,14 @@ class Reporter(threading.Thread):
     """
 
     def __init__(self, interval, metrics_aggregator, api_host, api_key=None,
-                 use_watchdog=False, event_chunk_size=None):
+                 use_watchdog=False, event_chunk_size=None, server=None,
+                 max_payload_size=None):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
         self.metrics_aggregator = metrics_aggregator
+        # Only used to report the receive loop stats
+        self.server = server
         self.flush_count = 0
         self.log_count = 0
 
@@ -100,6 +314,8 @@ class Reporter(threading.Thread):
         self.api_key = api_key
         self.api_host = api_host
         self.event_chunk_size = event_chunk_size or EVENT_CHUNK_SIZE
+        self.max_payload_size = int(max_payload_size or DEFAULT_MAX_PAYLOAD_SIZE)
+        self.sender = PayloadSender()
 
     def stop(self):
         log.info("Stopping reporter")
@@ -113,12 +329,14 @@ class Reporter(threading.Thread):
         # Persist a start-up message.
         DogstatsdStatus().persist()
 
+        self.sender.start()
         while not self.finished.isSet():  # Use camel case isSet for 2.4 support.
             self.finished.wait(self.interval)
             self.metrics_aggregator.send_packet_count('datadog.dogstatsd.packet.count')
             self.flush()
             if self.watchdog:
                 self.watchdog.reset()
+        self.sender.stop()
 
         # Clean up the status messages.
         log.debug("Stopped reporter")
@@ -126,17 +344,29 @@ class Reporter(threading.Thread):
 
     def flush(self):
         try:
+            flush_start_time = time()
             self.flush_count += 1
             self.log_count += 1
+            # Payloads that failed during the last flush go first
+            self.sender.retry()
             packets_per_second = self.metrics_aggregator.packets_per_second(self.interval)
             packet_count = self.metrics_aggregator.total_count
 
-            metrics = self.metrics_aggregator.flush()
+            # Only the swap blocks the packet intake, the retired state is
+            # serialized while packets keep being aggregated.
+            start_time = time()
+            retired = self.metrics_aggregator.swap()
+            swap_duration = time() - start_time
+
+            start_time = time()
+            metrics = self.metrics_aggregator.flush_retired(retired)
             count = len(metrics)
+            serialization_duration = time() - start_time
+
             if self.flush_count % FLUSH_LOGGING_PERIOD == 0:
                 self.log_count = 0
             if count:
-                self.submit(metrics)
+                serialization_duration += self.submit(metrics)
 
             events = self.metrics_aggregator.flush_events()
             event_count = len(events)
@@ -153,11 +383,17 @@ class Reporter(threading.Thread):
             if not should_log:
                 log_func = log.debug
             log_func("Flush #%s: flushed %s metric%s, %s event%s, and %s service check run%s" % (self.flush_count, count, plural(count), event_count, plural(event_count), service_check_count, plural(service_check_count)))
+            log.debug("Flush #%s: swapped in %.2fms, serialized in %.2fms" % (
+                self.flush_count, swap_duration * 1000, serialization_duration * 1000))
             if self.flush_count == FLUSH_LOGGING_INITIAL:
                 log.info("First flushes done, %s flushes will be logged every %s flushes." % (FLUSH_LOGGING_COUNT, FLUSH_LOGGING_PERIOD))
 
             # Persist a status message.
             packet_count = self.metrics_aggregator.total_count
+            server_stats = {}
+            if self.server is not None:
+                server_stats = self.server.get_stats()
+            server_stats.update(self.sender.get_stats())
             DogstatsdStatus(
                 flush_count=self.flush_count,
                 packet_count=packet_count,
@@ -165,6 +401,12 @@ class Reporter(threading.Thread):
                 metric_count=count,
                 event_count=event_count,
                 service_check_count=service_check_count,
+                tags_cache=self.metrics_aggregator.tags_cache_stats(),
+                swap_duration=swap_duration,
+                serialization_duration=serialization_duration,
+                # Payloads are posted by the sender workers, not waited for
+                submit_duration=time() - flush_start_time,
+                **server_stats
             ).persist()
 
         except Exception:
@@ -174,7 +416,19 @@ class Reporter(threading.Thread):
                 log.exception("Error flushing metrics")
 
     def submit(self, metrics):
-        body, headers = serialize_metrics(metrics)
+        """
+        Post the metrics, one payload at a time as soon as it is serialized.
+        Returns the time spent serializing them.
+        """
+        serialization_duration = 0
+        start_time = time()
+        for body, headers in serialize_metrics_chunks(metrics, self.max_payload_size):
+            serialization_duration += time() - start_time
+            self.submit_series(body, headers)
+            start_time = time()
+        return serialization_duration + time() - start_time
+
+    def submit_series(self, body, headers):
         params = {}
         if self.api_key:
             params['api_key'] = self.api_key
@@ -203,24 +457,7 @@ class Reporter(threading.Thread):
 
     def submit_http(self, url, data, headers):
         headers["DD-Dogstatsd-Version"] = get_version()
-        log.debug("Posting payload to %s" % url)
-        try:
-            start_time = time()
-            r = requests.post(url, data=data, timeout=5, headers=headers)
-            r.raise_for_status()
-
-            if r.status_code >= 200 and r.status_code < 205:
-                log.debug("Payload accepted")
-
-            status = r.status_code
-            duration = round((time() - start_time) * 1000.0, 4)
-            log.debug("%s POST %s (%sms)" % (status, url, duration))
-        except Exception:
-            log.exception("Unable to post payload.")
-            try:
-                log.error("Received status code: {0}".format(r.status_code))
-            except Exception:
-                pass
+        self.sender.submit(url, data, headers)
 
     def submit_service_checks(self, service_checks):
         headers = {'Content-Type':'application/json'}
@@ -236,17 +473,29 @@ class Reporter(threading.Thread):
 class Server(object):
     """
     A statsd udp server.
+
+    Every select wakeup drains up to `batch_size` datagrams from the socket.
+    If `queue_size` is set, datagrams are handed over to a parsing thread
+    through a bounded queue, and are dropped (and counted) when it is full.
     """
 
-    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None):
+    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None,
+                 batch_size=None, queue_size=None):
         self.host = host
         self.port = int(port)
         self.address = (self.host, self.port)
         self.metrics_aggregator = metrics_aggregator
         self.buffer_size = 1024 * 8
+        self.batch_size = int(batch_size or DEFAULT_RECV_BATCH_SIZE)
 
         self.running = False
 
+        # Receive queue, only used when a parsing thread is enabled
+        self.queue_size = int(queue_size or 0)
+        self.packet_queue = None
+        self.parser_thread = None
+        self.packets_dropped = 0
+
         self.should_forward = forward_to_host is not None
 
         self.forward_udp_sock = None
@@ -262,12 +511,13 @@ class Server(object):
             except Exception:
                 log.exception("Error while setting up connection to external statsd server")
 
-    def start(self):
-        """ Run the server. """
+    def _bind_socket(self, reuse_port=False):
         # Bind to the UDP socket.
         # IPv4 only
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setblocking(0)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         try:
             self.socket.bind(self.address)
         except socket.gaierror:
@@ -278,11 +528,19 @@ class Server(object):
 
         log.info('Listening on host & port: %s' % str(self.address))
 
+    def start(self):
+        """ Run the server. """
+        self._bind_socket()
+
+        self.running = True
+        submit = self._start_parser()
+
         # Inline variables for quick look-up.
         buffer_size = self.buffer_size
-        aggregator_submit = self.metrics_aggregator.submit_packets
+        batch_range = xrange(self.batch_size)
         sock = [self.socket]
         socket_recv = self.socket.recv
+        socket_error = socket.error
         select_select = select.select
         select_error = select.error
         timeout = UDP_SOCKET_TIMEOUT
@@ -290,26 +548,492 @@ class Server(object):
         forward_udp_sock = self.forward_udp_sock
 
         # Run our select loop.
-        self.running = True
         while self.running:
             try:
                 ready = select_select(sock, [], [], timeout)
                 if ready[0]:
-                    message = socket_recv(buffer_size)
-                    aggregator_submit(message)
+                    # Drain every ready datagram, the socket is non-blocking
+                    for _ in batch_range:
+                        try:
+                            message = socket_recv(buffer_size)
+                        except socket_error, e:
+                            if e.errno in (EAGAIN, EWOULDBLOCK):
+                                break
+                            raise
+                        submit(message)
+
+                        if should_forward:
+                            forward_udp_sock.send(message)
+            except select_error, se:
+                # Ignore interrupted system calls from sigterm.
+                errno = se[0]
+                if errno != 4:
+                    raise
+            except (KeyboardInterrupt, SystemExit):
+                break
+            except Exception:
+                log.exception('Error receiving datagram')
+
+        if self.parser_thread is not None:
+            self.parser_thread.join()
+
+    def _start_parser(self):
+        """ Start the parsing thread if enabled, returns the function submitting datagrams """
+        if not self.queue_size:
+            return self.metrics_aggregator.submit_packets
 
-                    if should_forward:
-                        forward_udp_sock.send(message)
+        log.info("Parsing packets in a separate thread, receive queue size: %s" % self.queue_size)
+        self.packet_queue = Queue.Queue(self.queue_size)
+        self.parser_thread = threading.Thread(target=self._parse_queued_packets,
+                                              name='dogstatsd-parser')
+        self.parser_thread.daemon = True
+        self.parser_thread.start()
+        return self._enqueue_packet
+
+    def _enqueue_packet(self, message):
+        try:
+            self.packet_queue.put_nowait(message)
+        except Queue.Full:
+            self.packets_dropped += 1
+
+    def _parse_queued_packets(self):
+        """ Parsing thread loop, submits queued datagrams to the aggregator. """
+        aggregator_submit = self.metrics_aggregator.submit_packets
+        queue_get = self.packet_queue.get
+        queue_empty = Queue.Empty
+        timeout = UDP_SOCKET_TIMEOUT
+
+        # Keep going until stopped and the queue is drained
+        while self.running or not self.packet_queue.empty():
+            try:
+                message = queue_get(True, timeout)
+            except queue_empty:
+                continue
+            try:
+                aggregator_submit(message)
+            except Exception:
+                log.exception('Error parsing datagram')
+
+    def get_stats(self):
+        return {
+            'packets_dropped': self.packets_dropped,
+            'queue_depth': self.packet_queue.qsize() if self.packet_queue is not None else 0,
+            'queue_size': self.queue_size,
+        }
+
+    def stop(self):
+        self.running = False
+
+
+class ShardServer(Server):
+    """
+    A statsd udp server owning one shard of the metric contexts.
+
+    It shares the dogstatsd port with the other shards through SO_REUSEPORT,
+    sends every metric line to the shard owning its name, and answers the
+    requests of the parent process on `conn`.
+    """
+
+    def __init__(self, metrics_aggregator, host, port, shard_id, shard_sockets, conn,
+                 forward_to_host=None, forward_to_port=None, batch_size=None, queue_size=None):
+        Server.__init__(self, metrics_aggregator, host, port, forward_to_host=forward_to_host,
+                        forward_to_port=forward_to_port, batch_size=batch_size, queue_size=queue_size)
+        self.shard_id = shard_id
+        self.shard_count = len(shard_sockets)
+        self.shard_socket = shard_sockets[shard_id]
+        self.shard_addresses = [s.getsockname() for s in shard_sockets]
+        self.conn = conn
+
+        # Datagrams received on the dogstatsd port / sent to other shards
+        self.packet_count = 0
+        self.forwarded_count = 0
+        # Submits the lines we own, through the receive queue if enabled
+        self.submit = metrics_aggregator.submit_packets
+
+    def _recv_batch(self, sock):
+        messages = []
+        for _ in xrange(self.batch_size):
+            try:
+                messages.append(sock.recv(self.buffer_size))
+            except socket.error, e:
+                if e.errno in (EAGAIN, EWOULDBLOCK):
+                    break
+                raise
+        return messages
+
+    def _route_packets(self, message):
+        """ Submit the lines of `message` we own, send the others to their shard. """
+        shard_id = self.shard_id
+        shard_count = self.shard_count
+        lines_by_shard = {}
+        for line in message.splitlines():
+            if line.startswith('_e') or line.startswith('_sc'):
+                # Events and service checks have no context, keep them
+                shard = shard_id
+            else:
+                shard = (crc32(line.split(':', 1)[0]) & 0xffffffff) % shard_count
+            lines_by_shard.setdefault(shard, []).append(line)
+
+        if len(lines_by_shard) == 1 and shard_id in lines_by_shard:
+            self.submit(message)
+            return
+
+        for shard, lines in lines_by_shard.iteritems():
+            if shard == shard_id:
+                self.submit('\n'.join(lines))
+            else:
+                self.shard_socket.sendto('\n'.join(lines), self.shard_addresses[shard])
+                self.forwarded_count += 1
+
+    def _handle_request(self):
+        request_id, command = self.conn.recv()
+        aggregator = self.metrics_aggregator
+        result = None
+        if command == 'count':
+            result = aggregator.count
+        elif command == 'flush':
+            metrics = aggregator.flush()
+            result = {
+                'metrics': metrics,
+                'events': aggregator.flush_events(),
+                'service_checks': aggregator.flush_service_checks(),
+                'total_count': aggregator.total_count,
+                'tags_cache': aggregator.tags_cache_stats(),
+                'packet_count': self.packet_count,
+                'forwarded_count': self.forwarded_count,
+                'packets_dropped': self.packets_dropped,
+                'queue_depth': self.packet_queue.qsize() if self.packet_queue is not None else 0,
+            }
+            self.packet_count = 0
+            self.forwarded_count = 0
+        elif command == 'stop':
+            self.running = False
+        self.conn.send((request_id, result))
+
+    def start(self):
+        """ Run the shard server. """
+        self._bind_socket(reuse_port=True)
+
+        self.running = True
+        self.submit = self._start_parser()
+
+        # Inline variables for quick look-up.
+        shared_socket = self.socket
+        shard_socket = self.shard_socket
+        conn = self.conn
+        readers = [shared_socket, shard_socket, conn]
+        recv_batch = self._recv_batch
+        route = self._route_packets
+        submit = self.submit
+        select_select = select.select
+        select_error = select.error
+        timeout = UDP_SOCKET_TIMEOUT
+        should_forward = self.should_forward
+        forward_udp_sock = self.forward_udp_sock
+
+        while self.running:
+            try:
+                ready = select_select(readers, [], [], timeout)[0]
+                if shared_socket in ready:
+                    messages = recv_batch(shared_socket)
+                    self.packet_count += len(messages)
+                    for message in messages:
+                        route(message)
+
+                        if should_forward:
+                            forward_udp_sock.send(message)
+                if shard_socket in ready:
+                    for message in recv_batch(shard_socket):
+                        submit(message)
+                if conn in ready:
+                    self._handle_request()
             except select_error, se:
                 # Ignore interrupted system calls from sigterm.
                 errno = se[0]
                 if errno != 4:
                     raise
+            except EOFError:
+                log.warning("Shard %s lost its parent process, stopping" % self.shard_id)
+                break
             except (KeyboardInterrupt, SystemExit):
                 break
             except Exception:
                 log.exception('Error receiving datagram')
 
+        self.running = False
+        if self.parser_thread is not None:
+            self.parser_thread.join()
+
+
+class ShardWorker(multiprocessing.Process):
+    """ A process running a ShardServer. """
+
+    def __init__(self, server):
+        multiprocessing.Process.__init__(self, name='dogstatsd-shard-%s' % server.shard_id)
+        self.server = server
+        self.daemon = True
+
+    def _handle_sigterm(self, signum, frame):
+        self.server.stop()
+
+    def run(self):
+        # The parent process handles interruptions and stops us through our pipe
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+        try:
+            self.server.start()
+        except Exception:
+            log.exception('Error running shard %s' % self.server.shard_id)
+
+
+class ShardedAggregator(object):
+    """
+    Exposes the aggregator interface used by the Reporter on top of the
+    shards, and merges their flushes. Shards own disjoint contexts, so
+    merging is a concatenation.
+    """
+
+    def __init__(self, metrics_aggregator, conns):
+        # Aggregates the metrics submitted by the parent process itself
+        self.metrics_aggregator = metrics_aggregator
+        self.conns = conns
+        self.request_id = 0
+        self.request_lock = threading.Lock()
+
+        self.total_count = 0
+        self.events = []
+        self.service_checks = []
+        self.shard_stats = []
+        self.shard_tags_cache_stats = []
+        self.last_flush_time = time()
+
+        # Packet count fetched from the shards once per flush
+        self.packet_count = None
+        # Commands of the requests shards didn't answer in time, by (shard_id, request_id)
+        self.timed_out_requests = OrderedDict()
+        # Flush answers received after their request timed out, merged in the next flush
+        self.late_flushes = []
+        self.late_flush_count = 0
+        self.lost_flush_count = 0
+
+    def _request(self, command):
+        """ Send `command` to every shard, return the (shard_id, result) answers. """
+        with self.request_lock:
+            self.request_id += 1
+            request_id = self.request_id
+            results = []
+            sent = []
+            for shard_id, conn in enumerate(self.conns):
+                try:
+                    conn.send((request_id, command))
+                except Exception:
+                    log.exception("Unable to send %s request to shard %s" % (command, shard_id))
+                    self._request_lost(command)
+                else:
+                    sent.append((shard_id, conn))
+
+            for shard_id, conn in sent:
+                deadline = time() + SHARD_REQUEST_TIMEOUT
+                try:
+                    while True:
+                        remaining = deadline - time()
+                        if remaining <= 0 or not conn.poll(remaining):
+                            log.warning("Shard %s didn't answer %s request in %ss" %
+                                        (shard_id, command, SHARD_REQUEST_TIMEOUT))
+                            self._request_timed_out(shard_id, request_id, command)
+                            break
+                        answer_id, result = conn.recv()
+                        if answer_id == request_id:
+                            results.append((shard_id, result))
+                            break
+                        self._late_answer(shard_id, answer_id, result)
+                except Exception:
+                    log.exception("Unable to get %s answer from shard %s" % (command, shard_id))
+                    self._request_lost(command)
+            return results
+
+    def _request_timed_out(self, shard_id, request_id, command):
+        self.timed_out_requests[shard_id, request_id] = command
+        # Don't wait forever for the answers of a shard which is stuck
+        while len(self.timed_out_requests) > MAX_TIMED_OUT_REQUESTS:
+            _, command = self.timed_out_requests.popitem(last=False)
+            self._request_lost(command)
+
+    def _request_lost(self, command):
+        if command == 'flush':
+            self.lost_flush_count += 1
+
+    def _late_answer(self, shard_id, answer_id, result):
+        """ Keep the late answers to flush requests, a shard flushed its state to send them """
+        command = self.timed_out_requests.pop((shard_id, answer_id), None)
+        if command == 'flush':
+            log.info("Shard %s answered flush request %s late, merging it with the next flush" %
+                     (shard_id, answer_id))
+            self.late_flushes.append((shard_id, result))
+            self.late_flush_count += 1
+
+    @property
+    def count(self):
+        return sum(count for _, count in self._request('count'))
+
+    def packets_per_second(self, interval):
+        if interval == 0:
+            return 0
+        count = self.packet_count if self.packet_count is not None else self.count
+        return round(float(count)/interval, 2)
+
+    def send_packet_count(self, metric_name):
+        # Each count is a round-trip to every shard, `packets_per_second` reuses it until the flush
+        self.packet_count = self.count
+        self.metrics_aggregator.submit_metric(metric_name, self.packet_count, 'g')
+
+    def flush(self):
+        self.packet_count = None
+        answers = self._request('flush')
+        # Merge the flushes that shards answered too late for the previous requests
+        answers = self.late_flushes + answers
+        self.late_flushes = []
+        now = time()
+        elapsed = max(now - self.last_flush_time, 1)
+        self.last_flush_time = now
+
+        metrics = self.metrics_aggregator.flush()
+        events = []
+        service_checks = []
+        shard_stats = []
+        shard_tags_cache_stats = []
+        total_count = 0
+        for shard_id, answer in answers:
+            metrics += answer['metrics']
+            events += answer['events']
+            service_checks += answer['service_checks']
+            total_count += answer['total_count']
+            shard_tags_cache_stats.append(answer['tags_cache'])
+            shard_stats.append({
+                'shard': shard_id,
+                'packets_per_second': round(answer['packet_count'] / elapsed, 2),
+                'forwarded_per_second': round(answer['forwarded_count'] / elapsed, 2),
+                'metric_count': len(answer['metrics']),
+                'packets_dropped': answer['packets_dropped'],
+                'queue_depth': answer['queue_depth'],
+            })
+
+        self.events += events
+        self.service_checks += service_checks
+        self.shard_stats = shard_stats
+        self.shard_tags_cache_stats = shard_tags_cache_stats
+        if answers:
+            self.total_count = total_count
+        return metrics
+
+    def swap(self):
+        # Shards swap and flush their own state between two receive batches
+        return None
+
+    def flush_retired(self, retired):
+        return self.flush()
+
+    def tags_cache_stats(self):
+        stats = self.metrics_aggregator.tags_cache_stats()
+        for shard_stats in self.shard_tags_cache_stats:
+            for key, value in shard_stats.iteritems():
+                stats[key] += value
+        return stats
+
+    def flush_events(self):
+        events = self.events
+        self.events = []
+        return events
+
+    def flush_service_checks(self):
+        service_checks = self.service_checks
+        self.service_checks = []
+        return service_checks
+
+    def stop_shards(self):
+        self._request('stop')
+
+
+class ShardedServer(object):
+    """
+    Runs `shard_count` ShardServer processes listening on the same port,
+    to use more than one core.
+    """
+
+    def __init__(self, aggregator_factory, host, port, shard_count,
+                 forward_to_host=None, forward_to_port=None, batch_size=None, queue_size=None):
+        # Sockets used by the shards to send each other the lines they don't own
+        shard_sockets = []
+        for _ in xrange(shard_count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(0)
+            sock.bind(('127.0.0.1', 0))
+            shard_sockets.append(sock)
+
+        conns = []
+        self.workers = []
+        for shard_id in xrange(shard_count):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            server = ShardServer(aggregator_factory(), host, port, shard_id, shard_sockets, child_conn,
+                                 forward_to_host=forward_to_host, forward_to_port=forward_to_port,
+                                 batch_size=batch_size, queue_size=queue_size)
+            self.workers.append(ShardWorker(server))
+            conns.append(parent_conn)
+
+        self.port = port
+        self.queue_size = int(queue_size or 0)
+        self.metrics_aggregator = ShardedAggregator(aggregator_factory(), conns)
+        self.shards_started = False
+        self.running = False
+
+    @staticmethod
+    def is_supported():
+        # SO_REUSEPORT load balancing across processes needs Linux >= 3.9
+        return Platform.is_linux()
+
+    def start_shards(self):
+        """
+        Fork the shard processes. It must happen before any thread is started:
+        a process forked while a thread holds a lock, like the ones of logging
+        or requests, would deadlock on it.
+        """
+        if self.shards_started:
+            return
+        for worker in self.workers:
+            worker.start()
+        self.shards_started = True
+        log.info("Started %s dogstatsd shards on port %s" % (len(self.workers), self.port))
+
+    def start(self):
+        """ Run the shards until stopped. """
+        self.start_shards()
+
+        self.running = True
+        while self.running:
+            dead_workers = [w.name for w in self.workers if not w.is_alive()]
+            if dead_workers:
+                log.error("Dogstatsd shards stopped unexpectedly: %s" % ", ".join(dead_workers))
+                break
+            sleep(1)
+
+        self.metrics_aggregator.stop_shards()
+        for worker in self.workers:
+            worker.join(SHARD_REQUEST_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+
+    def get_stats(self):
+        shard_stats = self.metrics_aggregator.shard_stats
+        return {
+            # Every shard has its own receive queue
+            'packets_dropped': sum(s['packets_dropped'] for s in shard_stats),
+            'queue_depth': sum(s['queue_depth'] for s in shard_stats),
+            'queue_size': self.queue_size * len(self.workers),
+            'shards': shard_stats,
+            'shard_late_flushes': self.metrics_aggregator.late_flush_count,
+            'shard_lost_flushes': self.metrics_aggregator.lost_flush_count,
+        }
+
     def stop(self):
         self.running = False
 
@@ -333,6 +1057,10 @@ class Dogstatsd(Daemon):
         # Handle Keyboard Interrupt
         signal.signal(signal.SIGINT, self._handle_sigterm)
 
+        # Fork the shards first, the reporter starts threads
+        if isinstance(self.server, ShardedServer):
+            self.server.start_shards()
+
         # Start the reporting thread before accepting data
         self.reporter.start()
 
@@ -383,6 +1111,10 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     forward_to_port = c.get('statsd_forward_port')
     event_chunk_size = c.get('event_chunk_size')
     recent_point_threshold = c.get('recent_point_threshold', None)
+    recv_batch_size = c.get('dogstatsd_recv_batch_size')
+    recv_queue_size = c.get('dogstatsd_recv_queue_size')
+    shard_count = int(c.get('dogstatsd_shard_count') or 0)
+    max_payload_size = c.get('dogstatsd_max_payload_size')
 
     target = c['dd_url']
     if use_forwarder:
@@ -394,19 +1126,21 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     # server and reporting threads.
     assert 0 < interval
 
-    aggregator = MetricsBucketAggregator(
+    aggregator_factory = partial(
+        MetricsBucketAggregator,
         hostname,
         aggregator_interval,
         recent_point_threshold=recent_point_threshold,
         formatter=get_formatter(c),
         histogram_aggregates=c.get('histogram_aggregates'),
         histogram_percentiles=c.get('histogram_percentiles'),
-        utf8_decoding=c['utf8_decoding']
+        histogram_backend=c.get('histogram_backend'),
+        histogram_sketch_prefixes=c.get('histogram_sketch_prefixes'),
+        histogram_sketch_accuracy=c.get('histogram_sketch_accuracy'),
+        utf8_decoding=c['utf8_decoding'],
+        tags_cache_size=c.get('dogstatsd_tags_cache_size')
     )
 
-    # Start the reporting thread.
-    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size)
-
     # Start the server on an IPv4 stack
     # Default to loopback
     server_host = c['bind_host']
@@ -414,7 +1148,23 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     if non_local_traffic:
         server_host = ''
 
-    server = Server(aggregator, server_host, port, forward_to_host=forward_to_host, forward_to_port=forward_to_port)
+    if shard_count > 1 and not ShardedServer.is_supported():
+        log.warning("Dogstatsd shards are only supported on Linux, running a single process")
+        shard_count = 0
+
+    if shard_count > 1:
+        server = ShardedServer(aggregator_factory, server_host, port, shard_count,
+                               forward_to_host=forward_to_host, forward_to_port=forward_to_port,
+                               batch_size=recv_batch_size, queue_size=recv_queue_size)
+        aggregator = server.metrics_aggregator
+    else:
+        aggregator = aggregator_factory()
+        server = Server(aggregator, server_host, port, forward_to_host=forward_to_host, forward_to_port=forward_to_port,
+                        batch_size=recv_batch_size, queue_size=recv_queue_size)
+
+    # Start the reporting thread.
+    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size,
+                        server=server, max_payload_size=max_payload_size)
 
     return reporter, server, c
 
@@ -1,5 +1,4 @@
 # stdlib
-import copy
 import inspect
 from itertools import product
 import logging
@@ -179,12 +178,11 @@ class AgentCheckTest(unittest.TestCase):
                     setattr(self.check, func_name, mock)
 
         error = None
-        for instance in self.check.instances:
+        for i in xrange(len(self.check.instances)):
             try:
-                # Deepcopy needed to avoid weird duplicate tagging situations
-                # ie the check edits the tags of the instance, problematic if
-                # run twice
-                self.check.check(copy.deepcopy(instance))
+                # Pass the instance the way `AgentCheck.run` does, frozen: checks
+                # editing the tags of their instance get a fresh copy on the next run
+                self.check.check(self.check._get_frozen_instance(i))
                 # FIXME: This should be called within the `run` method only
                 self.check._roll_up_instance_metadata()
             except Exception, e:
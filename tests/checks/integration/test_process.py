@@ -7,6 +7,7 @@ import os
 
 # 3p
 from mock import patch
+from nose.plugins.skip import SkipTest
 import psutil
 
 # project
@@ -232,6 +233,8 @@ class ProcessCheckTest(AgentCheckTest):
         mocks = {
             'find_pids': self.mock_find_pids,
             'psutil_wrapper': self.mock_psutil_wrapper,
+            # Read the stats of the mocked processes with psutil, not from /proc
+            '_use_procfs': False,
         }
 
         config = {
@@ -288,6 +291,52 @@ class ProcessCheckTest(AgentCheckTest):
 
             self.assertMetric('system.processes.cpu.pct', count=1, tags=expected_tags)
 
+    def test_shared_process_snapshot(self):
+        "Processes are listed, and their stats read, once for all the instances"
+        config = {
+            'instances': [
+                {'name': 'py', 'search_string': ['python'], 'exact_match': False},
+                {'name': 'py2', 'search_string': ['python2', 'nosetests'], 'exact_match': False},
+                {'name': 'nothing', 'search_string': ['%s-nothing' % os.getpid()], 'exact_match': False},
+            ]
+        }
+
+        process_iter = psutil.process_iter
+        with patch.object(psutil, 'process_iter', side_effect=process_iter) as mock_iter:
+            self.load_check(config)
+            self.check.run()
+            self.assertEquals(mock_iter.call_count, 1)
+
+            # Runs share a snapshot, not the next ones
+            self.check.last_pid_cache_ts = {}
+            self.check.run()
+            self.assertEquals(mock_iter.call_count, 2)
+
+        pid_cache = self.check.pid_cache
+        self.assertTrue(os.getpid() in pid_cache['py'])
+        self.assertEquals(pid_cache['nothing'], set())
+        # Stats are read once per process, for the processes of all the instances
+        self.assertEquals(set(self.check._process_stats), pid_cache['py'] | pid_cache['py2'])
+
+    def test_procfs_stats(self):
+        "Stats read from /proc are the ones psutil reads"
+        config = {'instances': [{'name': 'py', 'search_string': ['python']}]}
+        self.load_check(config)
+        if not self.check._use_procfs:
+            raise SkipTest("/proc is not available")
+
+        pid = os.getpid()
+        process = psutil.Process(pid)
+        stats = self.check._read_procfs_stats(pid)
+        self.assertEquals(stats['vms'], process.memory_info().vms)
+        self.assertEquals(stats['thr'], process.num_threads())
+        self.assertEquals(stats['open_fd'], process.num_fds())
+        self.assertEquals(stats['ctx_swtch_vol'], process.num_ctx_switches().voluntary)
+        self.assertFalse('cpu' in stats)
+
+        # The CPU usage is computed from the second sample on
+        self.assertTrue(self.check._read_procfs_stats(pid)['cpu'] >= 0)
+
     def test_check_real_process(self):
         "Check that we detect python running (at least this process)"
         config = {
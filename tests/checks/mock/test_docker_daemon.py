@@ -0,0 +1,154 @@
+# stdlib
+import os
+import shutil
+import tempfile
+
+# 3p
+import mock
+
+# project
+from tests.checks.common import AgentCheckTest
+
+CGROUPS = {
+    'memory': ('memory.stat', "cache 4096\nrss 8192\nswap 0\nhierarchical_memory_limit 1073741824\n"),
+    'cpuacct': ('cpuacct.stat', "user 1000\nsystem 500\n"),
+    'blkio': ('blkio.throttle.io_service_bytes', "8:0 Read 1024\n8:0 Write 2048\n8:0 Total 3072\nTotal 3072\n"),
+}
+
+NET_DEV = """Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+  eth0:    1296      16    0    0    0     0          0         0      648       8    0    0    0     0       0          0
+"""
+
+
+def container_id(index):
+    return '%064x' % (index + 1)
+
+
+def make_container_tree(root, pids_by_container, host_pids):
+    """
+    Create a synthetic `/proc` and cgroup tree in `root` for the containers
+    of `pids_by_container` and for `host_pids`, processes outside of them.
+    Returns the mountpoints of the cgroups.
+    """
+    mountpoints = {}
+    for cgroup, (filename, content) in CGROUPS.iteritems():
+        mountpoints[cgroup] = os.path.join(root, 'cgroup', cgroup)
+        for _id in pids_by_container:
+            os.makedirs(os.path.join(mountpoints[cgroup], 'docker', _id))
+            with open(os.path.join(mountpoints[cgroup], 'docker', _id, filename), 'w') as f:
+                f.write(content)
+
+    processes = [(pid, '/') for pid in host_pids]
+    for _id, pids in pids_by_container.iteritems():
+        processes.extend((pid, '/docker/%s' % _id) for pid in pids)
+    for pid, path in sorted(processes):
+        proc_root = os.path.join(root, 'proc', str(pid))
+        os.makedirs(os.path.join(proc_root, 'net'))
+        with open(os.path.join(proc_root, 'cgroup'), 'w') as f:
+            f.write("5:memory:%s\n4:cpu,cpuacct:%s\n3:blkio:%s\n" % (path, path, path))
+        with open(os.path.join(proc_root, 'net', 'dev'), 'w') as f:
+            f.write(NET_DEV)
+
+    return mountpoints
+
+
+def make_container(_id, name, status='Up 2 minutes'):
+    return {
+        'Id': _id,
+        'Names': ['/%s' % name],
+        'Image': 'redis:latest',
+        'Command': 'redis-server',
+        'Status': status,
+        'Labels': {},
+    }
+
+
+class TestCheckDockerDaemonIndex(AgentCheckTest):
+    CHECK_NAME = 'docker_daemon'
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.ids = [container_id(0), container_id(1)]
+        self.mountpoints = make_container_tree(
+            self.root, {self.ids[0]: [100, 101], self.ids[1]: [200]}, [1, 2, 3])
+
+        self.client = mock.MagicMock()
+        self.client.containers.return_value = [make_container(self.ids[0], 'redis'), make_container(self.ids[1], 'db')]
+        self.client.events.return_value = []
+
+        # Add checks.d to the path to be able to patch the check module
+        self.load_class('DockerDaemon')
+        config = {
+            'init_config': {'docker_root': self.root},
+            'instances': [{'url': 'unix://var/run/docker.sock'}],
+        }
+        with mock.patch('docker_daemon.get_client', return_value=self.client):
+            with mock.patch('docker_daemon.get_mountpoints', return_value=self.mountpoints):
+                self.load_check(config)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_container_index(self):
+        self.run_check({})
+        self.assertMetric('docker.mem.rss', value=8192, tags=['container_name:redis', 'docker_image:redis:latest',
+                                                              'image_name:redis', 'image_tag:latest'])
+        self.assertMetric('docker.mem.rss', count=2)
+        self.assertEquals(self.check._container_pids, {self.ids[0]: '100', self.ids[1]: '200'})
+        self.assertEquals(set(self.check._cgroup_filename_patterns), set(self.ids))
+
+        # Known PIDs and cgroup directories are reused, `/proc` isn't crawled again
+        with mock.patch('docker_daemon.os.listdir', side_effect=os.listdir) as listdir:
+            with mock.patch('docker_daemon.find_cgroup_filename_pattern') as find_pattern:
+                self.run_check({})
+        self.assertFalse(listdir.called)
+        self.assertFalse(find_pattern.called)
+        self.assertMetric('docker.mem.rss', count=2)
+
+        # A PID which isn't in its container anymore is replaced
+        shutil.rmtree(os.path.join(self.root, 'proc', '100'))
+        self.run_check({})
+        self.assertEquals(self.check._container_pids, {self.ids[0]: '101', self.ids[1]: '200'})
+
+        # Containers are forgotten once stopped or gone
+        self.client.containers.return_value = [make_container(self.ids[0], 'redis', status='Exited (0) 1 second ago')]
+        self.run_check({})
+        self.assertEquals(self.check._container_pids, {})
+        self.assertEquals(set(self.check._cgroup_filename_patterns), set([self.ids[0]]))
+
+    def test_container_events(self):
+        self.run_check({})
+
+        # A restarted container is looked for again, even if its processes weren't found before
+        self.check._unresolved_containers[self.ids[0]] = 0
+        self.client.events.return_value = [
+            {'status': 'restart', 'id': self.ids[0], 'from': 'redis:latest', 'time': 1},
+            {'status': 'exec_start', 'id': self.ids[1], 'from': 'redis:latest', 'time': 1},
+        ]
+        self.check._process_events({})
+        self.assertEquals(self.check._container_pids, {self.ids[1]: '200'})
+        self.assertEquals(self.check._unresolved_containers, {})
+
+    def test_unresolved_containers(self):
+        from docker_daemon import UNRESOLVED_CONTAINER_RETRY_RUNS
+
+        # The processes of the container aren't visible yet
+        proc_path = os.path.join(self.root, 'proc', '200')
+        shutil.move(proc_path, proc_path + '.hidden')
+        self.run_check({})
+        self.assertEquals(self.check._container_pids, {self.ids[0]: '100'})
+        self.assertEquals(self.check._unresolved_containers, {self.ids[1]: 0})
+
+        # They aren't looked for at every run
+        shutil.move(proc_path + '.hidden', proc_path)
+        with mock.patch('docker_daemon.os.listdir', side_effect=os.listdir) as listdir:
+            for _ in xrange(UNRESOLVED_CONTAINER_RETRY_RUNS - 1):
+                self.run_check({})
+        self.assertFalse(listdir.called)
+        self.assertEquals(self.check._container_pids, {self.ids[0]: '100'})
+
+        # But they are again after a few runs
+        self.run_check({})
+        self.assertEquals(self.check._container_pids, {self.ids[0]: '100', self.ids[1]: '200'})
+        self.assertEquals(self.check._unresolved_containers, {})
@@ -1,8 +1,12 @@
+# stdlib
+import os
+
 # 3p
 import mock
 
 # project
 from tests.checks.common import AgentCheckTest, Fixtures
+from utils.procfs import count_socket_states
 
 
 def ss_subprocess_mock(*args, **kwargs):
@@ -47,6 +51,26 @@ class TestCheckNetwork(AgentCheckTest):
         'system.net.tcp6.time_wait': 1,
     }
 
+    @mock.patch('network.get_subprocess_output')
+    @mock.patch('network.Platform.is_linux', return_value=True)
+    def test_cx_state_linux_procfs(self, mock_platform, mock_subprocess):
+        with mock.patch('network.PROCFS_PATH', os.path.join(Fixtures.directory(), 'proc')):
+            self.run_check({})
+
+        # Connection states are read from /proc/net, without running `ss` or `netstat`
+        self.assertFalse(mock_subprocess.called)
+        for metric, value in self.CX_STATE_GAUGES_VALUES.iteritems():
+            self.assertMetric(metric, value=value)
+
+    def test_count_socket_states(self):
+        path = os.path.join(Fixtures.directory(), 'proc', 'net', 'tcp')
+        expected = {'01': 1, '06': 2, '0A': 2}
+        self.assertEquals(count_socket_states(path), expected)
+        # Sockets split between two reads are counted once
+        for chunk_size in (1, 7, 100):
+            self.assertEquals(count_socket_states(path, chunk_size=chunk_size), expected)
+
+    @mock.patch('network.PROCFS_PATH', '/nonexistent')
     @mock.patch('network.get_subprocess_output', side_effect=ss_subprocess_mock)
     @mock.patch('network.Platform.is_linux', return_value=True)
     def test_cx_state_linux_ss(self, mock_subprocess, mock_platform):
@@ -56,6 +80,7 @@ class TestCheckNetwork(AgentCheckTest):
         for metric, value in self.CX_STATE_GAUGES_VALUES.iteritems():
             self.assertMetric(metric, value=value)
 
+    @mock.patch('network.PROCFS_PATH', '/nonexistent')
     @mock.patch('network.get_subprocess_output', side_effect=netstat_subprocess_mock)
     @mock.patch('network.Platform.is_linux', return_value=True)
     def test_cx_state_linux_netstat(self, mock_subprocess, mock_platform):
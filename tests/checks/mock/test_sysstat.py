@@ -13,6 +13,7 @@ from checks.system.common import System
 from config import get_system_stats
 from tests.checks.common import get_check
 from utils.platform import Platform
+from utils.procfs import DiskStats
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__file__)
@@ -125,6 +126,42 @@ sda               0.00     0.00  0.00  0.00     0.00     0.00     0.00     0.00
             {'system.io.bytes_per_s': float(0),}
         )
 
+    def testDiskstats(self):
+        previous = {'sda': DiskStats(100, 10, 2000, 300, 50, 5, 1000, 200, 0, 400, 500)}
+        # 2 seconds later
+        current = {
+            'sda': DiskStats(110, 12, 2400, 340, 60, 9, 1800, 260, 1, 900, 1700),
+            'sdb': DiskStats(1, 0, 8, 1, 0, 0, 0, 0, 0, 1, 1),
+        }
+
+        results = IO._compute_iostats(previous, current, 2)
+        # Devices are reported from their second sample on
+        self.assertEquals(results.keys(), ['sda'])
+        self.assertEquals(results['sda'], {
+            'rrqm/s': '1.00',
+            'wrqm/s': '2.00',
+            'r/s': '5.00',
+            'w/s': '5.00',
+            'rkB/s': '100.00',
+            'wkB/s': '200.00',
+            'avgrq-sz': '60.00',
+            'avgqu-sz': '0.60',
+            'await': '5.00',
+            'r_await': '4.00',
+            'w_await': '6.00',
+            'svctm': '25.00',
+            '%util': '25.00',
+        })
+
+        # Wrapped counters are skipped
+        self.assertEquals(IO._compute_iostats(current, previous, 2), {})
+
+        if Platform.is_linux():
+            checker = IO(logger)
+            self.assertEquals(checker.check({}), {})
+            for stats in checker.check({}).itervalues():
+                self.assertTrue('%util' in stats)
+
     def testNetwork(self):
         # FIXME: cx_state to true, but needs sysstat installed
         config = """
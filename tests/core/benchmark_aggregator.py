@@ -2,7 +2,17 @@
 """
 Performance tests for the agent/dogstatsd metrics aggregator.
 """
-from aggregator import MetricsAggregator, MetricsBucketAggregator
+# stdlib
+import gc
+import random
+import sys
+from time import sleep, time
+
+# 3p
+import psutil
+
+# project
+from aggregator import MetricsAggregator, MetricsBucketAggregator, SketchSamples
 
 
 class TestAggregatorPerf(object):
@@ -11,6 +21,39 @@ class TestAggregatorPerf(object):
     LOOPS_PER_FLUSH = 2000
     METRIC_COUNT = 5
 
+    PACKET_FORMATS = [
+        'counter.%s:%s|c',
+        'gauge.%s:%s|g',
+        'histogram.%s:%s|h',
+        'counter.%s:%s|c|#tag1,tag2',
+        'gauge.%s:%s|g|#env:prod,role:web',
+        'histogram.%s:%s|h|@0.5|#env:prod,host:foo,device:sda',
+        'counter.%s:%s|c|@0.5',
+        'set.%s:%s|s',
+    ]
+
+    def test_dogstatsd_parsing_perf(self):
+        ma = MetricsBucketAggregator('my.host')
+        packets = [
+            p % (j, i)
+            for i in xrange(self.LOOPS_PER_FLUSH)
+            for j in xrange(self.METRIC_COUNT)
+            for p in self.PACKET_FORMATS
+        ]
+
+        start = time()
+        for packet in packets:
+            ma.parse_metric_packet(packet)
+        parse_duration = time() - start
+
+        start = time()
+        for packet in packets:
+            ma.submit_packets(packet)
+        submit_duration = time() - start
+
+        print "parse_metric_packet: %d packets/s" % (len(packets) / parse_duration)
+        print "submit_packets: %d packets/s" % (len(packets) / submit_duration)
+
     def test_dogstatsd_aggregation_perf(self):
         ma = MetricsBucketAggregator('my.host')
 
@@ -38,6 +81,96 @@ class TestAggregatorPerf(object):
 
             ma.flush()
 
+    @staticmethod
+    def _samples_size(samples):
+        """ Approximate memory used by histogram samples, in bytes """
+        if isinstance(samples, SketchSamples):
+            return sys.getsizeof(samples) + sum(
+                sys.getsizeof(bins) + len(bins) * 2 * sys.getsizeof(0)
+                for bins in (samples.positive_bins, samples.negative_bins)
+            )
+        return sys.getsizeof(samples) + len(samples) * sys.getsizeof(0.0)
+
+    def test_histogram_backends_perf(self):
+        # One hot timer sampled 20k times per second, flushed every 10s
+        sample_count = 200000
+        values = [random.expovariate(1 / 50.0) for _ in xrange(sample_count)]
+        for backend in ['exact', 'sketch']:
+            ma = MetricsAggregator('my.host', histogram_backend=backend,
+                                   histogram_percentiles=[0.5, 0.95, 0.99])
+            start = time()
+            for value in values:
+                ma.histogram('timer', value)
+            sample_duration = time() - start
+
+            samples = ma.metrics.values()[0].samples
+            size = self._samples_size(samples)
+
+            start = time()
+            ma.flush()
+            flush_duration = time() - start
+
+            print "%s backend: %d samples/s, %.1f KB of samples, flush in %.1f ms" % (
+                backend, sample_count / sample_duration, size / 1024.0, flush_duration * 1000)
+
+    def _context_size(self, context_count):
+        """ Resident memory used per context by the aggregator, in bytes """
+        ma = MetricsBucketAggregator('my.host', tags_cache_size=context_count)
+        packet_formats = ['metric.%s:1|c|#shard:%s', 'metric.%s:1|g|#shard:%s',
+                          'metric.%s:1|h|#shard:%s', 'metric.%s:1|s|#shard:%s']
+        packets = [
+            packet_formats[i % len(packet_formats)] % (i % 1000, i // 1000)
+            for i in xrange(context_count)
+        ]
+        process = psutil.Process()
+
+        gc.collect()
+        rss = process.memory_info().rss
+        for packet in packets:
+            ma.submit_packets(packet)
+        gc.collect()
+        return (process.memory_info().rss - rss) / context_count
+
+    def test_context_memory_perf(self):
+        for context_count in [100000, 1000000]:
+            print "%d contexts: %d bytes/context" % (
+                context_count, self._context_size(context_count))
+
+    def test_idle_contexts_flush_perf(self):
+        # Most contexts are idle, a few are sampled between each flush
+        context_count = 100000
+        ma = MetricsAggregator('my.host')
+        for i in xrange(context_count):
+            ma.gauge('gauge.%s' % (i % 1000), 1, tags=['shard:%s' % (i // 1000)])
+        ma.flush()
+
+        start = time()
+        for _ in xrange(self.FLUSH_COUNT):
+            for j in xrange(self.METRIC_COUNT):
+                ma.gauge('gauge.%s' % j, 1)
+            ma.flush()
+        print "%.2f ms/flush with %d idle contexts" % (
+            (time() - start) * 1000 / self.FLUSH_COUNT, context_count)
+
+    def test_dogstatsd_swap_perf(self):
+        # Only the swap holds the intake lock, not the serialization
+        ma = MetricsBucketAggregator('my.host', interval=1)
+        for i in xrange(100000):
+            ma.submit_packets('histogram.%s:%s|h|#shard:%s' % (i % 1000, i, i // 1000))
+        while ma.calculate_bucket_start(time()) <= ma.current_bucket:
+            sleep(0.1)
+
+        start = time()
+        retired = ma.swap()
+        swap_duration = time() - start
+
+        start = time()
+        metrics = ma.flush_retired(retired)
+        serialization_duration = time() - start
+
+        print "%d metrics: swap in %.2f ms, serialization in %.2f ms" % (
+            len(metrics), swap_duration * 1000, serialization_duration * 1000)
+
     def test_checksd_aggregation_perf(self):
         ma = MetricsAggregator('my.host')
 
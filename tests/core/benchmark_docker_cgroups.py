@@ -0,0 +1,92 @@
+"""
+Performance tests for the container index of the Docker check, on a synthetic
+`/proc` and cgroup tree.
+"""
+# stdlib
+import __builtin__
+import os
+import shutil
+import tempfile
+from time import time
+
+# 3p
+import mock
+
+# project
+from tests.checks.common import load_check, load_class
+from tests.checks.mock.test_docker_daemon import container_id, make_container, make_container_tree
+
+
+class TestDockerCgroupsPerf(object):
+
+    CONTAINER_COUNT = 300
+    PROCESS_COUNT = 20000
+    RUNS = 5
+
+    def setUp(self):
+        # Build the tree on tmpfs when possible, so that only the reading is measured
+        self.root = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+        ids = [container_id(i) for i in xrange(self.CONTAINER_COUNT)]
+        # Spread the processes of the containers among the others, like on a real host
+        step = self.PROCESS_COUNT / self.CONTAINER_COUNT
+        pids_by_container = dict((_id, [i * step + 1, i * step + 2]) for i, _id in enumerate(ids))
+        container_pids = set(pid for pids in pids_by_container.itervalues() for pid in pids)
+        host_pids = [pid for pid in xrange(1, self.PROCESS_COUNT + 1) if pid not in container_pids]
+        mountpoints = make_container_tree(self.root, pids_by_container, host_pids)
+
+        client = mock.MagicMock()
+        client.containers.return_value = [make_container(_id, 'container-%d' % i) for i, _id in enumerate(ids)]
+        client.events.return_value = []
+
+        load_class('docker_daemon', 'DockerDaemon')
+        config = {
+            'init_config': {'docker_root': self.root},
+            'instances': [{'url': 'unix://var/run/docker.sock'}],
+        }
+        with mock.patch('docker_daemon.get_client', return_value=client):
+            with mock.patch('docker_daemon.get_mountpoints', return_value=mountpoints):
+                self.check = load_check('docker_daemon', config, {'version': '0.1', 'api_key': 'toto'})
+        self.instance = self.check.instances[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _forget_index(self):
+        """ Make the next run look for every container, like before the index """
+        self.check._cgroup_filename_patterns.clear()
+        self.check._container_pids.clear()
+        self.check._unresolved_containers.clear()
+
+    def _measure(self, before_run=None):
+        """ Returns how long a run takes on average, and how many files it opens, lists or stats """
+        calls = [0]
+
+        def counting(function):
+            def counting_function(*args, **kwargs):
+                calls[0] += 1
+                return function(*args, **kwargs)
+            return counting_function
+
+        duration = 0
+        with mock.patch.object(__builtin__, 'open', counting(__builtin__.open)):
+            with mock.patch.object(os, 'open', counting(os.open)):
+                with mock.patch.object(os, 'listdir', counting(os.listdir)):
+                    with mock.patch.object(os.path, 'exists', counting(os.path.exists)):
+                        for _ in xrange(self.RUNS):
+                            if before_run is not None:
+                                before_run()
+                            start = time()
+                            self.check.check(self.instance)
+                            duration += time() - start
+                            self.check.get_metrics()
+
+        return duration / self.RUNS, calls[0] / self.RUNS
+
+    def test_container_index_perf(self):
+        cold_duration, cold_calls = self._measure(before_run=self._forget_index)
+        indexed_duration, indexed_calls = self._measure()
+
+        print "%d containers, %d processes: without index %.1fms, %d calls, with index %.1fms, %d calls" % (
+            self.CONTAINER_COUNT, self.PROCESS_COUNT, cold_duration * 1000, cold_calls,
+            indexed_duration * 1000, indexed_calls)
@@ -0,0 +1,86 @@
+"""
+Performance tests for reading the stats of processes from /proc.
+"""
+# stdlib
+import __builtin__
+from itertools import cycle, islice
+import os
+from time import time
+
+# 3p
+from mock import patch
+from nose.plugins.skip import SkipTest
+import psutil
+
+# project
+from utils.platform import Platform
+from utils.procfs import is_procfs_available, read_process_stats
+
+
+def read_psutil_stats(process):
+    """ The stats of a process, read the way ProcessCheck reads them with psutil """
+    process.is_running()
+    process.memory_info()
+    process.memory_info_ex()
+    process.num_ctx_switches()
+    process.num_threads()
+    process.cpu_percent()
+    process.num_fds()
+    try:
+        process.io_counters()
+    except psutil.AccessDenied:
+        pass
+
+
+class TestProcfsPerf(object):
+
+    PID_COUNT = 1000
+
+    def _count_syscalls(self, func):
+        """ Returns how long `func` takes, and how many files it opens or lists """
+        calls = [0]
+
+        def counting(function):
+            def counting_function(*args, **kwargs):
+                calls[0] += 1
+                return function(*args, **kwargs)
+            return counting_function
+
+        with patch.object(__builtin__, 'open', counting(__builtin__.open)):
+            with patch.object(os, 'open', counting(os.open)):
+                with patch.object(os, 'listdir', counting(os.listdir)):
+                    func()
+
+        start = time()
+        func()
+        return time() - start, calls[0]
+
+    def test_process_stats_perf(self):
+        if not Platform.is_linux() or not is_procfs_available():
+            raise SkipTest("/proc is not available")
+
+        # Processes we can read, cycled over to get PID_COUNT of them
+        processes = []
+        for process in psutil.process_iter():
+            try:
+                read_psutil_stats(process)
+                read_process_stats(process.pid)
+            except (psutil.Error, IOError, OSError):
+                continue
+            processes.append(process)
+        processes = list(islice(cycle(processes), self.PID_COUNT))
+
+        def psutil_reads():
+            for process in processes:
+                read_psutil_stats(process)
+
+        def procfs_reads():
+            for process in processes:
+                read_process_stats(process.pid)
+
+        psutil_duration, psutil_calls = self._count_syscalls(psutil_reads)
+        procfs_duration, procfs_calls = self._count_syscalls(procfs_reads)
+
+        print "%d processes: psutil %.1fms, %d files read, /proc %.1fms, %d files read" % (
+            self.PID_COUNT, psutil_duration * 1000, psutil_calls,
+            procfs_duration * 1000, procfs_calls)
@@ -0,0 +1,67 @@
+"""
+Performance tests for the forwarder transaction manager.
+"""
+# stdlib
+from datetime import timedelta
+from time import time
+
+# project
+from transaction import Transaction, TransactionManager
+
+
+class benchTransaction(Transaction):
+    def __init__(self, size, manager):
+        Transaction.__init__(self)
+        self._trManager = manager
+        self._size = size
+        self.is_flushable = False
+
+    def flush(self):
+        if self.is_flushable:
+            self._trManager.tr_success(self)
+        else:
+            self._trManager.tr_error(self)
+
+
+class TestTransactionManagerPerf(object):
+
+    TRANSACTION_COUNT = 100000
+    FLUSH_COUNT = 10
+
+    def test_queued_transactions_perf(self):
+        # A backlog of retries during an intake outage
+        trManager = TransactionManager(timedelta(seconds=90), self.TRANSACTION_COUNT)
+        transactions = [benchTransaction(1, trManager) for _ in xrange(self.TRANSACTION_COUNT)]
+
+        start = time()
+        for tr in transactions:
+            trManager.append(tr)
+        append_duration = time() - start
+
+        # Every transaction fails once, and is rescheduled later
+        start = time()
+        for tr in transactions:
+            trManager.tr_error(tr)
+        error_duration = time() - start
+
+        # Nothing is due: flushes should not depend on the queue length
+        trManager.flush()
+        start = time()
+        for _ in xrange(self.FLUSH_COUNT):
+            trManager.flush()
+        flush_duration = (time() - start) / self.FLUSH_COUNT
+
+        # The queue is full, every new transaction drops the one scheduled the latest
+        start = time()
+        for _ in xrange(1000):
+            trManager.append(benchTransaction(1, trManager))
+        overflow_duration = time() - start
+
+        start = time()
+        for tr in trManager.get_transactions():
+            trManager.tr_success(tr)
+        success_duration = time() - start
+
+        print "%d transactions: append %.2fs, error %.2fs, flush %.2fms, overflow %.3fs, success %.2fs" % (
+            self.TRANSACTION_COUNT, append_duration, error_duration, flush_duration * 1000,
+            overflow_duration, success_duration)
@@ -1,9 +1,16 @@
 # stdlib
+import copy
 import logging
 import os
+import shutil
+import tempfile
 import time
 import unittest
 
+# 3p
+from nose.plugins.skip import SkipTest
+import yaml
+
 # project
 from aggregator import MetricsAggregator
 from checks import (
@@ -13,8 +20,9 @@ from checks import (
     Infinity,
     UnknownValue,
 )
-from checks.collector import Collector
-from tests.checks.common import load_check
+from checks.collector import CheckScheduler, Collector
+from config import DeferredCheck
+from tests.checks.common import get_check_class, load_check
 from util import get_hostname
 from utils.ntp import get_ntp_args
 from utils.proxy import get_proxy
@@ -179,6 +187,157 @@ class TestCore(unittest.TestCase):
             tag = "check:%s" % check.name
             assert tag in all_tags, all_tags
 
+    def test_deferred_checks(self):
+        agentConfig = {
+            'api_key': 'test_apikey',
+            'collect_ec2_tags': False,
+            'collect_instance_metadata': False,
+            'create_dd_check_tags': False,
+            'version': 'test',
+            'tags': '',
+        }
+        checksd_path = tempfile.mkdtemp()
+        try:
+            check_path = os.path.join(checksd_path, 'deferred.py')
+            with open(check_path, 'w') as f:
+                f.write("from checks import AgentCheck\n"
+                        "class DeferredTestCheck(AgentCheck):\n"
+                        "    def check(self, instance):\n"
+                        "        self.gauge('test.deferred', instance['value'])\n")
+            missing_path = os.path.join(checksd_path, 'missing.py')
+            config = {'init_config': {}, 'instances': [{'value': 1}]}
+            checksd = {
+                'initialized_checks': [
+                    DeferredCheck('deferred', check_path, config, agentConfig),
+                    DeferredCheck('missing', missing_path, config, agentConfig),
+                ],
+                'init_failed_checks': {},
+                'load_times': [('parse_configs', 0.1)],
+            }
+
+            c = Collector(agentConfig, [], {}, get_hostname(agentConfig))
+            payload = c.run(checksd)
+        finally:
+            shutil.rmtree(checksd_path)
+
+        # Checks are imported on their first run, the ones that can't be are reported as failed
+        self.assertTrue('test.deferred' in [m[0] for m in payload['metrics']])
+        self.assertEquals([check.name for check in checksd['initialized_checks']], ['deferred'])
+        self.assertTrue(isinstance(checksd['initialized_checks'][0], AgentCheck))
+        self.assertEquals(checksd['init_failed_checks'].keys(), ['missing'])
+        self.assertEquals([phase for phase, _ in c._startup_phases],
+                          ['parse_configs', 'import_checks', 'first_run'])
+
+        # Next runs don't report the startup phases again
+        c.run(checksd)
+        self.assertEquals(len(c._startup_phases), 3)
+
+        # Checks that a reload replaced are stopped
+        stopped = []
+        checksd['initialized_checks'][0].stop = lambda: stopped.append(True)
+        c.run({'initialized_checks': [], 'init_failed_checks': {}})
+        self.assertEquals(stopped, [True])
+
+    def test_check_runners(self):
+        agentConfig = {
+            'api_key': 'test_apikey',
+            'check_timings': True,
+            'check_runners': 2,
+            'check_timeout': 1,
+            'collect_ec2_tags': False,
+            'collect_instance_metadata': False,
+            'create_dd_check_tags': False,
+            'version': 'test',
+            'tags': '',
+        }
+
+        class SleepCheck(AgentCheck):
+            def check(self, instance):
+                time.sleep(instance['sleep'])
+                self.gauge('test.%s' % self.name, 1)
+
+        checks = [
+            SleepCheck('fast', {}, agentConfig, [{'sleep': 0}]),
+            SleepCheck('slow', {}, agentConfig, [{'sleep': 3}]),
+            # Checks can have their own timeout
+            SleepCheck('patient', {'check_timeout': 5}, agentConfig, [{'sleep': 1.5}]),
+        ]
+
+        c = Collector(agentConfig, [], {}, get_hostname(agentConfig))
+        start = time.time()
+        payload = c.run({
+            'initialized_checks': checks,
+            'init_failed_checks': {}
+        })
+        # Checks ran concurrently, the slow one was not waited for
+        self.assertTrue(time.time() - start < 3)
+
+        metric_names = [m[0] for m in payload['metrics']]
+        self.assertTrue('test.fast' in metric_names)
+        self.assertTrue('test.patient' in metric_names)
+        self.assertFalse('test.slow' in metric_names)
+        self.assertTrue('datadog.agent.check_queue_time' in metric_names)
+
+        def check_statuses(payload):
+            return dict((sc['tags'][0], sc) for sc in payload['service_checks']
+                        if sc['check'] == 'datadog.agent.check_status')
+
+        statuses = check_statuses(payload)
+        self.assertEquals(statuses['check:fast']['status'], AgentCheck.OK)
+        self.assertEquals(statuses['check:patient']['status'], AgentCheck.OK)
+        self.assertEquals(statuses['check:slow']['status'], AgentCheck.CRITICAL)
+
+        # The slow check is not run again while it's still running
+        payload = c.run({
+            'initialized_checks': checks,
+            'init_failed_checks': {}
+        })
+        statuses = check_statuses(payload)
+        self.assertEquals(statuses['check:slow']['status'], AgentCheck.CRITICAL)
+        self.assertTrue('still running' in statuses['check:slow']['message'])
+        self.assertEquals(statuses['check:fast']['status'], AgentCheck.OK)
+
+    def test_check_scheduler(self):
+        agentConfig = {'checksd_hostname': 'foo'}
+        cheap = AgentCheck('cheap', {}, agentConfig, [{}])
+        expensive = AgentCheck('expensive', {'min_collection_interval': 300}, agentConfig,
+                               [{}, {'min_collection_interval': 60}])
+
+        scheduler = CheckScheduler(15)
+        start = 1500000000
+        scheduler.sync([cheap, expensive], start)
+        # Every instance runs right away
+        self.assertEquals(scheduler.pop_due(start),
+                          [(cheap, [0], start), (expensive, [0, 1], start)])
+        self.assertEquals(scheduler.pop_due(start), [])
+
+        runs = {}
+        for now in xrange(start + 15, start + 1200 + 15, 15):
+            for check, instance_ids, due in scheduler.pop_due(now):
+                self.assertEquals(due, now)
+                for i in instance_ids:
+                    runs.setdefault((check.name, i), []).append(now)
+
+        self.assertEquals(len(runs[('cheap', 0)]), 80)
+        self.assertEquals(len(runs[('expensive', 0)]), 4)
+        self.assertEquals(len(runs[('expensive', 1)]), 20)
+        # Runs are aligned on their interval, shifted by the same number of ticks
+        offsets = set(t % 300 for t in runs[('expensive', 0)])
+        self.assertEquals(len(offsets), 1)
+        self.assertEquals(offsets.pop() % 15, 0)
+
+        # A late collection runs what is due once, and reports when it was due
+        due_time = scheduler.get_next_run()
+        late = scheduler.pop_due(due_time + 100)
+        self.assertEquals(min(due for _, _, due in late), due_time)
+        self.assertTrue(scheduler.get_next_run() > due_time + 100)
+
+        # Rescheduling keeps the schedule of the checks already scheduled
+        other = AgentCheck('other', {}, agentConfig, [{}])
+        now = scheduler.get_next_run() - 10
+        scheduler.sync([cheap, expensive, other], now)
+        self.assertEquals(scheduler.pop_due(now), [(other, [0], now)])
+
     def test_apptags(self):
         '''
         Tests that the app tags are sent if specified so
@@ -336,6 +495,53 @@ class TestCore(unittest.TestCase):
         metrics = check.get_metrics()
         self.assertTrue(len(metrics) > 0, metrics)
 
+    def test_frozen_instances(self):
+        class TagCheck(AgentCheck):
+            def check(self, instance):
+                self.seen.append(instance)
+                tags = instance.get('tags', [])
+                if instance.get('mutate'):
+                    tags.append('run:{0}'.format(len(self.seen)))
+                self.gauge('foo', 1, tags=tags)
+
+        instances = [{'tags': ['env:prod']}, {'tags': ['env:dev'], 'mutate': True}]
+        check = TagCheck('tag_check', {}, {}, instances)
+        check.seen = []
+        for copies in (2, 1, 1):
+            check.run()
+            self.assertEquals(check._instance_copies, copies)
+
+            # Changes made by the check are never seen by the next runs
+            tags = sorted(tuple(m[3]['tags']) for m in check.get_metrics())
+            self.assertEquals(tags, [('env:dev', 'run:{0}'.format(len(check.seen))), ('env:prod',)])
+            self.assertEquals(instances[1]['tags'], ['env:dev'])
+
+        # The instance that is only read is shared by all the runs
+        self.assertTrue(check.seen[0] is check.seen[2] is check.seen[4])
+        self.assertFalse(check.seen[1] is check.seen[3] or check.seen[3] is check.seen[5])
+
+        # Frozen instances can be used as cache keys, and copied to be modified
+        frozen = check._get_frozen_instance(0)
+        self.assertEquals(hash(frozen), hash(check._get_frozen_instance(0)))
+        self.assertEquals({frozen: 1}[check._get_frozen_instance(0)], 1)
+        self.assertEquals(type(copy.deepcopy(frozen)['tags']), list)
+        self.assertEquals(yaml.safe_load(yaml.safe_dump(frozen)), instances[0])
+
+    def test_frozen_instances_validation(self):
+        # Checks validating the types of their configuration accept frozen instances
+        rabbitmq_class = get_check_class('rabbitmq')
+        instance = {'rabbitmq_api_url': 'http://localhost:15672/api/', 'queues': ['test1'], 'nodes': ['rabbit@host']}
+        check = rabbitmq_class('rabbitmq', {}, {}, [instance])
+        _, _, specified, _ = check._get_config(check._get_frozen_instance(0))
+        self.assertEquals(specified['queues']['explicit'], ['test1'])
+
+        try:
+            hdfs_class = get_check_class('hdfs')
+        except ImportError:
+            raise SkipTest("snakebite is not installed")
+        check = hdfs_class('hdfs', {}, {}, [{'namenodes': [{'url': 'localhost'}]}])
+        check.get_client(check._get_frozen_instance(0))
+
     def test_ntp_global_settings(self):
         config = {'instances': [{
             "host": "foo.com",
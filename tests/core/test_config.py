@@ -6,7 +6,7 @@ import tempfile
 import unittest
 
 # project
-from config import get_config, load_check_directory
+from config import get_config, load_check_config, load_check_directory
 from util import is_valid_hostname, windows_friendly_colon_split
 from utils.pidfile import PidFile
 from utils.platform import Platform
@@ -104,6 +104,55 @@ class TestConfig(unittest.TestCase):
             # cleanup
             Platform.is_win32 = staticmethod(func)
 
+    def testCheckConfigCache(self):
+        fd, conf_path = tempfile.mkstemp(suffix='.yaml')
+        os.close(fd)
+        try:
+            with open(conf_path, 'w') as f:
+                f.write("init_config:\ninstances:\n  - host: foo\n")
+            config, cached = load_check_config(conf_path)
+            self.assertEquals(config['instances'], [{'host': 'foo'}])
+            self.assertFalse(cached)
+
+            # Every load gets its own copy of the configuration
+            config['instances'].append({})
+            config, cached = load_check_config(conf_path)
+            self.assertEquals(config['instances'], [{'host': 'foo'}])
+            self.assertTrue(cached)
+
+            # A file that is touched is not parsed again, one that is changed is
+            os.utime(conf_path, (0, 0))
+            self.assertTrue(load_check_config(conf_path)[1])
+            with open(conf_path, 'w') as f:
+                f.write("init_config:\ninstances:\n  - host: bar\n")
+            os.utime(conf_path, (1, 1))
+            config, cached = load_check_config(conf_path)
+            self.assertEquals(config['instances'], [{'host': 'bar'}])
+            self.assertFalse(cached)
+        finally:
+            os.remove(conf_path)
+
+    def testReloadChecks(self):
+        agentConfig = {"additional_checksd": "/etc/dd-agent/checks.d/"}
+        checks = load_check_directory(agentConfig, "foo")
+        self.assertTrue(checks['initialized_checks'])
+        self.assertFalse('reload_counts' in checks)
+
+        # Unchanged checks are kept, with their state
+        reloaded = load_check_directory(agentConfig, "foo", previous=checks)
+        self.assertEquals(sorted(map(id, reloaded['initialized_checks'])),
+                          sorted(map(id, checks['initialized_checks'])))
+        self.assertEquals(reloaded['reload_counts'],
+                          {'reloaded': 0, 'kept': len(checks['initialized_checks'])})
+
+        # Changed ones are initialized again
+        changed = checks['initialized_checks'][0]
+        reloaded['signatures'][changed.name] = None
+        reloaded_again = load_check_directory(agentConfig, "foo", previous=reloaded)
+        new_checks = [c for c in reloaded_again['initialized_checks'] if c.name == changed.name]
+        self.assertFalse(new_checks[0] is changed)
+        self.assertEquals(reloaded_again['reload_counts']['reloaded'], 1)
+
     def testDefaultChecks(self):
         checks = load_check_directory({"additional_checksd": "/etc/dd-agent/checks.d/"}, "foo")
         init_checks_names = [c.name for c in checks['initialized_checks']]
@@ -1,15 +1,30 @@
 # -*- coding: utf-8 -*-
 # stdlib
+from functools import partial
+import multiprocessing
+import os
+import Queue
 import random
+import socket
+import threading
 import time
 import unittest
 
 # 3p
+import mock
 from nose.plugins.attrib import attr
+from nose.plugins.skip import SkipTest
 import nose.tools as nt
 
 # project
-from aggregator import DEFAULT_HISTOGRAM_AGGREGATES, get_formatter, MetricsAggregator
+from aggregator import (
+    DEFAULT_HISTOGRAM_AGGREGATES,
+    get_formatter,
+    MetricsAggregator,
+    MetricsBucketAggregator,
+    TagsCache,
+)
+from dogstatsd import Dogstatsd, PayloadSender, Server, ShardedAggregator, ShardedServer, ShardServer
 
 
 class TestUnitDogStatsd(unittest.TestCase):
@@ -163,6 +178,63 @@ class TestUnitDogStatsd(unittest.TestCase):
         nt.assert_equal(fourth['points'][0][1], 16)
         nt.assert_equal(fourth['device_name'], 'floppy')
 
+    def test_parse_metric_packet(self):
+        stats = MetricsAggregator('myhost')
+        nt.assert_equal(
+            stats.parse_metric_packet('my.counter:1|c'),
+            [('my.counter', 1, 'c', None, 1, None, None)]
+        )
+        nt.assert_equal(
+            stats.parse_metric_packet('my.histogram:1.5|h|@0.5|#tag2,host:test-a,tag1:one,device:floppy'),
+            [('my.histogram', 1.5, 'h', ('tag1:one', 'tag2'), 0.5, 'test-a', 'floppy')]
+        )
+        # Packets holding several values
+        nt.assert_equal(
+            stats.parse_metric_packet('my.gauge:1|g|#tag1:one,host:test-b:2|g'),
+            [('my.gauge', 1, 'g', ('tag1:one',), 1, 'test-b', None),
+             ('my.gauge', 2, 'g', None, 1, None, None)]
+        )
+
+    def test_tags_cache(self):
+        cache = TagsCache(4)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        # 'a' is promoted, 'b' is evicted by the next generation change
+        nt.assert_equal(cache.get('a'), 1)
+        cache.set('d', 4)
+        nt.assert_equal(cache.get('b'), None)
+        nt.assert_equal(cache.get('a'), 1)
+        nt.assert_equal(cache.stats(), {'hits': 2, 'misses': 1, 'evictions': 1, 'size': 3})
+
+    def test_interned_tags(self):
+        stats = MetricsAggregator('myhost')
+        stats.submit_packets('my.counter:1|c|#tag2,tag1')
+        stats.submit_packets('my.gauge:1|g|#tag1,tag2,tag1')
+        stats.increment('my.other.counter', tags=['tag1', 'tag2'])
+
+        contexts = stats.metrics.keys()
+        nt.assert_equal(len(contexts), 3)
+        tags = contexts[0][1]
+        nt.assert_equal(tags, ('tag1', 'tag2'))
+        for context in contexts:
+            nt.assert_true(context[1] is tags)
+
+        # Metrics share the interned tuple too
+        for metric in stats.metrics.itervalues():
+            nt.assert_true(metric.tags is tags)
+
+        # Packet tags and tags sequences are counted in their own cache, once per lookup
+        cache_stats = stats.tags_cache_stats()
+        nt.assert_equal((cache_stats['hits'], cache_stats['misses']), (0, 2))
+        # Parsed tags are looked up again when the metric is submitted, and hit
+        nt.assert_equal((cache_stats['normalized_hits'], cache_stats['normalized_misses']), (3, 2))
+        stats.submit_packets('my.counter:1|c|#tag2,tag1')
+        stats.submit_packets('my.counter:1|c|#tag3')
+        cache_stats = stats.tags_cache_stats()
+        nt.assert_equal((cache_stats['hits'], cache_stats['misses']), (1, 3))
+        nt.assert_equal((cache_stats['normalized_hits'], cache_stats['normalized_misses']), (5, 3))
+
     def test_tags_gh442(self):
         import dogstatsd
         from aggregator import api_formatter
@@ -170,6 +242,133 @@ class TestUnitDogStatsd(unittest.TestCase):
         serialized = dogstatsd.serialize_metrics([api_formatter("foo", 12, 1, ('tag',), 'host')])
         assert '"tags": ["tag"]' in serialized[0]
 
+    def test_serialize_metrics_chunks(self):
+        import dogstatsd
+        from aggregator import api_formatter
+        import simplejson as json
+        import zlib
+
+        metrics = [
+            api_formatter('metric.%s' % i, random.random(), 1, ('tag:%s' % i,), 'host')
+            for i in xrange(5000)
+        ]
+        payloads = list(dogstatsd.serialize_metrics_chunks(metrics, max_payload_size=20000))
+        nt.assert_true(len(payloads) > 1)
+
+        series = []
+        for payload, headers in payloads:
+            nt.assert_true(len(payload) <= 20000, len(payload))
+            nt.assert_equal(headers['Content-Encoding'], 'deflate')
+            series += json.loads(zlib.decompress(payload))['series']
+        nt.assert_equal(series, json.loads(json.dumps(metrics)))
+
+        nt.assert_equal(list(dogstatsd.serialize_metrics_chunks([])), [])
+
+    def test_serialize_metrics_chunks_first_batch(self):
+        import dogstatsd
+        from aggregator import api_formatter
+        import simplejson as json
+        import zlib
+
+        # The first batch alone doesn't fit in a payload, it is split too
+        metrics = [
+            api_formatter('metric.%s' % os.urandom(16).encode('hex'), i, 1, None, 'host')
+            for i in xrange(dogstatsd.SERIES_BATCH_SIZE)
+        ]
+        # A series bigger than a payload is sent alone
+        metrics.append(api_formatter('metric.%s' % os.urandom(1024).encode('hex'), 1, 1, None, 'host'))
+        payloads = [payload for payload, _ in dogstatsd.serialize_metrics_chunks(metrics, max_payload_size=1024)]
+        nt.assert_true(len(payloads) > 2)
+
+        series = []
+        for payload in payloads[:-1]:
+            nt.assert_true(len(payload) <= 1024, len(payload))
+            series += json.loads(zlib.decompress(payload))['series']
+        nt.assert_equal(len(json.loads(zlib.decompress(payloads[-1]))['series']), 1)
+        series += json.loads(zlib.decompress(payloads[-1]))['series']
+        nt.assert_equal(series, json.loads(json.dumps(metrics)))
+
+    def test_payload_sender(self):
+        import dogstatsd
+
+        sender = PayloadSender(worker_count=1, retry_queue_size=2)
+        responses = {
+            'ok': mock.Mock(status_code=202),
+            'bad': mock.Mock(status_code=400),
+            'down': mock.Mock(status_code=503),
+        }
+
+        def post(url, data=None, timeout=None, headers=None):
+            if url == 'refused':
+                raise socket.error('Connection refused')
+            return responses[url]
+
+        with mock.patch.object(sender.session, 'post', side_effect=post):
+            for url in ['ok', 'ok', 'bad', 'down', 'refused', 'refused']:
+                sender._post((url, 'payload', {}), 0, time.time())
+
+        stats = sender.get_stats()
+        nt.assert_equal(stats['payloads_sent'], 2)
+        nt.assert_equal(stats['payloads_failed'], 4)
+        # The client error, and the oldest server error past the retry queue size
+        nt.assert_equal(stats['payloads_dropped'], 2)
+        nt.assert_equal(stats['retry_queue_length'], 2)
+
+        # Failed payloads wait for their retry delay
+        sender.retry()
+        nt.assert_equal(sender.queue.qsize(), 0)
+        nt.assert_equal(sender.get_stats()['retry_queue_length'], 2)
+
+        # Then they are submitted again, and posted by the workers
+        sender.start()
+        with mock.patch.object(sender.session, 'post', return_value=responses['ok']) as post:
+            with mock.patch('dogstatsd.time', return_value=time.time() + dogstatsd.RETRY_MIN_DELAY):
+                sender.retry()
+            sender.stop()
+        nt.assert_equal(post.call_count, 2)
+        nt.assert_equal(sender.get_stats()['payloads_sent'], 4)
+
+    def test_payload_sender_backoff(self):
+        import dogstatsd
+
+        sender = PayloadSender(worker_count=1, max_queued=2, retry_queue_size=4)
+
+        # Submitting doesn't block while the workers are busy
+        for i in xrange(3):
+            sender.submit('url', 'payload %s' % i, {})
+        nt.assert_equal(sender.queue.qsize(), 2)
+        nt.assert_equal(sender.get_stats()['retry_queue_length'], 1)
+
+        # Retries don't block either, they wait for the next one
+        sender.retry()
+        nt.assert_equal(sender.get_stats()['retry_queue_length'], 1)
+        sender.queue.get()
+        sender.retry()
+        nt.assert_equal(sender.queue.qsize(), 2)
+        nt.assert_equal(sender.get_stats()['retry_queue_length'], 0)
+
+        # The retry delay doubles at each failure, up to a maximum
+        now = time.time()
+        delays = []
+        with mock.patch.object(sender.session, 'post', return_value=mock.Mock(status_code=503)):
+            with mock.patch('dogstatsd.time', return_value=now):
+                for failures in xrange(6):
+                    sender._post(('url', 'payload', {}), failures, now)
+                    delays.append(sender.retry_queue.pop()[0] - now)
+        nt.assert_equal(delays, [10, 20, 40, 80, 160, 160])
+
+        # Payloads are dropped once too old
+        sender.queue.get()
+        sender.queue.get()
+        sender.retry_queue = [(now, 3, now - dogstatsd.RETRY_MAX_AGE - 1, ('url', 'old', {})),
+                              (now, 1, now, ('url', 'new', {}))]
+        dropped = sender.get_stats()['payloads_dropped']
+        sender.retry()
+        nt.assert_equal(sender.queue.get_nowait(), (('url', 'new', {}), 1, now))
+        nt.assert_equal(sender.queue.qsize(), 0)
+        nt.assert_equal(sender.get_stats()['payloads_dropped'], dropped + 1)
+        nt.assert_equal(sender.get_stats()['retry_queue_length'], 0)
+
     def test_counter(self):
         stats = MetricsAggregator('myhost')
 
@@ -563,6 +762,57 @@ class TestUnitDogStatsd(unittest.TestCase):
         nt.assert_equal(metrics[0]['metric'], 'test.counter')
         nt.assert_equal(metrics[0]['points'][0][1], 123)
 
+    def test_incremental_flush(self):
+        # Only sampled contexts and counters are flushed, idle ones expire lazily
+        stats = MetricsAggregator('myhost', expiry_seconds=10)
+        with mock.patch('aggregator.time') as fake_time:
+            fake_time.return_value = 100
+            stats.submit_packets('test.counter:1|c')
+            stats.submit_packets('test.gauge:1|g')
+            stats.submit_packets('test.histogram:1|h')
+            nt.assert_equal(len(stats.dirty_contexts), 3)
+            nt.assert_equal(len(stats.flush()), 7)
+            nt.assert_equal(len(stats.dirty_contexts), 0)
+
+            fake_time.return_value = 105
+            stats.submit_packets('test.gauge:2|g')
+            metrics = self.sort_metrics(stats.flush())
+            nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics],
+                            [('test.counter', 0), ('test.gauge', 2)])
+            nt.assert_equal(len(stats.metrics), 3)
+
+            # The counter and the histogram expire, the gauge was sampled since
+            fake_time.return_value = 112
+            nt.assert_equal(stats.flush(), [])
+            nt.assert_equal([context[0] for context in stats.metrics], ['test.gauge'])
+            nt.assert_equal(len(stats.counter_contexts), 0)
+
+            fake_time.return_value = 116
+            nt.assert_equal(stats.flush(), [])
+            nt.assert_equal(stats.metrics, {})
+
+    def test_swap_retired_state(self):
+        # Packets submitted after the swap go to the active state only
+        stats = MetricsBucketAggregator('myhost', interval=10)
+        with mock.patch('aggregator.time') as fake_time:
+            fake_time.return_value = 100
+            stats.submit_packets('test.before:1|c')
+
+            fake_time.return_value = 111
+            retired = stats.swap()
+            stats.submit_packets('test.after:1|c')
+            nt.assert_equal(stats.count, 1)
+
+            metrics = stats.flush_retired(retired)
+            nt.assert_equal([(m['metric'], m['points'][0]) for m in metrics],
+                            [('test.before', (100, 0.1))])
+
+            fake_time.return_value = 121
+            metrics = self.sort_metrics(stats.flush())
+            nt.assert_equal([(m['metric'], m['points'][0]) for m in metrics],
+                            [('test.after', (110, 0.1)), ('test.before', (110, 0))])
+            nt.assert_equal(stats.total_count, 2)
+
     def test_diagnostic_stats(self):
         stats = MetricsAggregator('myhost')
         for i in xrange(10):
@@ -866,3 +1116,196 @@ class TestUnitDogStatsd(unittest.TestCase):
         del env["https_proxy"]
         del env["HTTP_PROXY"]
         del env["HTTPS_PROXY"]
+
+
+class TestDogStatsdServer(unittest.TestCase):
+
+    def _run_server(self, server):
+        thread = threading.Thread(target=server.start)
+        thread.daemon = True
+        thread.start()
+        for _ in xrange(100):
+            if server.running:
+                break
+            time.sleep(0.01)
+        return thread
+
+    def _send_packets(self, port, packets):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for packet in packets:
+            sock.sendto(packet, ('127.0.0.1', port))
+        sock.close()
+
+    def _wait_for_count(self, aggregator, count):
+        for _ in xrange(200):
+            if aggregator.count >= count:
+                break
+            time.sleep(0.01)
+
+    def test_batched_receive(self):
+        aggregator = MetricsAggregator('myhost')
+        server = Server(aggregator, '127.0.0.1', 8140, batch_size=4)
+        thread = self._run_server(server)
+        try:
+            self._send_packets(8140, ['counter:1|c'] * 10)
+            self._wait_for_count(aggregator, 10)
+        finally:
+            server.stop()
+            thread.join()
+
+        nt.assert_equals(aggregator.count, 10)
+        nt.assert_equals(server.get_stats()['packets_dropped'], 0)
+
+    def test_queued_receive(self):
+        aggregator = MetricsAggregator('myhost')
+        server = Server(aggregator, '127.0.0.1', 8141, queue_size=100)
+        thread = self._run_server(server)
+        try:
+            self._send_packets(8141, ['counter:1|c'] * 10)
+            self._wait_for_count(aggregator, 10)
+        finally:
+            server.stop()
+            thread.join()
+
+        nt.assert_equals(aggregator.count, 10)
+        stats = server.get_stats()
+        nt.assert_equals(stats['queue_size'], 100)
+        nt.assert_equals(stats['queue_depth'], 0)
+
+    def test_full_queue_drops(self):
+        server = Server(MetricsAggregator('myhost'), '127.0.0.1', 8142, queue_size=2)
+        server.packet_queue = Queue.Queue(server.queue_size)
+        for _ in xrange(5):
+            server._enqueue_packet('counter:1|c')
+
+        stats = server.get_stats()
+        nt.assert_equals(stats['queue_depth'], 2)
+        nt.assert_equals(stats['packets_dropped'], 3)
+
+    def _run_sharded_server(self, port, queue_size=None):
+        if not ShardedServer.is_supported():
+            raise SkipTest("SO_REUSEPORT sharding is only supported on Linux")
+
+        server = ShardedServer(partial(MetricsBucketAggregator, 'myhost', interval=1),
+                               '127.0.0.1', port, 2, queue_size=queue_size)
+        aggregator = server.metrics_aggregator
+        thread = threading.Thread(target=server.start)
+        thread.daemon = True
+        thread.start()
+        try:
+            # Wait for the shards to be listening
+            for _ in xrange(100):
+                if len(aggregator._request('count')) == 2:
+                    break
+                time.sleep(0.05)
+
+            # Packets from several clients, mixing names owned by both shards
+            for _ in xrange(4):
+                self._send_packets(port, ['counter.%s:1|c\ngauge.%s:2|g' % (i, i) for i in xrange(10)])
+
+            for _ in xrange(200):
+                if aggregator.count >= 80:
+                    break
+                time.sleep(0.01)
+            nt.assert_equals(aggregator.count, 80)
+
+            # Let the bucket close
+            time.sleep(1)
+            metrics = aggregator.flush()
+        finally:
+            server.stop()
+            thread.join()
+
+        contexts = [(m['metric'], tuple(m['tags'] or [])) for m in metrics]
+        nt.assert_equals(len(contexts), 20)
+        nt.assert_equals(len(set(contexts)), 20)
+        for metric in metrics:
+            if metric['metric'].startswith('counter'):
+                nt.assert_equals(metric['points'][0][1], 4)
+        nt.assert_equals(len(server.get_stats()['shards']), 2)
+        return server
+
+    def test_sharded_server(self):
+        self._run_sharded_server(8143)
+
+    def test_sharded_server_queue(self):
+        # Every shard parses its packets in a separate thread
+        server = self._run_sharded_server(8145, queue_size=100)
+        stats = server.get_stats()
+        nt.assert_equals(stats['queue_size'], 200)
+        nt.assert_equals(stats['packets_dropped'], 0)
+
+    def test_shard_routing(self):
+        shard_sockets = []
+        for _ in xrange(2):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            shard_sockets.append(sock)
+
+        servers = [ShardServer(MetricsAggregator('myhost'), '127.0.0.1', 8144, i, shard_sockets, None)
+                   for i in xrange(2)]
+        packet = '\n'.join(['counter.%s:1|c' % i for i in xrange(10)] + ['_e{1,1}:a|b'])
+        servers[0]._route_packets(packet)
+
+        # Lines owned by the other shard are sent to its socket
+        forwarded = shard_sockets[1].recv(8192) if servers[0].forwarded_count else ''
+        servers[1].metrics_aggregator.submit_packets(forwarded)
+
+        nt.assert_equals(servers[0].metrics_aggregator.count + servers[1].metrics_aggregator.count, 10)
+        nt.assert_equals(servers[0].metrics_aggregator.event_count, 1)
+        names = [set(m['metric'] for m in s.metrics_aggregator.flush()) for s in servers]
+        nt.assert_equals(names[0] & names[1], set())
+        nt.assert_equals(len(names[0] | names[1]), 10)
+
+    @staticmethod
+    def _flush_answer(metric_name):
+        return {
+            'metrics': [{'metric': metric_name, 'points': [(0, 1)]}],
+            'events': [],
+            'service_checks': [],
+            'total_count': 1,
+            'tags_cache': {},
+            'packet_count': 1,
+            'forwarded_count': 0,
+            'packets_dropped': 0,
+            'queue_depth': 0,
+        }
+
+    def test_sharded_aggregator_late_flush(self):
+        parent_conn, shard_conn = multiprocessing.Pipe()
+        aggregator = ShardedAggregator(MetricsAggregator('myhost'), [parent_conn])
+
+        # The shard doesn't answer in time
+        with mock.patch('dogstatsd.SHARD_REQUEST_TIMEOUT', 0.01):
+            nt.assert_equals(aggregator.flush(), [])
+
+        # Its late answer is merged with the next flush instead of being lost
+        request_id, command = shard_conn.recv()
+        nt.assert_equals(command, 'flush')
+        shard_conn.send((request_id, self._flush_answer('late')))
+        shard_conn.send((request_id + 1, self._flush_answer('on_time')))
+        metrics = aggregator.flush()
+        nt.assert_equals(sorted(m['metric'] for m in metrics), ['late', 'on_time'])
+        nt.assert_equals(aggregator.late_flush_count, 1)
+        nt.assert_equals(aggregator.lost_flush_count, 0)
+
+    def test_sharded_aggregator_count(self):
+        parent_conn, shard_conn = multiprocessing.Pipe()
+        aggregator = ShardedAggregator(MetricsAggregator('myhost'), [parent_conn])
+
+        # The packet count is fetched from the shards once per flush
+        shard_conn.send((1, 20))
+        aggregator.send_packet_count('datadog.dogstatsd.packet.count')
+        nt.assert_equals(aggregator.packets_per_second(10), 2)
+        nt.assert_equals(aggregator.request_id, 1)
+
+    def test_shards_forked_before_threads(self):
+        calls = mock.Mock()
+        server = mock.Mock(spec=ShardedServer)
+        server.start_shards.side_effect = lambda: calls('start_shards')
+        server.start.side_effect = lambda: calls('server.start')
+        reporter = mock.Mock()
+        reporter.start.side_effect = lambda: calls('reporter.start')
+
+        Dogstatsd('/tmp/dogstatsd-test.pid', server, reporter, False).run()
+        nt.assert_equals([c[0][0] for c in calls.call_args_list], ['start_shards', 'reporter.start', 'server.start'])
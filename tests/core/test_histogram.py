@@ -2,8 +2,20 @@
 import unittest
 
 # project
-from aggregator import Histogram, MetricsAggregator
-from config import get_histogram_aggregates, get_histogram_percentiles
+from aggregator import (
+    ExactSamples,
+    Histogram,
+    HISTOGRAM_SKETCH_MAX_BINS,
+    MetricsAggregator,
+    SketchSamples,
+)
+from config import (
+    get_histogram_aggregates,
+    get_histogram_backend,
+    get_histogram_percentiles,
+    get_histogram_sketch_accuracy,
+    get_histogram_sketch_prefixes,
+)
 
 class TestHistogram(unittest.TestCase):
     def test_default(self):
@@ -151,3 +163,84 @@ class TestHistogram(unittest.TestCase):
         self.assertEquals(value_by_type['median'], 9, value_by_type)
         self.assertEquals(value_by_type['max'], 19, value_by_type)
         self.assertEquals(value_by_type['95percentile'], 18, value_by_type)
+
+    def test_sketch_backend(self):
+        stats = MetricsAggregator(
+            'myhost',
+            histogram_aggregates=get_histogram_aggregates('min, max, median, avg, count'),
+            histogram_percentiles=get_histogram_percentiles('0.5, 0.95, 0.99'),
+            histogram_backend=get_histogram_backend('sketch'),
+            histogram_sketch_accuracy=get_histogram_sketch_accuracy('0.01')
+        )
+        exact_stats = MetricsAggregator(
+            'myhost',
+            histogram_aggregates=get_histogram_aggregates('min, max, median, avg, count'),
+            histogram_percentiles=get_histogram_percentiles('0.5, 0.95, 0.99')
+        )
+
+        for i in xrange(-100, 10000):
+            value = i * 1.7
+            stats.histogram('myhistogram', value)
+            exact_stats.histogram('myhistogram', value)
+
+        value_by_type = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        exact_value_by_type = dict((m['metric'], m['points'][0][1]) for m in exact_stats.flush())
+        self.assertEquals(sorted(value_by_type.keys()), sorted(exact_value_by_type.keys()))
+
+        # min, max, avg and count are exact
+        for name in ['min', 'max', 'avg', 'count']:
+            self.assertAlmostEquals(value_by_type['myhistogram.%s' % name],
+                                    exact_value_by_type['myhistogram.%s' % name])
+
+        # Quantiles are within the relative accuracy
+        for name in ['median', '50percentile', '95percentile', '99percentile']:
+            exact_value = exact_value_by_type['myhistogram.%s' % name]
+            self.assertTrue(
+                abs(value_by_type['myhistogram.%s' % name] - exact_value) <= 0.01 * abs(exact_value),
+                (name, value_by_type, exact_value_by_type)
+            )
+
+    def test_sketch_prefixes(self):
+        stats = MetricsAggregator(
+            'myhost',
+            histogram_sketch_prefixes=get_histogram_sketch_prefixes('my.sketched., other.')
+        )
+        stats.histogram('my.sketched.histogram', 1)
+        stats.histogram('my.histogram', 1)
+
+        backends = dict((context[0], type(metric.samples)) for context, metric in stats.metrics.iteritems())
+        self.assertEquals(backends['my.sketched.histogram'], SketchSamples)
+        self.assertEquals(backends['my.histogram'], ExactSamples)
+
+    def test_sketch_bounded_bins(self):
+        samples = SketchSamples()
+        for i in xrange(-20, 20):
+            for _ in xrange(100):
+                samples.append(10 ** i)
+
+        self.assertTrue(len(samples.positive_bins) <= HISTOGRAM_SKETCH_MAX_BINS)
+        samples.prepare()
+        self.assertEquals(samples.min(), 10 ** -20)
+        self.assertEquals(samples.max(), 10 ** 19)
+        self.assertTrue(abs(samples.value_at_rank(3950) - 10 ** 19) <= 0.01 * 10 ** 19)
+
+    def test_sketch_collapse(self):
+        # More distinct bins than a sketch keeps, the lowest ones are merged
+        samples = SketchSamples()
+        values = [1.03 ** i for i in xrange(5000)]
+        for value in values:
+            samples.append(value)
+
+        self.assertEquals(len(samples.positive_bins), HISTOGRAM_SKETCH_MAX_BINS)
+        self.assertEquals(sum(samples.positive_bins.itervalues()), len(values))
+        samples.prepare()
+        self.assertEquals(samples.min(), values[0])
+        self.assertEquals(samples.max(), values[-1])
+        # High quantiles are still within the relative accuracy
+        for rank in [4000, 4500, 4750, 4950, 4999]:
+            self.assertTrue(abs(samples.value_at_rank(rank) - values[rank]) <= 0.01 * values[rank],
+                            (rank, samples.value_at_rank(rank), values[rank]))
+
+    def test_invalid_backend(self):
+        self.assertEquals(get_histogram_backend('tdigest'), None)
+        self.assertEquals(get_histogram_sketch_accuracy('2'), None)
@@ -1,11 +1,15 @@
 # stdlib
+import os
 import unittest
+import zlib
 
 #  3p
 from mock import Mock
+import simplejson as json
 
 # project
 from checks.collector import AgentPayload
+from utils.payload import decode_series, SeriesPayload
 
 
 class TestAgentPayload(unittest.TestCase):
@@ -108,3 +112,40 @@ class TestAgentPayload(unittest.TestCase):
         # One payload, one endpoint
         agent_payload.emit(None, None, [fake_emitter], True)
         fake_emitter.assert_any_call(agent_payload.payload, None, None, "")
+
+
+class TestSeriesPayload(unittest.TestCase):
+
+    SERIES = [{'metric': 'foo', 'points': [[1, 1]]}, {'metric': 'bar', 'points': [[1, 2]]}]
+
+    def test_decode_series(self):
+        body = json.dumps({'series': self.SERIES})
+        json_headers = {'Content-Type': 'application/json'}
+        self.assertEquals(json.loads('[%s]' % decode_series(body, json_headers)), self.SERIES)
+
+        deflate_headers = {'Content-Type': 'application/json', 'Content-Encoding': 'deflate',
+                           'DD-Dogstatsd-Version': '5.0.0'}
+        self.assertEquals(json.loads('[%s]' % decode_series(zlib.compress(body), deflate_headers)),
+                          self.SERIES)
+
+        # Anything else than series is not decoded
+        self.assertEquals(decode_series(json.dumps({'series': [], 'events': []}), json_headers), None)
+        self.assertEquals(decode_series(body, {'Content-Type': 'text/plain'}), None)
+        self.assertEquals(decode_series(body, {'Content-Type': 'application/json',
+                                               'Content-Encoding': 'gzip'}), None)
+        self.assertEquals(decode_series(body, deflate_headers), None)
+        self.assertEquals(decode_series('{"series": [', json_headers), None)
+
+    def test_merge_series(self):
+        payload = SeriesPayload(1024)
+        for serialized in [decode_series(json.dumps({'series': self.SERIES}),
+                                         {'Content-Type': 'application/json'})] * 3:
+            self.assertTrue(payload.fits(serialized))
+            payload.write(serialized)
+        self.assertEquals(json.loads(zlib.decompress(payload.close())), {'series': self.SERIES * 3})
+
+    def test_empty_payload_bound(self):
+        # Even the first series written are checked against the maximum size
+        serialized = json.dumps({'metric': os.urandom(2048).encode('hex'), 'points': [[1, 1]]})
+        self.assertFalse(SeriesPayload(1024).fits(serialized))
+        self.assertTrue(SeriesPayload(len(serialized) * 2).fits(serialized))
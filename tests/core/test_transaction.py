@@ -1,8 +1,16 @@
 # stdlib
 from datetime import datetime, timedelta
+import os
+import logging
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 
 # 3rd party
+import mock
 from nose.plugins.attrib import attr
 import requests
 import simplejson as json
@@ -11,13 +19,17 @@ from tornado.web import Application
 # project
 from config import get_version
 from ddagent import (
+    ApiInputHandler,
     APIMetricTransaction,
     APIServiceCheckTransaction,
+    Application as ForwarderApplication,
+    EmitterPayload,
+    EmitterThread,
     MAX_QUEUE_SIZE,
     MetricTransaction,
-    THROTTLING_DELAY,
 )
-from transaction import Transaction, TransactionManager
+from transaction import SpillQueue, SpillRecordTooBig, Transaction, TransactionManager
+from utils.payload import decode_series, DEFAULT_MAX_PAYLOAD_SIZE
 
 
 class memTransaction(Transaction):
@@ -39,6 +51,224 @@ class memTransaction(Transaction):
         self._trManager.flush_next()
 
 
+class inFlightTransaction(Transaction):
+    """ Sent to an endpoint, and completed when the test answers it """
+    def __init__(self, manager):
+        Transaction.__init__(self)
+        self._trManager = manager
+        self._size = 1
+
+    def flush(self):
+        self._trManager.endpoint_request('dd_url')
+
+    def respond(self, code):
+        self._trManager.endpoint_response('dd_url', code, 0.1)
+        if code < 400:
+            self._trManager.tr_success(self)
+        else:
+            self._trManager.tr_error(self)
+
+        self._trManager.flush_next()
+
+
+class spillableTransaction(memTransaction):
+    def get_spill_record(self):
+        return self._size
+
+    @classmethod
+    def loader(cls, manager):
+        def load(size):
+            tr = cls(size, manager)
+            tr.is_flushable = True
+            return tr
+        return load
+
+
+class TestSpillQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testFifoAcrossSegments(self):
+        queue = SpillQueue(self.path, 10000, segment_size=100)
+        for i in xrange(20):
+            self.assertEqual(queue.push(('record', i)), 0)
+        self.assertEqual(len(queue), 20)
+        self.assertTrue(len(os.listdir(self.path)) > 1)
+
+        self.assertEqual([queue.pop() for _ in xrange(20)], [('record', i) for i in xrange(20)])
+        self.assertEqual(queue.pop(), None)
+        # Replayed segments are removed
+        self.assertEqual(os.listdir(self.path), [])
+        self.assertEqual(queue.get_size(), 0)
+
+    def testSizeLimit(self):
+        queue = SpillQueue(self.path, 300, segment_size=100)
+        dropped = sum(queue.push(('record', i)) for i in xrange(20))
+        self.assertTrue(queue.get_size() <= 300)
+        self.assertEqual(len(queue) + dropped, 20)
+        # The oldest records are dropped
+        records = [queue.pop() for _ in xrange(len(queue))]
+        self.assertEqual(records, [('record', i) for i in xrange(dropped, 20)])
+
+    def testRecordTooBig(self):
+        queue = SpillQueue(self.path, 300, segment_size=100)
+        queue.push(('record', 0))
+        self.assertRaises(SpillRecordTooBig, queue.push, ('record', '0' * 300))
+        # The records already spilled are kept
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.pop(), ('record', 0))
+
+        # The transaction manager drops the transaction, without counting it as spilled
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+                                       spill_queue=queue, spill_threshold=50)
+        tr = spillableTransaction(100, trManager)
+        tr.get_spill_record = lambda: '0' * 300
+        trManager.append(tr)
+        self.assertEqual(len(trManager._transactions), 0)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(trManager._transactions_spilled, 0)
+        self.assertEqual(trManager._transactions_received, 0)
+        self.assertEqual(trManager._transactions_dropped, 1)
+
+    def testRecovery(self):
+        queue = SpillQueue(self.path, 10000, segment_size=100)
+        for i in xrange(10):
+            queue.push(('record', i))
+        queue.pop()
+
+        # Simulate a record partially written when stopping
+        last_segment = os.path.join(self.path, sorted(os.listdir(self.path))[-1])
+        with open(last_segment, 'ab') as f:
+            f.write('\x00\x00\x01')
+
+        recovered = SpillQueue(self.path, 10000, segment_size=100)
+        records = [recovered.pop() for _ in xrange(len(recovered))]
+        # Records of a partially replayed segment are replayed again
+        self.assertEqual(records[-9:], [('record', i) for i in xrange(1, 10)])
+        recovered.push(('record', 10))
+        self.assertEqual(recovered.pop(), ('record', 10))
+
+    def testCorruptSegment(self):
+        queue = SpillQueue(self.path, 10000, segment_size=100)
+        for i in xrange(10):
+            queue.push(('record', i))
+        first_segment = os.path.join(self.path, sorted(os.listdir(self.path))[0])
+        first_count = queue._segments[0].count
+
+        # Simulate a segment truncated in the middle of its second record
+        with open(first_segment, 'r+b') as f:
+            f.truncate(os.path.getsize(first_segment) / first_count + 5)
+
+        self.assertEqual(queue.pop(), ('record', 0))
+        self.assertRaises(IOError, queue.pop)
+        # The rest of the segment is dropped, the queue moves on to the next one
+        self.assertEqual(len(queue), 10 - first_count)
+        self.assertFalse(os.path.exists(first_segment))
+        self.assertEqual([queue.pop() for _ in xrange(len(queue))], [('record', i) for i in xrange(first_count, 10)])
+
+    def testReplayCorruptSegment(self):
+        queue = SpillQueue(self.path, MAX_QUEUE_SIZE)
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+                                       spill_queue=queue, spill_threshold=250)
+        trManager._spill_loader = spillableTransaction.loader(trManager)
+        for i in xrange(5):
+            trManager.append(spillableTransaction(100, trManager))
+        self.assertEqual(len(queue), 3)
+
+        # A truncated segment is dropped instead of being read over and over
+        segment = os.path.join(self.path, os.listdir(self.path)[0])
+        with open(segment, 'r+b') as f:
+            f.truncate(2)
+        trManager._transactions.clear()
+        trManager._total_size = 0
+        trManager._replay_spilled()
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(trManager._transactions_dropped, 3)
+        self.assertEqual(trManager._transactions_replayed, 0)
+
+    def testTransactionManagerSpill(self):
+        queue = SpillQueue(self.path, MAX_QUEUE_SIZE)
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+                                       spill_queue=queue, spill_threshold=250)
+        trManager._spill_loader = spillableTransaction.loader(trManager)
+
+        for i in xrange(10):
+            trManager.append(spillableTransaction(100, trManager))
+        # Two transactions fit in memory, the other ones are on disk
+        self.assertEqual(len(trManager._transactions), 2)
+        self.assertEqual(len(queue), 8)
+        self.assertEqual(trManager._transactions_spilled, 8)
+
+        # Nothing is replayed while the transactions in memory fail
+        trManager.flush()
+        self.assertEqual(len(queue), 8)
+
+        for tr in trManager.get_transactions():
+            tr.is_flushable = True
+        for _ in xrange(5):
+            trManager.flush()
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(trManager._transactions_replayed, 8)
+        self.assertEqual(trManager._transactions_flushed, 10)
+        self.assertEqual(trManager._transactions_dropped, 0)
+
+
+class TestEmitterThread(unittest.TestCase):
+
+    def wait_processed(self, thread, count):
+        for _ in xrange(100):
+            if thread.get_stats()['processed'] >= count:
+                return
+            time.sleep(0.05)
+
+    def testDecodeOnce(self):
+        calls = []
+
+        class emitter(object):
+            def __call__(self, data, logger, config):
+                calls.append(data)
+
+        payload = EmitterPayload(zlib.compress(json.dumps({'series': []})),
+                                 {'Content-Encoding': 'deflate'})
+        threads = [EmitterThread(name='emitter%s' % i, emitter=emitter, logger=logging, config={})
+                   for i in xrange(2)]
+        for thread in threads:
+            thread.enqueue(payload)
+            thread.start()
+            self.wait_processed(thread, 1)
+
+        self.assertEqual(calls, [{'series': []}] * 2)
+        # Decoded once, shared by the emitters
+        self.assertTrue(calls[0] is calls[1])
+
+    def testBatches(self):
+        calls = []
+
+        class emitter(object):
+            batch_size = 10
+
+            def __call__(self, data, logger, config):
+                calls.append(data)
+
+        thread = EmitterThread(name='emitter', emitter=emitter, logger=logging, config={},
+                               max_queue_size=2)
+        for i in xrange(3):
+            thread.enqueue(EmitterPayload(json.dumps({'payload': i}), {}))
+        thread.start()
+        self.wait_processed(thread, 2)
+
+        # Queued payloads are handled at once, past the queue size they are dropped
+        self.assertEqual(calls, [[{'payload': 0}, {'payload': 1}]])
+        stats = thread.get_stats()
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['queue_length'], 0)
+        self.assertTrue(stats['latency'] is not None)
+
+
 @attr(requires='core_integration')
 class TestTransaction(unittest.TestCase):
 
@@ -49,7 +279,7 @@ class TestTransaction(unittest.TestCase):
         """Test memory limit as well as simple flush"""
 
         # No throttling, no delay for replay
-        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0))
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE)
 
         step = 10
         oneTrSize = (MAX_QUEUE_SIZE / step) - 1
@@ -62,7 +292,7 @@ class TestTransaction(unittest.TestCase):
         # There should be exactly step transaction in the list, with
         # a flush count of 1
         self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             self.assertEqual(tr._flush_count, 1)
 
         # Try to add one more
@@ -71,13 +301,13 @@ class TestTransaction(unittest.TestCase):
 
         # At this point, transaction one (the oldest) should have been removed from the list
         self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             self.assertNotEqual(tr._id, 1)
 
         trManager.flush()
         self.assertEqual(len(trManager._transactions), step)
         # Check and allow transactions to be flushed
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             tr.is_flushable = True
             # Last transaction has been flushed only once
             if tr._id == step + 1:
@@ -91,9 +321,14 @@ class TestTransaction(unittest.TestCase):
     def testThrottling(self):
         """Test throttling while flushing"""
 
-        # No throttling, no delay for replay
-        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, THROTTLING_DELAY)
+        # No delay for replay
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE)
         trManager._flush_without_ioloop = True  # Use blocking API to emulate tornado ioloop
+        # No delay between two requests until an endpoint is overloaded
+        self.assertEqual(trManager._throttling_delay, timedelta(0))
+        trManager.endpoint_response('dd_url', 503)
+        throttling_delay = trManager._throttling_delay
+        self.assertTrue(throttling_delay > timedelta(0))
 
         # Add 3 transactions, make sure no memory limit is in the way
         oneTrSize = MAX_QUEUE_SIZE / 10
@@ -105,9 +340,132 @@ class TestTransaction(unittest.TestCase):
         before = datetime.utcnow()
         trManager.flush()
         after = datetime.utcnow()
-        self.assertTrue((after - before) > 3 * THROTTLING_DELAY - timedelta(microseconds=100000),
+        self.assertTrue((after - before) > 2 * throttling_delay,
                         "before = %s after = %s" % (before, after))
 
+    def testInFlightLimit(self):
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, max_in_flight=4)
+        trManager._flush_without_ioloop = True  # Use blocking API to emulate tornado ioloop
+
+        def in_flight():
+            return [tr for tr in trManager.get_transactions() if tr.get_id() in trManager._in_flight]
+
+        for i in xrange(10):
+            trManager.append(inFlightTransaction(trManager))
+        trManager.flush()
+
+        # Transactions are sent without waiting for the previous ones
+        self.assertEqual(len(in_flight()), 4)
+        self.assertEqual(trManager._endpoint_stats['dd_url']['in_flight'], 4)
+        # Sending the next ones as responses come back
+        for tr in in_flight():
+            tr.respond(200)
+        self.assertEqual(len(in_flight()), 4)
+        self.assertEqual(trManager._transactions_flushed, 4)
+
+        # The endpoint is overloaded: fewer transactions are sent, and not right away
+        in_flight()[0].respond(503)
+        self.assertEqual(trManager._in_flight_limit, 2)
+        self.assertTrue(trManager._throttling_delay > timedelta(seconds=0))
+        self.assertEqual(len(in_flight()), 3)
+
+        # The flush is done once every transaction got its response
+        while in_flight():
+            in_flight()[0].respond(200)
+        self.assertEqual(trManager._in_flight_limit, 4)
+        self.assertEqual(trManager._throttling_delay, timedelta(seconds=0))
+        self.assertEqual(trManager._trs_to_flush, None)
+        self.assertEqual(len(trManager._transactions), 1)
+        self.assertEqual(trManager._endpoint_stats['dd_url']['requests'], 10)
+        self.assertEqual(trManager._endpoint_stats['dd_url']['errors'], 1)
+        self.assertEqual(trManager._endpoint_stats['dd_url']['in_flight'], 0)
+
+    def testCoalesceSeries(self):
+        MetricTransaction._endpoints = []
+        app = ForwarderApplication(17123, {'api_key': 'foo', 'dd_url': 'https://foo.bar.com'},
+                                   watchdog=False)
+        trManager = app._tr_manager
+        headers = {'Content-Type': 'application/json', 'DD-Dogstatsd-Version': get_version()}
+
+        for i in xrange(10):
+            series = [{'metric': 'foo', 'points': [[i, i]]}]
+            self.assertTrue(app.coalesce_series(json.dumps({'series': series}), headers))
+        # Other payloads are sent as they are
+        self.assertTrue(app.coalesce_series(json.dumps({'foo': 'bar'}), headers))
+        self.assertFalse(app.coalesce_series('0' * DEFAULT_MAX_PAYLOAD_SIZE, headers))
+        self.assertEqual(len(trManager._transactions), 0)
+
+        app._postSeries()
+        self._merge_series(app)
+        self.assertEqual(len(trManager._transactions), 2)
+        raw, tr = sorted(trManager.get_transactions(), key=lambda t: t.get_id())
+        self.assertEqual(raw._data, json.dumps({'foo': 'bar'}))
+        self.assertEqual(tr.get_payload_count(), 10)
+        self.assertEqual(trManager._payloads_received, 11)
+        self.assertEqual(json.loads(zlib.decompress(tr._data))['series'],
+                         [{'metric': 'foo', 'points': [[i, i]]} for i in xrange(10)])
+
+    def testSpillRecord(self):
+        MetricTransaction._endpoints = []
+        ForwarderApplication(17123, {'api_key': 'foo', 'dd_url': 'https://foo.bar.com'}, watchdog=False)
+        tr = APIMetricTransaction('data', {'Content-Type': 'application/json'}, payload_count=10)
+
+        replayed = APIMetricTransaction.from_spill_record(tr.get_spill_record())
+        self.assertTrue(isinstance(replayed, APIMetricTransaction))
+        self.assertEqual(replayed._data, 'data')
+        self.assertEqual(replayed.get_payload_count(), 10)
+
+        # Records spilled by older versions count as one payload
+        replayed = APIMetricTransaction.from_spill_record(tr.get_spill_record()[:4])
+        self.assertEqual(replayed.get_payload_count(), 1)
+
+    def _merge_series(self, app):
+        """ Merge the queued series like the coalescer thread, and create their transactions """
+        coalescer = app._series_coalescer
+        while not coalescer._queue.empty():
+            coalescer.handle(coalescer._queue.get())
+        app.mloop.add_callback(app.mloop.stop)
+        app.mloop.start()
+
+    def testCoalesceSeriesOffIoloop(self):
+        MetricTransaction._endpoints = []
+        app = ForwarderApplication(17123, {'api_key': 'foo', 'dd_url': 'https://foo.bar.com'},
+                                   watchdog=False)
+        trManager = app._tr_manager
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'deflate'}
+
+        # A deflated body which inflates to a few MB
+        series = [{'metric': 'foo.%s' % i, 'points': [[i, i]], 'tags': ['tag:%s' % i]}
+                  for i in xrange(50000)]
+        msg = zlib.compress(json.dumps({'series': series}))
+        self.assertTrue(len(msg) <= DEFAULT_MAX_PAYLOAD_SIZE / 2)
+
+        decoding_threads = []
+
+        def decode(body, headers):
+            decoding_threads.append(threading.current_thread())
+            return decode_series(body, headers)
+
+        with mock.patch('ddagent.decode_series', side_effect=decode):
+            # The handler only queues the body
+            handler = mock.Mock(application=app, request=mock.Mock(body=msg, headers=headers))
+            ApiInputHandler.post.__func__(handler)
+            self.assertEqual(decoding_threads, [])
+            self.assertEqual(len(trManager._transactions), 0)
+
+            app._series_coalescer.start()
+            app._postSeries()
+            for _ in xrange(100):
+                if trManager._transactions:
+                    break
+                app.mloop.add_timeout(time.time() + 0.1, app.mloop.stop)
+                app.mloop.start()
+
+        self.assertEqual(decoding_threads, [app._series_coalescer])
+        self.assertEqual(len(trManager._transactions), 1)
+        self.assertEqual(json.loads(zlib.decompress(trManager.get_transactions()[0]._data))['series'],
+                         series)
+
     def testCustomEndpoint(self):
         MetricTransaction._endpoints = []
 
@@ -122,7 +480,7 @@ class TestTransaction(unittest.TestCase):
         app._agentConfig = config
         app.use_simple_http_client = True
 
-        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, THROTTLING_DELAY)
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE)
         trManager._flush_without_ioloop = True  # Use blocking API to emulate tornado ioloop
         MetricTransaction._trManager = trManager
         MetricTransaction.set_application(app)
@@ -133,6 +491,47 @@ class TestTransaction(unittest.TestCase):
         expected = ['https://foo.bar.com/intake/msgtype?api_key=foo']
         self.assertEqual(endpoints, expected, (endpoints, expected))
 
+    def testMultipleEndpoints(self):
+        config = {
+            "dd_url": "https://foo.bar.com",
+            "other_url": "https://other.bar.com",
+            "api_key": "foo",
+            "use_dd": True
+        }
+
+        app = Application()
+        app.skip_ssl_validation = False
+        app._agentConfig = config
+        app.use_simple_http_client = True
+
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE)
+        trManager._flush_without_ioloop = True  # Use blocking API to emulate tornado ioloop
+        MetricTransaction._trManager = trManager
+        MetricTransaction.set_application(app)
+        MetricTransaction._endpoints = ['dd_url', 'other_url']
+        self.addCleanup(setattr, MetricTransaction, '_endpoints', [])
+
+        def response(code):
+            return mock.Mock(code=code, error=None if code < 400 else Exception(code), request_time=0.1)
+
+        for codes, success in [((200, 200), True), ((200, 500), False)]:
+            flushed = trManager._transactions_flushed
+            with mock.patch('ddagent.tornado.httpclient.AsyncHTTPClient') as client:
+                tr = MetricTransaction('data', {}, "msgtype")
+            callbacks = [call[1]['callback'] for call in client.return_value.fetch.call_args_list]
+            self.assertEqual(len(callbacks), 2)
+
+            # The transaction stays in flight until the last endpoint answers
+            callbacks[0](response(codes[0]))
+            self.assertTrue(tr.get_id() in trManager._in_flight)
+            self.assertEqual(trManager._transactions_flushed, flushed)
+
+            callbacks[1](response(codes[1]))
+            self.assertFalse(tr.get_id() in trManager._in_flight)
+            self.assertEqual(trManager._transactions_flushed, flushed + success)
+        self.assertEqual([t.get_id() for t in trManager.get_transactions()], [tr.get_id()])
+        self.assertEqual(tr.get_error_count(), 1)
+
     def testEndpoints(self):
         """
         Tests that the logic behind the agent version specific endpoints is ok.
@@ -151,7 +550,7 @@ class TestTransaction(unittest.TestCase):
         app._agentConfig = config
         app.use_simple_http_client = True
 
-        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, THROTTLING_DELAY)
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE)
         trManager._flush_without_ioloop = True  # Use blocking API to emulate tornado ioloop
         MetricTransaction._trManager = trManager
         MetricTransaction.set_application(app)
@@ -1,7 +1,12 @@
 # stdlib
+from collections import deque
+import cPickle as pickle
 from datetime import datetime, timedelta
+import heapq
 import logging
-from operator import attrgetter
+from operator import methodcaller
+import os
+import struct
 import sys
 import time
 
@@ -14,6 +19,44 @@ log = logging.getLogger(__name__)
 FLUSH_LOGGING_PERIOD = 20
 FLUSH_LOGGING_INITIAL = 5
 
+# Spilled transactions are appended to segment files of about this size
+SPILL_SEGMENT_SIZE = 4 * 1024 * 1024  # 4MB
+SPILL_SEGMENT_PREFIX = 'transactions-'
+# Records are prefixed by their length
+SPILL_RECORD_HEADER = struct.Struct('>I')
+
+# Backing off an endpoint at least doubles the delay between two requests, up to
+# MAX_THROTTLING_DELAY. Each success halves it, down to no delay at all.
+MIN_THROTTLING_DELAY = timedelta(milliseconds=100)
+MAX_THROTTLING_DELAY = timedelta(seconds=10)
+# Weight of the last response in the average latency of an endpoint
+LATENCY_SMOOTHING = 0.2
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _timestamp(dt):
+    td = dt - EPOCH
+    return td.days * 86400 + td.seconds + td.microseconds / 1e6
+
+
+def _flush_key(tr):
+    # Transactions are scheduled on their next flush time
+    return _timestamp(tr.get_next_flush())
+
+
+def _total_seconds(td):
+    # Python 2.7 has this built in, python < 2.7 don't...
+    if hasattr(td, 'total_seconds'):
+        return td.total_seconds()
+    return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10.0**6
+
+
+def _should_back_off(code):
+    # The endpoint is overloaded or unreachable (tornado reports the latter as 599)
+    return code == 429 or code >= 500
+
+
 class Transaction(object):
 
     def __init__(self):
@@ -22,6 +65,7 @@ class Transaction(object):
         self._error_count = 0
         self._next_flush = datetime.utcnow()
         self._size = None
+        self._payload_count = 1  # Payloads received merged into this transaction
 
     def get_id(self):
         return self._id
@@ -36,6 +80,9 @@ class Transaction(object):
     def get_error_count(self):
         return self._error_count
 
+    def get_payload_count(self):
+        return self._payload_count
+
     def get_size(self):
         if self._size is None:
             self._size = sys.getsizeof(self)
@@ -61,23 +108,212 @@ class Transaction(object):
     def flush(self):
         raise NotImplementedError("To be implemented in a subclass")
 
+    def get_spill_record(self):
+        """ Picklable state the transaction can be rebuilt from, None if it can't be spilled to disk """
+        return None
+
+
+class SpillRecordTooBig(Exception):
+    """ A record is bigger than the whole spill queue """
+    pass
+
+
+class SpillSegment(object):
+
+    def __init__(self, path, size=0, count=0):
+        self.path = path
+        self.size = size
+        self.count = count
+
+
+class SpillQueue(object):
+    """
+    FIFO queue of transaction records spilled to disk, in segment files
+    of about `segment_size` bytes in the `path` directory.
+
+    The queue holds `max_size` bytes at most, the oldest segment is
+    dropped to make room for new records. Segments left by a previous
+    run are recovered, records of a segment that was being replayed
+    when it stopped may be sent twice.
+    """
+
+    def __init__(self, path, max_size, segment_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.segment_size = segment_size or SPILL_SEGMENT_SIZE
+
+        self._segments = deque()  # Oldest first
+        self._size = 0
+        self._count = 0
+        self._next_segment_id = 0
+        self._writer = None  # Last segment file, open for writing
+        self._reader = None  # First segment file, open for reading
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._recover()
+
+    def __len__(self):
+        return self._count
+
+    def get_size(self):
+        return self._size
+
+    def _segment_ids(self):
+        segment_ids = []
+        for filename in os.listdir(self.path):
+            if filename.startswith(SPILL_SEGMENT_PREFIX):
+                try:
+                    segment_ids.append(int(filename[len(SPILL_SEGMENT_PREFIX):]))
+                except ValueError:
+                    continue
+        return sorted(segment_ids)
+
+    def _recover(self):
+        for segment_id in self._segment_ids():
+            segment = SpillSegment(os.path.join(self.path, SPILL_SEGMENT_PREFIX + str(segment_id)))
+            with open(segment.path, 'r+b') as f:
+                while True:
+                    header = f.read(SPILL_RECORD_HEADER.size)
+                    if len(header) < SPILL_RECORD_HEADER.size:
+                        break
+                    record_size, = SPILL_RECORD_HEADER.unpack(header)
+                    if len(f.read(record_size)) < record_size:
+                        break
+                    segment.size += SPILL_RECORD_HEADER.size + record_size
+                    segment.count += 1
+                # Drop a record partially written when the previous run stopped
+                f.truncate(segment.size)
+
+            if segment.count:
+                self._segments.append(segment)
+                self._size += segment.size
+                self._count += segment.count
+            else:
+                os.remove(segment.path)
+            self._next_segment_id = segment_id + 1
+
+        if self._count:
+            log.info("Recovered %s transaction%s spilled to disk" % (self._count, plural(self._count)))
+
+    def _drop_oldest_segment(self):
+        segment = self._segments.popleft()
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        if not self._segments and self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        os.remove(segment.path)
+        self._size -= segment.size
+        self._count -= segment.count
+        return segment.count
+
+    def push(self, record):
+        """ Append a record to the queue, returns the number of records dropped to make room for it.
+        Raises SpillRecordTooBig if it can't fit in the queue at all """
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        data = SPILL_RECORD_HEADER.pack(len(data)) + data
+        if len(data) > self.max_size:
+            raise SpillRecordTooBig("Record of %s bytes, the spill queue holds %s bytes at most"
+                                    % (len(data), self.max_size))
+
+        dropped = 0
+        while self._segments and self._size + len(data) > self.max_size:
+            dropped += self._drop_oldest_segment()
+
+        if self._writer is None or self._segments[-1].size + len(data) > self.segment_size:
+            if self._writer is not None:
+                self._writer.close()
+            segment = SpillSegment(os.path.join(self.path, SPILL_SEGMENT_PREFIX + str(self._next_segment_id)))
+            self._next_segment_id += 1
+            self._segments.append(segment)
+            self._writer = open(segment.path, 'ab')
+
+        self._writer.write(data)
+        self._writer.flush()
+        self._segments[-1].size += len(data)
+        self._segments[-1].count += 1
+        self._size += len(data)
+        self._count += 1
+        return dropped
+
+    def pop(self):
+        """ Remove and return the oldest record, None if the queue is empty """
+        if not self._count:
+            return None
+
+        segment = self._segments[0]
+        try:
+            if self._reader is None:
+                self._reader = open(segment.path, 'rb')
+            header = self._reader.read(SPILL_RECORD_HEADER.size)
+            if len(header) < SPILL_RECORD_HEADER.size:
+                raise IOError("Truncated record header in %s" % segment.path)
+            record_size, = SPILL_RECORD_HEADER.unpack(header)
+            data = self._reader.read(record_size)
+            if len(data) < record_size:
+                raise IOError("Truncated record in %s" % segment.path)
+            record = pickle.loads(data)
+        except Exception:
+            # The reader is past a record it couldn't decode, the rest of
+            # the segment can't be trusted: drop it and its records
+            self._drop_oldest_segment()
+            raise
+
+        segment.count -= 1
+        self._count -= 1
+        if not segment.count:
+            # Fully replayed
+            self._drop_oldest_segment()
+        return record
+
+
 class TransactionManager(object):
     """Holds any transaction derived object list and make sure they
        are all commited, without exceeding parameters (throttling, memory consumption) """
 
-    def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay):
+    def __init__(self, max_wait_for_replay, max_queue_size,
+                 spill_queue=None, spill_threshold=None, spill_loader=None, max_in_flight=1,
+                 emitter_stats=None):
         self._MAX_WAIT_FOR_REPLAY = max_wait_for_replay
         self._MAX_QUEUE_SIZE = max_queue_size
-        self._THROTTLING_DELAY = throttling_delay
+        self._MAX_IN_FLIGHT = max(1, max_in_flight)
+
+        # Up to `max_in_flight` transactions are sent concurrently. The limit and the
+        # delay between two requests adapt to the responses of the endpoints.
+        self._in_flight_limit = self._MAX_IN_FLIGHT
+        self._throttling_delay = timedelta(0)
+        self._in_flight = set()  # Ids of the transactions sent, waiting for a response
+        self._throttled = False  # A delayed flush_next is scheduled
+        self._endpoint_stats = {}
+
+        # Past `spill_threshold` bytes in memory, transactions are spilled to
+        # `spill_queue` and rebuilt with `spill_loader` once there is room again
+        self._spill_queue = spill_queue
+        self._spill_threshold = spill_threshold or max_queue_size
+        self._spill_loader = spill_loader
+
+        # Returns the stats of the custom emitters, reported in the status
+        self._emitter_stats = emitter_stats
 
         self._flush_without_ioloop = False # useful for tests
 
-        self._transactions = []  # List of all non commited transactions
+        self._transactions = {}  # All non commited transactions, by id
+        # Heaps of (next flush, id) and of (-next flush, id) to find the transactions
+        # to flush and to drop. Entries of transactions that were committed, dropped
+        # or rescheduled since they were pushed are skipped when popped.
+        self._flush_heap = []
+        self._drop_heap = []
         self._total_count = 0  # Maintain size/count not to recompute it everytime
         self._total_size = 0
         self._flush_count = 0
         self._transactions_received = 0
+        self._payloads_received = 0
         self._transactions_flushed = 0
+        self._transactions_spilled = 0
+        self._transactions_replayed = 0
+        self._transactions_dropped = 0
 
         # Global counter to assign a number to each transaction: we may have an issue
         #  if this overlaps
@@ -90,7 +326,33 @@ class TransactionManager(object):
         ForwarderStatus().persist()
 
     def get_transactions(self):
-        return self._transactions
+        return sorted(self._transactions.itervalues(), key=methodcaller('get_id'))
+
+    def _schedule(self, tr):
+        key = _flush_key(tr)
+        heapq.heappush(self._flush_heap, (key, tr.get_id()))
+        heapq.heappush(self._drop_heap, (-key, tr.get_id()))
+
+        # Rebuild the drop heap when rescheduled transactions left too many stale entries
+        if len(self._drop_heap) > 2 * len(self._transactions) + 1000:
+            self._drop_heap = [(-_flush_key(tr2), tr_id) for tr_id, tr2 in self._transactions.iteritems()]
+            heapq.heapify(self._drop_heap)
+
+    def _pop_latest_scheduled(self):
+        """ Pop the transaction scheduled the latest, None if there is none """
+        while self._drop_heap:
+            key, tr_id = heapq.heappop(self._drop_heap)
+            tr = self._transactions.get(tr_id)
+            if tr is not None and key == -_flush_key(tr):
+                return tr
+        return None
+
+    def _remove(self, tr):
+        if self._transactions.pop(tr.get_id(), None) is None:
+            return False
+        self._total_count -= 1
+        self._total_size -= tr.get_size()
+        return True
 
     def print_queue_stats(self):
         log.debug("Queue size: at %s, %s transaction(s), %s KB" %
@@ -108,23 +370,82 @@ class TransactionManager(object):
         # Check the size
         tr_size = tr.get_size()
 
+        if self._should_spill(tr_size):
+            record = tr.get_spill_record()
+            if record is not None:
+                self._spill(tr, record)
+                return
+
+        self._append_in_memory(tr, tr_size)
+        self._transactions_received += 1
+        self._payloads_received += tr.get_payload_count()
+
+    def _should_spill(self, tr_size):
+        if self._spill_queue is None:
+            return False
+        # Keep the transactions in order once some are on disk
+        return len(self._spill_queue) > 0 or self._total_size + tr_size > self._spill_threshold
+
+    def _spill(self, tr, record):
+        try:
+            dropped = self._spill_queue.push(record)
+        except SpillRecordTooBig, e:
+            log.warn("Transaction %s is too big to be spilled to disk, dropping it: %s" % (tr.get_id(), e))
+            self._transactions_dropped += 1
+            return
+        except Exception:
+            log.exception("Unable to spill transaction %s to disk, dropping it" % tr.get_id())
+            self._transactions_dropped += 1
+            return
+
+        self._transactions_received += 1
+        self._payloads_received += tr.get_payload_count()
+        self._transactions_spilled += 1
+        if dropped:
+            log.warn("Spill queue is too big, dropped %s old transaction%s" % (dropped, plural(dropped)))
+            self._transactions_dropped += dropped
+        log.debug("Transaction %s spilled to disk" % tr.get_id())
+
+    def _replay_spilled(self):
+        """ Move transactions back from disk to memory, oldest first, while there is room """
+        # Wait for half of the memory queue to be sent, not to replay and
+        # spill transactions back and forth
+        while self._spill_queue and self._total_size < self._spill_threshold / 2:
+            spilled_count = len(self._spill_queue)
+            try:
+                tr = self._spill_loader(self._spill_queue.pop())
+            except Exception:
+                # A record that can't be decoded drops the rest of its segment
+                dropped = spilled_count - len(self._spill_queue)
+                log.exception("Unable to replay a transaction spilled to disk, dropping %s transaction%s"
+                              % (dropped, plural(dropped)))
+                self._transactions_dropped += dropped
+                # Resume at the next flush
+                break
+            tr.set_id(self.get_tr_id())
+            self._append_in_memory(tr, tr.get_size())
+            self._transactions_replayed += 1
+
+    def _append_in_memory(self, tr, tr_size):
+
         log.debug("New transaction to add, total size of queue would be: %s KB" %
             ((self._total_size + tr_size) / 1024))
 
         if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
             log.warn("Queue is too big, removing old transactions...")
-            new_trs = sorted(self._transactions,key=attrgetter('_next_flush'), reverse = True)
-            for tr2 in new_trs:
-                if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
-                    self._transactions.remove(tr2)
-                    self._total_count = self._total_count - 1
-                    self._total_size = self._total_size - tr2.get_size()
-                    log.warn("Removed transaction %s from queue" % tr2.get_id())
+            # Transactions scheduled the latest first, the oldest first among them
+            while (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
+                tr2 = self._pop_latest_scheduled()
+                if tr2 is None:
+                    break
+                self._remove(tr2)
+                self._transactions_dropped += 1
+                log.warn("Removed transaction %s from queue" % tr2.get_id())
 
         # Done
-        self._transactions.append(tr)
+        self._transactions[tr.get_id()] = tr
+        self._schedule(tr)
         self._total_count += 1
-        self._transactions_received += 1
         self._total_size = self._total_size + tr_size
 
         log.debug("Transaction %s added" % (tr.get_id()))
@@ -136,11 +457,17 @@ class TransactionManager(object):
             log.debug("A flush is already in progress, not doing anything")
             return
 
+        if self._spill_queue is not None:
+            self._replay_spilled()
+
         to_flush = []
         # Do we have something to do ?
         now = datetime.utcnow()
-        for tr in self._transactions:
-            if tr.time_to_flush(now):
+        now_key = _timestamp(now)
+        while self._flush_heap and self._flush_heap[0][0] < now_key:
+            key, tr_id = heapq.heappop(self._flush_heap)
+            tr = self._transactions.get(tr_id)
+            if tr is not None and key == _flush_key(tr):
                 to_flush.append(tr)
 
         count = len(to_flush)
@@ -169,53 +496,115 @@ class TransactionManager(object):
             queue_size=self._total_size,
             flush_count=self._flush_count,
             transactions_received=self._transactions_received,
-            transactions_flushed=self._transactions_flushed).persist()
+            payloads_received=self._payloads_received,
+            transactions_flushed=self._transactions_flushed,
+            transactions_spilled=self._transactions_spilled,
+            transactions_replayed=self._transactions_replayed,
+            transactions_dropped=self._transactions_dropped,
+            spill_queue_length=len(self._spill_queue) if self._spill_queue is not None else 0,
+            spill_queue_size=self._spill_queue.get_size() if self._spill_queue is not None else 0,
+            in_flight_limit=self._in_flight_limit,
+            throttling_delay=_total_seconds(self._throttling_delay),
+            endpoints=self._endpoint_stats,
+            emitters=self._emitter_stats() if self._emitter_stats is not None else None).persist()
 
     def flush_next(self):
 
-        if len(self._trs_to_flush) > 0:
+        if self._trs_to_flush is None or self._throttled:
+            return
 
-            td = self._last_flush + self._THROTTLING_DELAY - datetime.utcnow()
-            # Python 2.7 has this built in, python < 2.7 don't...
-            if hasattr(td,'total_seconds'):
-                delay = td.total_seconds()
-            else:
-                delay = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10.0**6
+        while self._trs_to_flush and len(self._in_flight) < self._in_flight_limit:
 
-            if delay <= 0:
-                tr = self._trs_to_flush.pop()
-                self._last_flush = datetime.utcnow()
-                log.debug("Flushing transaction %d" % tr.get_id())
-                try:
-                    tr.flush()
-                except Exception,e :
-                    log.exception(e)
-                    self.tr_error(tr)
-                    self.flush_next()
-            else:
+            delay = _total_seconds(self._last_flush + self._throttling_delay - datetime.utcnow())
+
+            if delay > 0:
                 # Wait a little bit more
                 tornado_ioloop = get_tornado_ioloop()
                 if tornado_ioloop._running:
+                    self._throttled = True
                     tornado_ioloop.add_timeout(time.time() + delay,
-                        lambda: self.flush_next())
+                        lambda: self._flush_throttled())
+                    return
                 elif self._flush_without_ioloop:
                     # Tornado is no started (ie, unittests), do it manually: BLOCKING
                     time.sleep(delay)
-                    self.flush_next()
-        else:
+                else:
+                    return
+
+            tr = self._trs_to_flush.pop()
+            self._last_flush = datetime.utcnow()
+            self._in_flight.add(tr.get_id())
+            log.debug("Flushing transaction %d" % tr.get_id())
+            try:
+                tr.flush()
+            except Exception,e :
+                log.exception(e)
+                self.tr_error(tr)
+
+        # The flush is over once the last transaction sent got its response
+        if not self._trs_to_flush and not self._in_flight:
             self._trs_to_flush = None
 
+    def _flush_throttled(self):
+        self._throttled = False
+        self.flush_next()
+
+    def _get_endpoint_stats(self, endpoint):
+        stats = self._endpoint_stats.get(endpoint)
+        if stats is None:
+            stats = self._endpoint_stats[endpoint] = {
+                'in_flight': 0,
+                'requests': 0,
+                'errors': 0,
+                'latency': None,
+            }
+        return stats
+
+    def endpoint_request(self, endpoint):
+        """ Track a request sent to `endpoint` """
+        self._get_endpoint_stats(endpoint)['in_flight'] += 1
+
+    def endpoint_response(self, endpoint, code, latency=None):
+        """ Track the response of `endpoint` to a request, and adapt the throttling to it:
+        back off when it is overloaded, ramp up again when it accepts the requests """
+        stats = self._get_endpoint_stats(endpoint)
+        stats['in_flight'] = max(0, stats['in_flight'] - 1)
+        stats['requests'] += 1
+        if latency is not None:
+            if stats['latency'] is None:
+                stats['latency'] = latency
+            else:
+                stats['latency'] += LATENCY_SMOOTHING * (latency - stats['latency'])
+
+        if _should_back_off(code):
+            stats['errors'] += 1
+            self._in_flight_limit = max(1, self._in_flight_limit / 2)
+            self._throttling_delay = min(max(self._throttling_delay * 2, MIN_THROTTLING_DELAY),
+                                         MAX_THROTTLING_DELAY)
+            log.warn("Endpoint %s answered %s, backing off: %s transaction%s in flight at most, %ss between requests" %
+                     (endpoint, code, self._in_flight_limit, plural(self._in_flight_limit),
+                      _total_seconds(self._throttling_delay)))
+        elif code >= 400:
+            stats['errors'] += 1
+        else:
+            self._in_flight_limit = min(self._MAX_IN_FLIGHT, self._in_flight_limit + 1)
+            self._throttling_delay = self._throttling_delay / 2
+            if self._throttling_delay < MIN_THROTTLING_DELAY:
+                self._throttling_delay = timedelta(0)
+
     def tr_error(self,tr):
+        self._in_flight.discard(tr.get_id())
         tr.inc_error_count()
         tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+        if tr.get_id() in self._transactions:
+            self._schedule(tr)
         log.warn("Transaction %d in error (%s error%s), it will be replayed after %s" %
           (tr.get_id(), tr.get_error_count(), plural(tr.get_error_count()),
            tr.get_next_flush()))
 
     def tr_success(self,tr):
         log.debug("Transaction %d completed" % tr.get_id())
-        self._transactions.remove(tr)
-        self._total_count -= 1
-        self._total_size -= tr.get_size()
+        self._in_flight.discard(tr.get_id())
+        self._remove(tr)
         self._transactions_flushed += 1
         self.print_queue_stats()
@@ -0,0 +1,134 @@
+# stdlib
+import copy
+
+# 3p
+import yaml
+
+
+class _FrozenState(object):
+    """ Shared by all the containers of a frozen value, flags whether any was written to """
+    __slots__ = ('mutated',)
+
+    def __init__(self):
+        self.mutated = False
+
+
+def _mutator(base, name):
+    method = getattr(base, name)
+
+    def mutate(self, *args, **kwargs):
+        self._state.mutated = True
+        return method(self, *args, **kwargs)
+
+    mutate.__name__ = name
+    return mutate
+
+
+class FrozenDict(dict):
+    """
+    A dict which can be shared between check runs instead of being copied for each of them.
+
+    Its hash is computed from its content when it is frozen, so it can be used as a cache key.
+    Writes are still allowed, for the checks which update their instance, but flag the whole
+    frozen value as mutated so that its owner can replace it by a fresh copy.
+    """
+    __slots__ = ('_state', '_hash')
+
+    def __init__(self, items, state):
+        dict.__init__(self, items)
+        self._state = state
+        self._hash = None
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self.iteritems()))
+        return self._hash
+
+    def __copy__(self):
+        return dict(self)
+
+    copy = __copy__
+
+    def __deepcopy__(self, memo):
+        return dict((copy.deepcopy(k, memo), copy.deepcopy(v, memo)) for k, v in self.iteritems())
+
+    def __reduce_ex__(self, protocol):
+        return dict, (dict(self),)
+
+    __setitem__ = _mutator(dict, '__setitem__')
+    __delitem__ = _mutator(dict, '__delitem__')
+    clear = _mutator(dict, 'clear')
+    pop = _mutator(dict, 'pop')
+    popitem = _mutator(dict, 'popitem')
+    setdefault = _mutator(dict, 'setdefault')
+    update = _mutator(dict, 'update')
+
+
+class FrozenList(list):
+    """ A list which can be shared between check runs, see `FrozenDict` """
+    __slots__ = ('_state', '_hash')
+
+    def __init__(self, items, state):
+        list.__init__(self, items)
+        self._state = state
+        self._hash = None
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(tuple(self))
+        return self._hash
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(v, memo) for v in self]
+
+    def __reduce_ex__(self, protocol):
+        return list, (list(self),)
+
+    __setitem__ = _mutator(list, '__setitem__')
+    __delitem__ = _mutator(list, '__delitem__')
+    __setslice__ = _mutator(list, '__setslice__')
+    __delslice__ = _mutator(list, '__delslice__')
+    __iadd__ = _mutator(list, '__iadd__')
+    __imul__ = _mutator(list, '__imul__')
+    append = _mutator(list, 'append')
+    extend = _mutator(list, 'extend')
+    insert = _mutator(list, 'insert')
+    pop = _mutator(list, 'pop')
+    remove = _mutator(list, 'remove')
+    reverse = _mutator(list, 'reverse')
+    sort = _mutator(list, 'sort')
+
+
+# Dump frozen values like the plain ones, with the Python and C dumpers alike
+for _dumper in (getattr(yaml, name) for name in ('SafeDumper', 'Dumper', 'CSafeDumper', 'CDumper') if hasattr(yaml, name)):
+    _dumper.add_representer(FrozenDict, yaml.representer.SafeRepresenter.represent_dict)
+    _dumper.add_representer(FrozenList, yaml.representer.SafeRepresenter.represent_list)
+
+
+def _freeze(value, state):
+    if isinstance(value, dict):
+        return FrozenDict(((k, _freeze(v, state)) for k, v in value.iteritems()), state)
+    if isinstance(value, list):
+        return FrozenList((_freeze(v, state) for v in value), state)
+    if isinstance(value, tuple):
+        return tuple(_freeze(v, state) for v in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
+def freeze(value):
+    """
+    Return a deep copy of `value`, a configuration loaded from YAML, made of
+    hashable `FrozenDict` and `FrozenList` containers.
+    """
+    return _freeze(value, _FrozenState())
+
+
+def is_mutated(value):
+    """ Whether any container of the frozen `value` was written to since it was frozen """
+    state = getattr(value, '_state', None)
+    return state is not None and state.mutated
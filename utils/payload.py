@@ -0,0 +1,91 @@
+# stdlib
+import zlib
+
+# 3p
+import simplejson as json
+
+# Maximum compressed size of a series payload, in bytes
+DEFAULT_MAX_PAYLOAD_SIZE = 2 * 1024 * 1024
+SERIES_HEADER = '{"series": ['
+SERIES_FOOTER = ']}'
+
+
+def compress_bound(size):
+    # Worst case size of `size` bytes once deflated, see zlib's compressBound
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+
+
+class SeriesPayload(object):
+    """
+    A deflated series payload of at most `max_size` bytes, written to
+    incrementally so that it is only held in memory in its compressed form.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.compressor = zlib.compressobj()
+        self.parts = []
+        self.size = 0
+        # Bytes written since the last sync, maybe not output by the compressor yet
+        self.pending = 0
+        self.empty = True
+        self._write(SERIES_HEADER)
+
+    def _write(self, data):
+        part = self.compressor.compress(data)
+        if part:
+            self.parts.append(part)
+            self.size += len(part)
+        self.pending += len(data)
+
+    def fits(self, serialized):
+        """ Whether series serialized as `serialized` can be added to the payload """
+        bound = self.max_size - compress_bound(len(SERIES_FOOTER)) - self.size
+        if compress_bound(self.pending + len(serialized) + 1) <= bound:
+            return True
+
+        # Sync the compressor, which costs a bit of compression ratio, to
+        # know the actual size of the payload
+        part = self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.parts.append(part)
+        self.size += len(part)
+        self.pending = 0
+        return compress_bound(len(serialized) + 1) <= bound - len(part)
+
+    def write(self, serialized):
+        if not self.empty:
+            serialized = ',' + serialized
+        self._write(serialized)
+        self.empty = False
+
+    def close(self):
+        self.parts.append(self.compressor.compress(SERIES_FOOTER) + self.compressor.flush())
+        return ''.join(self.parts)
+
+
+def decode_series(body, headers):
+    """
+    The series of a series payload, serialized as the inside of a JSON list,
+    None if `body` is not a JSON payload of series only.
+    """
+    if not headers.get('Content-Type', '').startswith('application/json'):
+        return None
+    encoding = headers.get('Content-Encoding')
+    try:
+        if encoding == 'deflate':
+            body = zlib.decompress(body)
+        elif encoding:
+            return None
+
+        # Dogstatsd payloads are series only, their series don't need to be parsed
+        if 'DD-Dogstatsd-Version' in headers and body.startswith(SERIES_HEADER) \
+                and body.endswith(SERIES_FOOTER):
+            return body[len(SERIES_HEADER):-len(SERIES_FOOTER)]
+
+        payload = json.loads(body)
+    except (zlib.error, ValueError):
+        return None
+    if not isinstance(payload, dict) or payload.keys() != ['series'] \
+            or not isinstance(payload['series'], list):
+        return None
+    return json.dumps(payload['series'])[1:-1]
@@ -0,0 +1,213 @@
+# stdlib
+from collections import defaultdict, namedtuple
+import errno
+import os
+import re
+
+PROCFS_PATH = '/proc'
+SYSFS_PATH = '/sys'
+
+# Process stats read from /proc/<pid>, fields are None when they can't be read
+ProcessStats = namedtuple('ProcessStats', [
+    'starttime',  # in clock ticks since boot, (pid, starttime) identifies a process
+    'cpu_time',   # user + system, in seconds
+    'threads',
+    'rss',
+    'vms',
+    'shared',
+    'ctx_switches_vol',
+    'ctx_switches_invol',
+    'open_fds',
+    'read_count',
+    'write_count',
+    'read_bytes',
+    'write_bytes',
+])
+
+try:
+    PAGESIZE = os.sysconf('SC_PAGE_SIZE')
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+except (AttributeError, ValueError, OSError):
+    PAGESIZE, CLOCK_TICKS = None, None
+
+
+def is_procfs_available(procfs_path=PROCFS_PATH):
+    return PAGESIZE is not None and os.path.isfile(os.path.join(procfs_path, 'self', 'stat'))
+
+
+def read_pseudo_file(path):
+    """ Returns the content of the /proc or /sys file `path`. Raises OSError if it can't be read. """
+    # These files are small, read them without the overhead of file objects
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        chunks = []
+        while True:
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                return ''.join(chunks)
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+
+
+def _read(path):
+    """ Returns the content of `path`, or None if it can't be read. Raises if the process is gone. """
+    try:
+        return read_pseudo_file(path)
+    except OSError, e:
+        if e.errno in (errno.EACCES, errno.EPERM):
+            return None
+        raise
+
+
+def read_process_stats(pid, procfs_path=PROCFS_PATH):
+    """
+    Read the stats of the process `pid` that psutil reads with memory_info(_ex),
+    num_threads, num_ctx_switches, cpu_percent, num_fds and io_counters, reading
+    each file of /proc/<pid> once instead of once per method.
+
+    Raises OSError if the process is gone.
+    """
+    proc_path = os.path.join(procfs_path, str(pid))
+
+    # "pid (comm) state ppid ...", comm may contain spaces and parentheses
+    stat = _read(os.path.join(proc_path, 'stat'))
+    if stat is None:
+        raise OSError(errno.EACCES, "Can't read the stat of process %s" % pid)
+    fields = stat[stat.rfind(')') + 2:].split()
+    starttime = int(fields[19])
+    cpu_time = float(int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    threads = int(fields[17])
+
+    rss, vms, shared = None, None, None
+    statm = _read(os.path.join(proc_path, 'statm'))
+    if statm is not None:
+        vms, rss, shared = [int(v) * PAGESIZE for v in statm.split()[:3]]
+
+    ctx_switches_vol, ctx_switches_invol = None, None
+    status = _read(os.path.join(proc_path, 'status'))
+    if status is not None:
+        for line in status.splitlines():
+            if line.startswith('voluntary_ctxt_switches'):
+                ctx_switches_vol = int(line.split()[1])
+            elif line.startswith('nonvoluntary_ctxt_switches'):
+                ctx_switches_invol = int(line.split()[1])
+
+    read_count, write_count, read_bytes, write_bytes = None, None, None, None
+    io = _read(os.path.join(proc_path, 'io'))
+    if io is not None:
+        for line in io.splitlines():
+            if line.startswith('syscr'):
+                read_count = int(line.split()[1])
+            elif line.startswith('syscw'):
+                write_count = int(line.split()[1])
+            elif line.startswith('read_bytes'):
+                read_bytes = int(line.split()[1])
+            elif line.startswith('write_bytes'):
+                write_bytes = int(line.split()[1])
+
+    try:
+        open_fds = len(os.listdir(os.path.join(proc_path, 'fd')))
+    except OSError, e:
+        if e.errno not in (errno.EACCES, errno.EPERM):
+            raise
+        open_fds = None
+
+    return ProcessStats(starttime, cpu_time, threads, rss, vms, shared,
+                        ctx_switches_vol, ctx_switches_invol, open_fds,
+                        read_count, write_count, read_bytes, write_bytes)
+
+
+# I/O stats of a block device, the fields of /proc/diskstats
+DiskStats = namedtuple('DiskStats', [
+    'reads',
+    'reads_merged',
+    'sectors_read',
+    'read_ms',
+    'writes',
+    'writes_merged',
+    'sectors_written',
+    'write_ms',
+    'in_progress',
+    'io_ms',
+    'weighted_io_ms',
+])
+
+
+def read_diskstats(procfs_path=PROCFS_PATH, sysfs_path=SYSFS_PATH):
+    """
+    Returns the `DiskStats` of the block devices, by name. Like iostat,
+    partitions and devices that never did any I/O are skipped.
+    """
+    devices = set(os.listdir(os.path.join(sysfs_path, 'block')))
+
+    diskstats = {}
+    with open(os.path.join(procfs_path, 'diskstats')) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 14:
+                continue
+            # Names with a slash, like cciss/c0d0, have a `!` in /sys/block
+            device = fields[2]
+            if device.replace('/', '!') not in devices:
+                continue
+            stats = DiskStats(*[int(v) for v in fields[3:14]])
+            if any(stats):
+                diskstats[device] = stats
+    return diskstats
+
+
+# The state column of /proc/net/{tcp,udp}[6], "  sl  local_address rem_address   st ...",
+# the only two hex digits of a line which follow a port, the 4 hex digits of rem_address
+_SOCKET_STATE_RE = re.compile(r':[0-9A-F]{4} ([0-9A-F]{2}) ')
+_SOCKET_TABLES = ('tcp', 'tcp6', 'udp', 'udp6')
+
+
+def count_socket_states(path, chunk_size=65536):
+    """
+    Returns the number of sockets of the table `path`, like /proc/net/tcp,
+    by state, the kernel's hex code of the state, like '0A' for LISTEN.
+
+    The table is streamed and only the state column is matched, sockets are
+    never split into fields, so that hosts with many of them stay cheap.
+    """
+    counts = defaultdict(int)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        pending = ''
+        while True:
+            chunk = os.read(fd, chunk_size)
+            if not chunk:
+                break
+            # Only match complete lines, keep the last one for the next chunk
+            end = chunk.rfind('\n')
+            if end == -1:
+                pending += chunk
+                continue
+            states = _SOCKET_STATE_RE.findall(pending + chunk[:end + 1])
+            pending = chunk[end + 1:]
+            for state in set(states):
+                counts[state] += states.count(state)
+        for state in _SOCKET_STATE_RE.findall(pending + '\n'):
+            counts[state] += 1
+    finally:
+        os.close(fd)
+    return dict(counts)
+
+
+def read_socket_states(procfs_path=PROCFS_PATH):
+    """
+    Returns the socket counts by state of /proc/net/{tcp,tcp6,udp,udp6}, by table
+    name. The IPv6 tables are empty when IPv6 is disabled.
+
+    Raises IOError or OSError if /proc/net can't be read.
+    """
+    socket_states = {}
+    for table in _SOCKET_TABLES:
+        try:
+            socket_states[table] = count_socket_states(os.path.join(procfs_path, 'net', table))
+        except OSError, e:
+            if e.errno != errno.ENOENT or not table.endswith('6'):
+                raise
+            socket_states[table] = {}
+    return socket_states
@@ -84,8 +84,9 @@ def pretty_statistics(stats):
     mem_before = before.get('memory_info')
     mem_after = after.get('memory_info')
 
+    output = ""
     if mem_before and mem_after:
-        return """
+        output += """
             Memory Before (RSS): {0}
             Memory After (RSS): {1}
             Difference (RSS): {2}
@@ -94,5 +95,17 @@ def pretty_statistics(stats):
             Difference (VMS): {5}
             """.format(mem_before['rss'], mem_after['rss'], mem_after['rss'] - mem_before['rss'],
                        mem_before['vms'], mem_after['vms'], mem_after['vms'] - mem_before['vms'])
-    else:
-        return ""
+
+    # Allocations of the run: objects tracked by the garbage collector, and copies of instances
+    objects_before = before.get('gc_objects')
+    objects_after = after.get('gc_objects')
+    if objects_before is not None and objects_after is not None:
+        output += """
+            Objects Before (GC): {0}
+            Objects After (GC): {1}
+            Difference (GC): {2}
+            Instance Copies: {3}
+            """.format(objects_before, objects_after, objects_after - objects_before,
+                       after.get('instance_copies', 0))
+
+    return output
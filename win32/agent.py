@@ -213,7 +213,7 @@ class DDAgent(multiprocessing.Process):
         collector_profiled_runs = 0
 
         # Load the checks.d checks
-        checksd = load_check_directory(self.config, self.hostname)
+        checksd = load_check_directory(self.config, self.hostname, deferred=True)
 
         # Main agent loop will run until interrupted
         while self.running: